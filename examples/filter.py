@@ -15,7 +15,6 @@
 import logging
 import time
 
-from gendas.statistics import count
 from gendas.engine import Gendas
 
 logging.basicConfig(format='[%(name)s] %(asctime)s %(levelname)s: %(message)s', datefmt='%H:%M:%S', level=logging.INFO)
@@ -27,40 +26,40 @@ print("Engine ready {:.3f} s".format(time.time()-t))
 t = time.time()
 
 # Count mutations that have a CADD score above 20 and are in a + strand gene
-positive_above20 = count(
+positive_above20 = (
     gd['variants'].merge(gd['cadd'], on=['REF', 'ALT']).merge(gd['genes']).filter(
         lambda r: r['cadd']['PHRED'] > 20 and r['genes']['STRAND'] == '+'
-    )
+    ).count()
 )
 print("Positive: {}".format(positive_above20))
 print("{:.3f} s".format(time.time()-t))
 t = time.time()
 
 # The same in a faster way
-fpositive_above20 = count(
+fpositive_above20 = (
     gd['genes'].merge(gd['variants']).merge(gd['cadd'], on=['REF', 'ALT']).filter(
         lambda r: r['cadd']['PHRED'] > 20 and r['genes']['STRAND'] == '+'
-    )
+    ).count()
 )
 print("Fast positive: {}".format(fpositive_above20))
 print("{:.3f} s".format(time.time()-t))
 t = time.time()
 
 # Count mutations that have a CADD score above 20 and are in a - strand gene
-negative_above20 = count(
+negative_above20 = (
     gd['variants'].merge(gd['cadd'], on=['REF', 'ALT']).merge(gd['genes']).filter(
         lambda r: r['cadd']['PHRED'] > 20 and r['genes']['STRAND'] == '-'
-    )
+    ).count()
 )
 print("Negative:{}".format(negative_above20))
 print("{:.3f} s".format(time.time()-t))
 t = time.time()
 
 # The same in a faster way
-fnegative_above20 = count(
+fnegative_above20 = (
     gd['genes'].merge(gd['variants']).merge(gd['cadd'], on=['REF', 'ALT']).filter(
         lambda r: r['cadd']['PHRED'] > 20 and r['genes']['STRAND'] == '-'
-    )
+    ).count()
 )
 print("Fast negative: {}".format(fnegative_above20))
 print("{:.3f} s".format(time.time()-t))
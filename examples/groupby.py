@@ -18,7 +18,7 @@ import pandas as pd
 from tqdm import tqdm
 
 from gendas.engine import Gendas
-from gendas.statistics import mean, max, min
+from gendas.statistics import mean, max, min, describe
 
 logging.basicConfig(format='[%(name)s] %(asctime)s %(levelname)s: %(message)s', datefmt='%H:%M:%S', level=logging.INFO)
 
@@ -52,7 +52,8 @@ def pan_stats(gd, row, test=None):
     scores = gd['variants'].merge(gd['cadd'], on=['REF', 'ALT'])['cadd']['PHRED']
     pan_muts = gd['variants']['SAMPLE']
 
-    row['MEAN'], row['MAX'], row['MIN'] = mean(scores), max(scores), min(scores)
+    stats = describe(scores, ['mean', 'max', 'min'])
+    row['MEAN'], row['MAX'], row['MIN'] = stats['mean'], stats['max'], stats['min']
     row['MUTS'], row['SMUTS'] = len(pan_muts), len(set(pan_muts))
     return row
 
@@ -14,33 +14,29 @@
 
 import time
 import logging
-import numpy as np
 import pandas as pd
 
 from gendas.engine import Gendas
+from gendas.statistics import resample_mean_pvalue, group_seed
 
+SEED = 1234
 
-def oncodrive_fml(gd, sampling=100):
 
-    cadds_gene = list(gd['cadd']['PHRED'])
-    cadds_observed = list(gd['variants'].merge(gd['cadd'], on=['REF', 'ALT'])['cadd']['PHRED'])
+def oncodrive_fml(gd, row, sampling=100):
 
-    if len(cadds_observed) == 0:
-        return None
+    cadds_observed = gd['variants'].merge(gd['cadd'], on=['REF', 'ALT'])['cadd']['PHRED']
 
-    background = np.array([np.mean(np.random.choice(cadds_gene, size=len(cadds_observed))) for a in range(sampling)])
-    obs = len(background[background >= np.mean(cadds_observed)])
-
-    return max(1, obs) / sampling
+    # Each gene has its own random numbers, so the results are the same with any number of workers
+    row['PVALUE'] = resample_mean_pvalue(gd['cadd']['PHRED'], cadds_observed, sampling,
+                                         seed=group_seed(SEED, row['GENE']))
+    return row
 
 
 logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', datefmt='%H:%M:%S', level=logging.INFO)
 gd = Gendas('data/gendas.conf')
 
 t = time.time()
-pvalues = gd.groupby(gd['exons']['GENE']).aggregate({
-    'PVALUE': oncodrive_fml
-})
+pvalues = gd.groupby(gd['exons']['GENE']).aggregate(oncodrive_fml)
 
 df = pd.DataFrame.from_dict(pvalues, orient='columns').set_index(['GENE'])
 df = df.sort_values('PVALUE', ascending=True)
@@ -0,0 +1,202 @@
+#
+#   Copyright 2018 Jordi Deu-Pons
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may not use this
+#   file except in compliance with the License. You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software distributed under
+#   the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+#   ANY KIND, either express or implied. See the License for the specific language
+#   governing permissions and limitations under the License.
+#
+
+"""
+    Cache of the results of genomic region queries. The groups of a groupby often query the same
+    regions (overlapping transcripts, shared exons), with this cache each region is read and parsed
+    only once by each process. A region is also answered from any cached region that contains it.
+"""
+
+import collections
+import itertools
+import os
+from bisect import bisect_left, bisect_right, insort
+
+import numpy as np
+
+# Approximated memory overhead of each cached entry, row and value
+ENTRY_OVERHEAD = 200
+ROW_OVERHEAD = 240
+VALUE_OVERHEAD = 50
+
+
+class RegionCache:
+    """
+    A least recently used cache of query results bounded by their approximated size in memory.
+
+    The results are cached as 'rows' (a list of rows) or as 'columns' (a dictionary with a NumPy array
+    of each column).
+    """
+
+    def __init__(self, max_bytes: int):
+        """
+        Args:
+            max_bytes: Maximum number of bytes of all the cached results
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.contained_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._regions = {}
+        self._counter = itertools.count()
+
+    def get(self, source, kind, sequence, begin, end, columns=None):
+        """
+        Args:
+            source: The queried source
+            kind: 'rows' or 'columns'
+            sequence: Sequence identifier
+            begin: Query begin position
+            end: Query end position
+            columns: Columns of interest of the source or None for all of them
+
+        Returns:
+            A shallow copy of the cached result or None if no cached region contains this one
+        """
+        columns = None if columns is None else frozenset(columns)
+        key = (source.label, kind, sequence, begin, end, columns)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return _copy(kind, entry[0])
+
+        covered = source._covered(begin, end)
+        regions = self._regions.get((source.label, kind, sequence))
+        if covered is not None and regions is not None:
+            first, last = covered
+            spans, span = regions
+
+            # Cached regions that start before this one, from the closest to the farthest it can be
+            for i in range(bisect_right(spans, (first, float('inf'))) - 1, -1, -1):
+                c_first, c_last, _, c_key = spans[i]
+                if c_first < first - span:
+                    break
+                if c_last >= last and (c_key[5] is None or (columns is not None and c_key[5] >= columns)):
+                    self.hits += 1
+                    self.contained_hits += 1
+                    self._entries.move_to_end(c_key)
+                    return _within(source, kind, self._entries[c_key][0], first, last)
+
+        self.misses += 1
+        return None
+
+    def set(self, source, kind, sequence, begin, end, columns, result):
+        """
+        Args:
+            source: The queried source
+            kind: 'rows' or 'columns'
+            sequence: Sequence identifier
+            begin: Query begin position
+            end: Query end position
+            columns: Columns of interest of the source or None for all of them
+            result: The query result
+        """
+        covered = source._covered(begin, end)
+        size = _size(kind, result)
+        if covered is None or size > self.max_bytes:
+            return
+
+        key = (source.label, kind, sequence, begin, end, None if columns is None else frozenset(columns))
+        if key in self._entries:
+            return
+
+        # The counter sorts the regions with the same coordinates
+        position = (covered[0], covered[1], next(self._counter))
+        self._entries[key] = (_copy(kind, result), size, position)
+        self.nbytes += size
+        spans, span = self._regions.get(key[:3], ([], 0))
+        insort(spans, position + (key,))
+        self._regions[key[:3]] = spans, max(span, covered[1] - covered[0])
+
+        while self.nbytes > self.max_bytes:
+            self._evict()
+
+    def _evict(self):
+        key, (_, size, position) = self._entries.popitem(last=False)
+        self.nbytes -= size
+        self.evictions += 1
+
+        spans, span = self._regions[key[:3]]
+        del spans[bisect_left(spans, position)]
+        if len(spans) == 0:
+            del self._regions[key[:3]]
+
+    def stats(self):
+        """
+        Returns: A dictionary with the cache counters of this process
+        """
+        return {
+            'pid': os.getpid(),
+            'hits': self.hits,
+            'contained_hits': self.contained_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+            'bytes': self.nbytes
+        }
+
+    def clear(self):
+        self._entries.clear()
+        self._regions.clear()
+        self.nbytes = 0
+
+    def __getstate__(self):
+        # The results are not sent to other processes and each process has its own counters
+        state = dict(self.__dict__)
+        state['_entries'] = collections.OrderedDict()
+        state['_regions'] = {}
+        state['_counter'] = itertools.count()
+        state.update(nbytes=0, hits=0, contained_hits=0, misses=0, evictions=0)
+        return state
+
+
+def _within(source, kind, result, first, last):
+    """
+    Returns: The rows of a cached result that overlap the closed interval from first to last
+    """
+    if kind == 'rows':
+        return [r for r in result if r[source.begin] <= last and r[source.end] >= first]
+
+    if len(result) == 0:
+        return {}
+    mask = (result[source.begin] <= last) & (result[source.end] >= first)
+    return {h: v[mask] for h, v in result.items()}
+
+
+def _copy(kind, result):
+    """
+    Returns: A shallow copy of a query result, so the callers cannot change the cached one
+    """
+    return list(result) if kind == 'rows' else dict(result)
+
+
+def _size(kind, result):
+    """
+    Returns: Approximated size in memory of a query result
+    """
+    if kind == 'rows':
+        if len(result) == 0:
+            return ENTRY_OVERHEAD
+        return ENTRY_OVERHEAD + len(result) * (ROW_OVERHEAD + VALUE_OVERHEAD * len(result[0]))
+
+    size = ENTRY_OVERHEAD
+    for values in result.values():
+        size += values.nbytes
+        if values.dtype == np.object_:
+            size += VALUE_OVERHEAD * len(values)
+    return size
@@ -14,23 +14,255 @@
 
 import logging
 import os
+import queue
+import threading
+import time
+from collections import deque
+from itertools import groupby, permutations
 from os.path import join, dirname
 
 from configobj import ConfigObj, Section
-from pathos.pools import ProcessPool, ParallelPool
+from pathos.pools import ParallelPool
 from tqdm import tqdm
 
-from gendas.sources import GendasSource, TabixSource, IntervalTreeSource
+import numpy as np
+
+from gendas.cache import RegionCache
+from gendas.expressions import Expression, Column, Comparison, IsIn, split, with_columns, filter_batch
+from gendas.sources import GendasSource, TabixSource, IntervalTreeSource, ArraySource, BATCH_SIZE
 from gendas.statistics import count
-from gendas.utils import _get_chunks, _overlap_intervals
+from gendas.tabix.cache import BlockCache, SharedBlockCache
+from gendas.utils import _get_chunks, _overlap_intervals, _rows_to_batches, _coalesce
+from gendas.workers import WorkerPool, _is_worker
 
 logger = logging.getLogger("gendas")
 
+# Maximum number of left rows that are joined at once in a merge
+MERGE_BATCH_SIZE = 1024
+
+# Expected duration in seconds of each groupby task
+TASK_SECONDS = 1.0
+
+# Maximum number of merged datasets to search the join order with the lowest cost
+MAX_REORDER = 6
+
+# The statistics are rough estimates, a merge is only reordered when the estimated cost is this times lower
+REORDER_GAIN = 2
+
 SOURCE_TYPES = {
     'tabix': TabixSource,
-    'mem': IntervalTreeSource
+    'mem': IntervalTreeSource,
+    'array': ArraySource
 }
 
+# Configuration parameters that are only passed to the sources when they are defined
+SOURCE_OPTIONS = {'backend': str, 'processes': int}
+
+# Default size in megabytes of the uncompressed blocks cache shared by all the sources
+BLOCK_CACHE_SIZE = 256
+
+# Default size in megabytes of the queries results cache of the sources that enable it
+REGION_CACHE_SIZE = 128
+
+
+def _filter_columns(fn, columns):
+    """
+    Columns to read to compute a filter
+
+    Args:
+        fn: A filtering function or a column expression
+        columns: Columns of interest
+    """
+    if isinstance(fn, Expression):
+        return with_columns(columns, fn)
+
+    # A filtering function can read any column
+    return None
+
+
+def _profile(source, regions=None):
+    """
+    Estimated rows of a source by sequence
+
+    Args:
+        source: A gendas source
+        regions: Only count the rows in these regions. None for the whole genome.
+
+    Returns:
+        A dictionary like {sequence: (rows, rows_per_position)} or None if the source has no statistics
+    """
+    statistics = source.statistics()
+    if statistics is None:
+        return None
+
+    profile = {seq: (rows if regions is None else 0, rows / max(1, end - begin))
+               for seq, (rows, begin, end) in statistics.items()}
+    for seq, begin, end in (regions or []):
+        if seq in profile:
+            rows, density = profile[seq]
+            profile[seq] = (rows + source.estimate(seq, begin, end), density)
+    return profile
+
+
+def _join_cost(order, profiles, widths, costs):
+    """
+    Estimated cost of a join order in rows read. Each join reads the right rows with one query per
+    left row or with a sequential sweep, the cheapest, plus the rows that it returns. A left row overlaps
+    the right rows that begin in a window as long as both rows widths.
+
+    Args:
+        order: Datasets indices in join order
+        profiles: Estimated rows of each dataset (see '_profile')
+        widths: Average rows width of each dataset
+        costs: Cost of a query at each dataset in rows read
+    """
+    current = {seq: rows for seq, (rows, _) in profiles[order[0]].items()}
+    width = widths[order[0]]
+    cost = sum(current.values())
+    for i in order[1:]:
+        for seq, rows in current.items():
+            if seq in profiles[i]:
+                cost += min(rows * costs[i], profiles[i][seq][0]) if costs[i] > 1 else rows
+        current = {
+            seq: rows * profiles[i][seq][1] * (width + widths[i])
+            for seq, rows in current.items() if seq in profiles[i]
+        }
+        cost += sum(current.values())
+        width = min(width, widths[i])
+    return cost
+
+
+def _build_merge(datasets, keys):
+    """
+    Merge datasets in the given order
+
+    Args:
+        datasets: Datasets in join order
+        keys: All the join keys like (label, label, column)
+
+    Returns:
+        A gendas merge view
+    """
+    merge = None
+    joined = {datasets[0].source.label}
+    for dataset in datasets[1:]:
+        label = dataset.source.label
+        m_keys = []
+        for a, b, o in keys:
+            other = b if a == label else a if b == label else None
+            if other in joined and (other, o) not in m_keys:
+                m_keys.append((other, o))
+
+        on = sorted({o for _, o in m_keys}) or None
+        merge = GendasMerge(datasets[0], dataset, on=on) if merge is None else GendasMultipleMerge(merge, dataset, on=on)
+        merge.keys = m_keys
+        merge.plan = merge
+        joined.add(label)
+
+    return merge
+
+
+def _submit(executor, fn, arg, key, done):
+    """
+    Run a function at a pool and put a tuple like (key, result, exception) in the 'done' queue when it finishes
+
+    Args:
+        executor: An engine pool
+        fn: The function to run
+        arg: The function argument
+        key: A value to identify the task
+        done: A queue
+    """
+    if isinstance(executor, WorkerPool):
+        executor.apply_async(fn, (arg,), callback=lambda r: done.put((key, r, None)),
+                             error_callback=lambda e: done.put((key, None, e)))
+        return
+
+    # The remote pools do not have callbacks, a thread waits for each result
+    def wait(result):
+        try:
+            done.put((key, result.get(), None))
+        except Exception as e:
+            done.put((key, None, e))
+
+    threading.Thread(target=wait, args=(executor.apipe(fn, arg),), daemon=True).start()
+
+
+def _filter_batches(expression, batches):
+    """
+    Filter nested column batches evaluating the expression vectorized
+    """
+    for batch in batches:
+        batch = filter_batch(expression, batch)
+        if len(next(iter(next(iter(batch.values())).values()))) > 0:
+            yield batch
+
+
+def _query_many(source, regions, columns=None):
+    """
+    Query the rows of several regions of a source, reusing the cached results if the source has
+    a region cache
+
+    Args:
+        source: A gendas source
+        regions: A list of tuples like (sequence, begin, end)
+        columns: Columns of interest of the source
+
+    Returns:
+        A list with the rows of each region
+    """
+    cache = source.region_cache
+    if cache is None:
+        return source.query_many(regions, columns=columns)
+
+    results = [cache.get(source, 'rows', sequence, begin, end, columns) for sequence, begin, end in regions]
+    missing = [i for i, rows in enumerate(results) if rows is None]
+    if len(missing) > 0:
+        for i, rows in zip(missing, source.query_many([regions[i] for i in missing], columns=columns)):
+            cache.set(source, 'rows', *regions[i], columns, rows)
+            results[i] = rows
+    return results
+
+
+def _query_rows(source, sequence, begin, end, columns=None):
+    """
+    Query the rows of a region of a source, reusing the cached results if the source has a region cache
+    """
+    if source.region_cache is None:
+        return source.query(sequence, begin, end, columns=columns)
+    return iter(_query_many(source, [(sequence, begin, end)], columns=columns)[0])
+
+
+def _query_batches(source, sequence, begin, end, batch_size, columns=None):
+    """
+    Query the column batches of a region of a source, reusing the cached results if the source has
+    a region cache
+    """
+    cache = source.region_cache
+    if cache is None:
+        yield from source.query_batches(sequence, begin, end, batch_size=batch_size, columns=columns)
+        return
+
+    values = cache.get(source, 'columns', sequence, begin, end, columns)
+    if values is None:
+        batches = list(source.query_batches(sequence, begin, end, batch_size=batch_size, columns=columns))
+        values = {h: np.concatenate([b[h] for b in batches]) for h in batches[0]} if len(batches) > 0 else {}
+        cache.set(source, 'columns', sequence, begin, end, columns, values)
+
+    total = len(values[source.begin]) if len(values) > 0 else 0
+    for i in range(0, total, batch_size):
+        yield {h: v[i:i + batch_size] for h, v in values.items()}
+
+
+def _cache_stats(manager):
+    """
+    Returns: The region cache counters of the current process or None if no source uses it
+    """
+    for source in manager.sources.values():
+        if source.region_cache is not None:
+            return source.region_cache.stats()
+    return None
+
 
 class Gendas:
     """
@@ -38,7 +270,8 @@ class Gendas:
         All the queries start here.
     """
 
-    def __init__(self, configfile: 'str' = None, workers: 'int' = os.cpu_count(), servers=None, progress: 'int' = 20):
+    def __init__(self, configfile: 'str' = None, workers: 'int' = os.cpu_count(), servers=None, progress: 'int' = 20,
+                 cache_size: 'int' = None, shared_cache: 'bool' = None, region_cache_size: 'int' = None):
         """
         Initialize a gendas engine
 
@@ -47,19 +280,46 @@ class Gendas:
             workers: Total number of workers to parallelize the computations. Defaults to total number of cores.
             servers: A list of servers where to distribute the parallelization. Defaults to only localhost.
             progress: A smaller number means that gendas will report progress more often. Defaults to 20.
+            cache_size: Megabytes of uncompressed blocks cached for all the sources. Defaults to the 'cache_size'
+                parameter of the configuration file or BLOCK_CACHE_SIZE.
+            shared_cache: True to share the cached blocks between all the workers of this host using shared
+                memory. Defaults to the 'shared_cache' parameter of the configuration file or False.
+            region_cache_size: Megabytes of queries results cached at each process for the sources that enable
+                it with the 'cache' parameter. Defaults to the 'region_cache_size' parameter of the configuration
+                file or REGION_CACHE_SIZE.
 
         """
         self.workers = workers
         self.servers = servers
         self.progress = progress
         self.sources = {}
+        self.workers_cache_stats = {}
+        self._pool = None
 
+        config = None
         if configfile is not None:
             if not os.path.exists(configfile):
                 raise FileNotFoundError("File {} not found".format(configfile))
+            config = ConfigObj(configfile)
+
+        # Uncompressed blocks cache
+        if cache_size is None:
+            cache_size = config.as_int('cache_size') if config is not None and 'cache_size' in config \
+                else BLOCK_CACHE_SIZE
+        if shared_cache is None:
+            shared_cache = config is not None and 'shared_cache' in config and config.as_bool('shared_cache')
+        cache_bytes = cache_size * 2 ** 20
+        self.block_cache = SharedBlockCache(cache_bytes) if shared_cache else BlockCache(cache_bytes)
+
+        # Queries results cache
+        if region_cache_size is None:
+            region_cache_size = config.as_int('region_cache_size') if config is not None and \
+                'region_cache_size' in config else REGION_CACHE_SIZE
+        self.region_cache = RegionCache(region_cache_size * 2 ** 20)
+
+        if config is not None:
 
             # Load datasets from config file
-            config = ConfigObj(configfile)
             for key, section in config.items():
 
                 # Skip general parameters
@@ -69,6 +329,9 @@ class Gendas:
                 # Load the source type
                 source = SOURCE_TYPES[str(section['type']).lstrip().lower()]
 
+                # Optional source specific parameters
+                options = {k: t(section[k]) for k, t in SOURCE_OPTIONS.items() if k in section}
+
                 # Create a source instance from the configuration
                 self[key] = source(
                     join(dirname(configfile), section['file']),
@@ -77,9 +340,14 @@ class Gendas:
                     sequence=section['sequence'],
                     begin=section['begin'],
                     end=section['end'],
-                    indices=section.get('indices', None)
+                    indices=section.get('indices', None),
+                    **options
                 )
 
+                # Cache the queries results of this source
+                if 'cache' in section and section.as_bool('cache'):
+                    self.sources[key].region_cache = self.region_cache
+
     def __setitem__(self, label: 'str', source: object) -> object:
         """
         Add a source
@@ -89,8 +357,16 @@ class Gendas:
             source: Source object
         """
         source.label = label
+        source.block_cache = self.block_cache
+
+        # The workers at other hosts cannot map the shared memory of this host
+        if self.servers is not None and isinstance(source, ArraySource):
+            source.shared = False
         self.sources[label] = source
 
+        # The workers need to be restarted to load the new source
+        self.close()
+
     def __getitem__(self, source: 'str') -> 'GendasDataset':
         """
         Returns a dataset view of the given source
@@ -103,6 +379,15 @@ class Gendas:
         """
         return GendasDataset(self.sources[source], self)
 
+    def cache_stats(self):
+        """
+        Returns: A dictionary with the queries results cache counters of this process and of each worker
+        that has run groupby tasks, by process id
+        """
+        stats = dict(self.workers_cache_stats)
+        stats[os.getpid()] = self.region_cache.stats()
+        return stats
+
     def groupby(self, field) -> 'GendasGroupBy':
         """
         Create a groupby view by the given field
@@ -117,29 +402,114 @@ class Gendas:
 
     def pool(self):
         """
-        Returns: The computing pool to process run the queries
+        Returns: The computing pool to process run the queries. The local pool is created only the first
+        time and reused by all the following queries.
 
         """
         if self.servers is None:
-            return ProcessPool(nodes=self.workers)
+            if self._pool is None:
+                self._pool = WorkerPool(self.workers, self.sources)
+            return self._pool
         else:
             return ParallelPool(nodes=self.workers, servers=self.servers)
 
+    def close(self):
+        """
+        Stop the engine workers. They will be started again if needed.
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_pool'] = None
+        return state
+
+
+class _Replay:
+    """
+    An iterable of the items of an iterator that can be iterated many times. The items are read from
+    the iterator only when the first iteration needs them, and kept for the next iterations.
+    """
+
+    def __init__(self, iterator):
+        self.iterator = iter(iterator)
+        self.items = []
+
+    def __iter__(self):
+        i = 0
+        while True:
+            if i < len(self.items):
+                yield self.items[i]
+                i += 1
+                continue
+
+            if self.iterator is None:
+                return
+            try:
+                item = next(self.iterator)
+            except StopIteration:
+                self.iterator = None
+                return
+            self.items.append(item)
+
 
 class GendasSlice:
     """
     A gendas slice is a view of only some genomic regions (segments) of the whole genome.
     """
 
-    def __init__(self, manager: Gendas, segments: list):
+    def __init__(self, manager: Gendas, segments: list, shared: bool = False):
         """
 
         Args:
             manager: A gendas engine
             segments: The genomic segments of interest. A list of tuples like (chromosome, start, end)
+            shared: True to share the scans of this slice, so the datasets that read the same columns of a
+                source only read it once. The first one streams the data and it is kept in memory for the
+                next ones. The memory cost is the data of those columns at all the segments. Defaults to False.
         """
         self.manager = manager
         self.segments = segments
+        self.read = set()
+        self._scans = {} if shared else None
+        self._union = None
+
+    def union(self):
+        """
+        Returns: The union of the segments sorted by sequence and begin, as a list of disjoint and
+        not contiguous tuples like (chromosome, start, end)
+        """
+        if self._union is None:
+            self._union = [(s, b, e) for s, b, e, _ in _coalesce(self.segments, lambda *args: False)]
+        return self._union
+
+    def _scan(self, source, kind, columns, read):
+        """
+        Read the data of a source at this slice, or reuse it if the slice is shared and a previous
+        scan of the same kind read all these columns.
+
+        Args:
+            source: A gendas source
+            kind: 'rows' or the batch size of a batches scan
+            columns: Columns of interest of the source or None for all of them
+            read: A function without arguments that reads the data
+
+        Returns:
+            An iterable of rows or batches
+        """
+        if self._scans is None:
+            return read()
+
+        for (label, k, cached), data in self._scans.items():
+            if label == source.label and k == kind and \
+                    (cached is None or (columns is not None and cached >= set(columns))):
+                return data
+
+        data = _Replay(read())
+        self._scans[(source.label, kind, None if columns is None else frozenset(columns))] = data
+        return data
 
     def __getitem__(self, source):
         """
@@ -150,6 +520,7 @@ class GendasSlice:
         Returns: A slice view limiting to the given source
 
         """
+        self.read.add(source)
         return GendasSliceDataset(self.manager.sources[source], self)
 
 
@@ -198,39 +569,98 @@ class GendasDataset:
         Returns: A generator to the results.
 
         """
-        return self._map_par(fn)
+        if self._parallel():
+            return self._map_par(fn)
+        return self._map_seq(fn)
 
     def _map_seq(self, fn):
         """
         Sequential implementation of the map (for debugging purposes only)
         """
-        return map(fn, self)
+        return map(fn, self._rows())
 
     def _map_par(self, fn):
         """
         Parallel implementation of the map
         """
+        return self._partitions(lambda p: list(map(fn, self._rows(p=p))))
+
+    def _partitions(self, fn):
+        """
+        Compute all the partitions of this dataset at the engine workers.
+
+        Args:
+            fn: A function that receives a partition and returns a list of results
+
+        Returns:
+            A generator of all the results following the partitions order
+        """
         cores = self.manager.workers
         logger.debug("ready to create pool")
         with self.manager.pool() as executor:
             logger.debug("pool created")
             partitions = cores * self.manager.progress
-            mapfn = lambda p: list(map(fn, self.__iter__(p=(p, partitions))))
-            for items in executor.imap(mapfn, range(cores)):
+            mapfn = lambda p: fn((p, partitions))
+            for items in executor.imap(mapfn, range(partitions)):
                 for item in items:
                     yield item
 
+    def iter_batches(self, batch_size=BATCH_SIZE, p=None, columns=None):
+        """
+        Iterate this dataset in column batches. Each batch is a dictionary with a NumPy
+        array for each column.
+
+        Args:
+            batch_size: Maximum number of rows at each batch
+            p: Partition parameter. Useful when iterating in parallel.
+            columns: Columns of interest (see '_rows')
+        """
+        if p is None and self._parallel():
+            it = self._partitions(lambda p: list(self._batches(batch_size, p=p, columns=columns)))
+        else:
+            it = self._batches(batch_size, p=p, columns=columns)
+
+        for b in it:
+            yield b
+
+    def _batches(self, batch_size, p=None, columns=None):
+        """
+        Private implementation to iterate this dataset in column batches
+        """
+        return self.source.iter_batches(batch_size=batch_size, p=p, columns=self._source_columns(columns))
+
+    def _rows_batches(self, rows, batch_size, columns=None):
+        """
+        Group rows of this dataset source into column batches
+        """
+        fields = self.source._fields(self._source_columns(columns))
+        return _rows_to_batches(rows, [h for _, h, _ in fields], [c for _, _, c in fields], batch_size)
+
+    def _source_columns(self, columns):
+        """
+        Columns of interest of this dataset source
+
+        Args:
+            columns: Columns of interest of all the sources
+        """
+        if columns is None:
+            return None
+        return columns.get(self.source.label, ())
+
     def filter(self, fn):
         """
         Filter the rows of this dataset
 
         Args:
-            fn: A function that return true/false to filter the rows
+            fn: A function that return true/false to filter the rows, or a column expression
+                like gd['cadd']['PHRED'] > 20
 
         Returns:
             A filtered view of this dataset
 
         """
+        if isinstance(fn, Expression) and not fn.sources() <= {self.source.label}:
+            raise ValueError("The expression {!r} reads other sources than '{}'".format(fn, self.source.label))
         return GendasDatasetFilter(self, fn)
 
     def count(self, progress=False):
@@ -244,6 +674,8 @@ class GendasDataset:
             Total number of rows
 
         """
+        if self._parallel():
+            return self._count_par(progress=progress)
         return self._count_seq(progress=progress)
 
     def _count_seq(self, progress=False):
@@ -252,8 +684,8 @@ class GendasDataset:
         """
         logger.debug("Count sequencial")
         if progress:
-            return count(tqdm(self))
-        return count(self)
+            return count(tqdm(self._rows(columns={})))
+        return count(self._rows(columns={}))
 
     def _count_par(self, progress=False):
         """
@@ -265,10 +697,10 @@ class GendasDataset:
         with self.manager.pool() as executor:
             logger.debug("pool created")
             partitions = cores * self.manager.progress
-            mapfn = lambda p: list(map(count, self.__iter__(p=(p, partitions))))
-            it = executor.uimap(mapfn, range(cores))
+            mapfn = lambda p: count(self._rows(p=(p, partitions), columns={}))
+            it = executor.uimap(mapfn, range(partitions))
             if progress:
-                it = tqdm(it, total=cores)
+                it = tqdm(it, total=partitions)
             return sum(it)
 
     def head(self, n=10):
@@ -278,28 +710,75 @@ class GendasDataset:
         Args:
             n: Total number of rows to return
         """
-        for i, r in enumerate(self, start=1):
+        for i, r in enumerate(self._rows(), start=1):
             if i > n:
                 break
             yield r
             if i == n:
                 break
 
-    def _rows(self, p=None):
+    def _rows(self, p=None, columns=None):
         """
         Private implementation to iterate over this dataset
 
         Args:
             p: Partition parameter. Useful when iterating in parallel.
+            columns: Columns of interest as a dictionary like {source_label: {column, ...}, ...}. The sources
+                are only required to parse these columns plus the coordinates. Defaults to None, all the columns.
 
         """
-        return self.source.__iter__(p=p)
+        return self.source.__iter__(p=p, columns=self._source_columns(columns))
 
-    def __iter__(self, p=None):
+    def _query(self, sequence, begin, end, columns=None):
         """
-        Iterate this dataset rows
+        Private implementation to query the rows of this dataset that overlap a genomic region
+
+        Args:
+            sequence: Sequence name
+            begin: Begin position
+            end: End position
+            columns: Columns of interest (see '_rows')
+        """
+        return self.source.query(sequence, begin, end, columns=self._source_columns(columns))
+
+    def _query_many(self, regions, columns=None):
+        """
+        Private implementation to query the rows of several genomic regions at once
+
+        Args:
+            regions: A list of tuples like (sequence, begin, end)
+            columns: Columns of interest (see '_rows')
+
+        Returns:
+            A list with the rows of each region
+        """
+        return _query_many(self.source, regions, columns=self._source_columns(columns))
+
+    def _partitioned(self):
+        """
+        Returns: True if the rows of this dataset can be computed by partitions
+        """
+        return True
+
+    def _regions(self):
+        """
+        Returns: The genomic regions that this dataset is limited to, as a list of tuples like
+        (sequence, begin, end), or None if it covers the whole genome
+        """
+        return None
+
+    def _parallel(self):
         """
-        for r in self._rows(p=p):
+        Returns: True if this dataset must be computed in parallel by the engine workers
+        """
+        return self.manager.workers > 1 and self._partitioned() and not _is_worker()
+
+    def __iter__(self, p=None, columns=None):
+        """
+        Iterate this dataset rows. The rows are streamed sequentially, use 'map' or 'count'
+        to compute the whole dataset at the engine workers.
+        """
+        for r in self._rows(p=p, columns=columns):
             yield r
 
     def __len__(self):
@@ -318,14 +797,43 @@ class GendasDatasetFilter(GendasDataset):
         """
         Args:
             dataset: Dataset to filter
-            filter: Filtering function
+            filter: Filtering function or column expression
         """
         super().__init__(dataset.source, dataset.manager)
         self.dataset = dataset
         self.filter = filter
 
-    def __iter__(self, p=None):
-        return filter(self.filter, self.dataset)
+    def _rows(self, p=None, columns=None):
+        return self._filter_rows(self.dataset._rows(p=p, columns=_filter_columns(self.filter, columns)))
+
+    def _query(self, sequence, begin, end, columns=None):
+        return self._filter_rows(self.dataset._query(sequence, begin, end, columns=_filter_columns(self.filter, columns)))
+
+    def _query_many(self, regions, columns=None):
+        return [
+            list(self._filter_rows(rows))
+            for rows in self.dataset._query_many(regions, columns=_filter_columns(self.filter, columns))
+        ]
+
+    def _filter_rows(self, rows):
+        if isinstance(self.filter, Expression):
+            label = self.source.label
+            return (r for r in rows if self.filter.evaluate({label: r}))
+        return filter(self.filter, rows)
+
+    def _batches(self, batch_size, p=None, columns=None):
+        if not isinstance(self.filter, Expression):
+            return self._rows_batches(self._rows(p=p), batch_size, columns=columns)
+
+        label = self.source.label
+        batches = self.dataset._batches(batch_size, p=p, columns=_filter_columns(self.filter, columns))
+        return (b[label] for b in _filter_batches(self.filter, ({label: b} for b in batches)))
+
+    def _partitioned(self):
+        return self.dataset._partitioned()
+
+    def _regions(self):
+        return self.dataset._regions()
 
 
 class GendasMergeDataset(GendasDataset):
@@ -337,12 +845,18 @@ class GendasMergeDataset(GendasDataset):
         super().__init__(source, merge.left.manager)
         self.merge = merge
 
-    def _rows(self, p=None):
-        for r in self.merge.__iter__(p=None):
+    def _rows(self, p=None, columns=None):
+        if columns is not None:
+            columns = {self.source.label: self._source_columns(columns)}
+
+        for r in self.merge._rows(p=p, columns=columns):
             yield r[self.source.label]
 
-    def __len__(self):
-        return len(self.merge)
+    def _batches(self, batch_size, p=None, columns=None):
+        return self._rows_batches(self._rows(p=p, columns=columns), batch_size, columns=columns)
+
+    def _partitioned(self):
+        return self.merge._partitioned()
 
 
 class GendasMerge(GendasDataset):
@@ -367,6 +881,8 @@ class GendasMerge(GendasDataset):
             left.source.label: left.source,
             right.source.label: right.source
         }
+        self.keys = self._on_keys(on, {left.source.label: left.source})
+        self.plan = None
 
     def __getitem__(self, source):
         """
@@ -397,58 +913,246 @@ class GendasMerge(GendasDataset):
         """
         Filter a merge view
 
+        When the filter is a column expression, the parts of it that only read one of the
+        merged datasets are applied to that dataset before the join.
+
         Args:
-            fn: The filtering function
+            fn: The filtering function or a column expression
 
         Returns: A gendas merge view filtered
 
         """
+        if isinstance(fn, Expression):
+            merge, fn = self._pushdown(fn)
+            return merge if fn is None else GendasMergeFilter(merge, fn)
         return GendasMergeFilter(self, fn)
 
-    def _rows(self, p=None):
+    def _pushdown(self, expression):
+        """
+        Filter the merged datasets with the conjuncts of an expression that only read one of them
+
+        Args:
+            expression: A column expression
+
+        Returns:
+            A tuple like (merge, rest_of_expression)
+        """
+        left, expression = split(expression, {self.left.source.label})
+        right, expression = split(expression, {self.right.source.label})
+        merge = GendasMerge(
+            self.left if left is None else self.left.filter(left),
+            self.right if right is None else self.right.filter(right),
+            on=self.on
+        )
+        return merge, expression
+
+    def _rows(self, p=None, columns=None):
         """
         Iterate the left most dataset computing the 'inner join' merge
         of other datasets
 
         Args:
             p: partition. Internal parameter to use when doing iterations in parallel
+            columns: Columns of interest
         """
-        for l_row in self.left.__iter__(p=p):
-            seq = l_row[self.left.source.sequence]
-            begin = l_row[self.left.source.begin]
-            end = l_row[self.left.source.end]
+        plan = self._plan()
+        if plan is not self:
+            return plan._rows(p=p, columns=columns)
 
-            if self.on is not None:
-                l_key = [l_row[o] for o in self.on]
-            else:
-                l_key = None
+        columns = self._columns(columns)
+        rows = ({self.left.source.label: r} for r in self.left._rows(p=p, columns=columns))
+        return self._join(rows, columns=columns)
 
-            r_rows = []
-            for r in self.right.source.query(seq, begin - 1, end):
-                if self.on is not None:
-                    r_key = [r[o] for o in self.on]
-                    if l_key != r_key:
-                        continue
+    @staticmethod
+    def _on_keys(on, sources):
+        """
+        Join keys of the right dataset. Each 'on' column of the right rows has to be equal
+        to the same column of all the merged sources that have it.
 
-                r_rows.append(r)
+        Args:
+            on: A list of columns
+            sources: The merged sources by label
+
+        Returns:
+            A list of tuples like (source_label, column)
+        """
+        return [(label, o) for o in (on or []) for label, source in sources.items() if o in source.header]
 
-            # Inner join
-            for r_row in r_rows:
+    def _columns(self, columns):
+        """
+        Columns of interest plus the columns that the join needs
+        """
+        if columns is None:
+            return None
+
+        columns = {label: set(c) for label, c in columns.items()}
+        for label, o in self.keys:
+            columns.setdefault(label, set()).add(o)
+            columns.setdefault(self.right.source.label, set()).add(o)
+        return columns
+
+    def _chain(self):
+        """
+        Flatten the merged datasets
+
+        Returns:
+            A tuple like (datasets, keys) where 'keys' is a list of join keys like (label, label, column),
+            or None if the merge cannot be reordered
+        """
+        label = self.right.source.label
+        return [self.left, self.right], [(k, label, o) for k, o in self.keys]
+
+    def _plan(self):
+        """
+        Returns: An equivalent merge with the join order of lowest estimated cost
+        """
+        if self.plan is None:
+            self.plan = self._reorder()
+        return self.plan
+
+    def _reorder(self):
+        """
+        Choose the driving dataset and the join order of the merged datasets.
+
+        All the merged datasets rows must overlap a common region and satisfy the same join keys in any order,
+        so the plan with the lowest estimated number of rows to scan and query is chosen using the sources
+        statistics. A dataset that cannot be partitioned (ex: a slice) keeps driving the merge.
+
+        Returns:
+            The reordered merge, or this merge if there is no better order or the statistics are unknown
+        """
+        chain = self._chain()
+        if chain is None or len(chain[0]) > MAX_REORDER:
+            return self
+
+        datasets, keys = chain
+        pinned = not datasets[0]._partitioned()
+        regions = datasets[0]._regions() if pinned else None
+
+        profiles = [_profile(d.source, regions) for d in datasets]
+        if any(p is None for p in profiles):
+            return self
+        widths = [d.source.width() or 1 for d in datasets]
+        costs = [d.source.QUERY_COST for d in datasets]
+
+        orders = [
+            o for o in permutations(range(len(datasets)))
+            if (o[0] == 0 if pinned else datasets[o[0]]._partitioned())
+        ]
+        cost = {o: _join_cost(o, profiles, widths, costs) for o in orders}
+        best = min(orders, key=lambda o: cost[o])
+        if cost[best] * REORDER_GAIN > cost[orders[0]]:
+            return self
+
+        logger.debug("merge reordered as {}".format([datasets[i].source.label for i in best]))
+        return _build_merge([datasets[i] for i in best], keys)
+
+    def _batches(self, batch_size, p=None, columns=None):
+        """
+        Column batches of a merge are dictionaries like {source_label: {column: array, ...}, ...}
+        """
+        fields = {
+            label: s._fields(None if columns is None else columns.get(label, ()))
+            for label, s in self.sources.items()
+        }
+        for chunk in _get_chunks(self._rows(p=p, columns=columns), size=batch_size):
+            if len(chunk) > 0:
                 yield {
-                    self.left.source.label: l_row,
-                    self.right.source.label: r_row
+                    label: next(_rows_to_batches([r[label] for r in chunk], [h for _, h, _ in f],
+                                                 [c for _, _, c in f], len(chunk)))
+                    for label, f in fields.items()
                 }
 
-    def __iter__(self, p=None):
+    def _region(self, m_row):
         """
-            Return a generator to iterate this
+        Genomic region of a left row as a tuple like (sequence, begin, end)
         """
-        for r in self._rows(p=p):
-            yield r
+        l_row = m_row[self.left.source.label]
+        return l_row[self.left.source.sequence], l_row[self.left.source.begin], l_row[self.left.source.end]
 
-    def __len__(self):
-        # TODO Implement the gendas merge count (without iterating everything)
-        raise NotImplementedError("GendasMerge.__len__ not implemented")
+    def _key(self, m_row):
+        """
+        Values of the join keys of a left row
+        """
+        if len(self.keys) == 0:
+            return None
+        return [m_row[label][o] for label, o in self.keys]
+
+    def _join(self, rows, columns=None):
+        """
+        Inner join of the left rows with the right dataset.
+
+        The left rows are joined in batches of consecutive rows of the same sequence. Each batch is
+        resolved with one query per row (close rows share a query) when the rows are sparse, or with
+        a single sequential sweep of the right source when there are more left rows than right blocks
+        to read in the region that the batch covers.
+
+        Args:
+            rows: An iterable of left rows like {source_label: row, ...} sorted by genomic position
+            columns: Columns of interest
+        """
+        label = self.right.source.label
+        for batch in _get_chunks(rows, size=MERGE_BATCH_SIZE):
+            for seq, group in groupby(batch, key=lambda m: self._region(m)[0]):
+                items = [(m_row, self._region(m_row), self._key(m_row)) for m_row in group]
+                begin = min(i[1][1] for i in items)
+                end = max(i[1][2] for i in items)
+
+                blocks = self.right.source.blocks(seq, begin, end)
+                if blocks is not None and len(items) > blocks:
+                    matches = self._sweep(seq, items, columns)
+                else:
+                    matches = self.right._query_many(
+                        [(seq,) + self.right.source.region(b, e) for _, (_, b, e), _ in items], columns=columns
+                    )
+
+                # Inner join
+                for (m_row, _, m_key), r_rows in zip(items, matches):
+                    for r_row in r_rows:
+                        if m_key is not None and [r_row[o] for _, o in self.keys] != m_key:
+                            continue
+
+                        res = {k: v for k, v in m_row.items()}
+                        res[label] = r_row
+                        yield res
+
+    def _sweep(self, seq, items, columns=None):
+        """
+        Sweep-line interval join. Queries the whole region of the left rows only once and
+        keeps an active set with the right rows that can still overlap the next left rows.
+
+        Args:
+            seq: Sequence of all the left rows
+            items: List of left rows like (row, (sequence, begin, end), key)
+            columns: Columns of interest
+
+        Returns:
+            A list with the overlapping right rows of each left row
+        """
+        source = self.right.source
+        order = sorted(range(len(items)), key=lambda i: items[i][1][1])
+        begin = items[order[0]][1][1]
+        end = max(i[1][2] for i in items)
+
+        right = iter(self.right._query(seq, *source.region(begin, end), columns=columns))
+        pending = next(right, None)
+        active = []
+        matches = [[] for _ in items]
+        for i in order:
+            _, (_, lo, hi), _ = items[i]
+
+            while pending is not None and pending[source.begin] <= hi:
+                active.append(pending)
+                pending = next(right, None)
+
+            # The left rows are sorted by begin, so rows ending before it will never overlap again
+            active = [r for r in active if r[source.end] >= lo]
+            matches[i] = [r for r in active if r[source.begin] <= hi]
+
+        return matches
+
+    def _partitioned(self):
+        return self.left._partitioned()
 
 
 class GendasMergeFilter(GendasMerge):
@@ -460,9 +1164,31 @@ class GendasMergeFilter(GendasMerge):
         super().__init__(merge.left, merge.right, merge.on)
         self.merge = merge
         self.filter = filter
+        self.sources = dict(merge.sources)
+
+    def filter(self, fn):
+        if isinstance(fn, Expression):
+            return GendasMergeFilter(self.merge.filter(fn), self.filter)
+        return GendasMergeFilter(self, fn)
+
+    def _chain(self):
+        # A filter function can read any merged dataset
+        return None
+
+    def _rows(self, p=None, columns=None):
+        rows = self.merge._rows(p=p, columns=_filter_columns(self.filter, columns))
+        if isinstance(self.filter, Expression):
+            return (r for r in rows if self.filter.evaluate(r))
+        return filter(self.filter, rows)
+
+    def _batches(self, batch_size, p=None, columns=None):
+        if not isinstance(self.filter, Expression):
+            return super()._batches(batch_size, p=p, columns=columns)
+        return _filter_batches(self.filter, self.merge._batches(batch_size, p=p,
+                                                                columns=_filter_columns(self.filter, columns)))
 
-    def __iter__(self, p=None):
-        return filter(self.filter, self.merge)
+    def _partitioned(self):
+        return self.merge._partitioned()
 
 
 class GendasMultipleMerge(GendasMerge):
@@ -478,59 +1204,128 @@ class GendasMultipleMerge(GendasMerge):
         for k, v in merge.sources.items():
             self.sources[k] = v
 
-    def _rows(self, p=None):
-        for m_row in self.merge.__iter__(p=p):
+        self.keys = self._on_keys(on, merge.sources)
 
-            l_row = m_row[self.left.source.label]
-            seq = l_row[self.left.source.sequence]
+    def _rows(self, p=None, columns=None):
+        plan = self._plan()
+        if plan is not self:
+            return plan._rows(p=p, columns=columns)
 
-            begin, end = _overlap_intervals(
-                [(m_row[s.label][s.begin], m_row[s.label][s.end])
-                 for s in self.merge.sources.values()]
-            )
+        columns = self._columns(columns)
+        return self._join(self.merge._rows(p=p, columns=columns), columns=columns)
 
-            if self.on is not None:
-                m_key = []
-                for o in self.on:
-                    for label, source in self.merge.sources.items():
-                        if o in source.header:
-                            m_key.append(m_row[label][o])
-            else:
-                m_key = None
+    def _chain(self):
+        chain = self.merge._chain()
+        if chain is None:
+            return None
+
+        datasets, keys = chain
+        label = self.right.source.label
+        return datasets + [self.right], keys + [(k, label, o) for k, o in self.keys]
 
-            r_rows = []
-            for r in self.right.source.query(seq, begin - 1, end):
-                if self.on is not None:
-                    r_key = [r[o] for o in self.on]
-                    if m_key != r_key:
-                        continue
+    def _pushdown(self, expression):
+        inner, expression = split(expression, set(self.merge.sources.keys()))
+        right, expression = split(expression, {self.right.source.label})
+        merge = GendasMultipleMerge(
+            self.merge if inner is None else self.merge.filter(inner),
+            self.right if right is None else self.right.filter(right),
+            on=self.on
+        )
+        return merge, expression
 
-                r_rows.append(r)
+    def _partitioned(self):
+        return self.merge._partitioned()
 
-            # Inner join
-            for r_row in r_rows:
-                res = {k: v for k, v in m_row.items()}
-                res[self.right.source.label] = r_row
-                yield res
+    def _region(self, m_row):
+        l_row = m_row[self.left.source.label]
+        begin, end = _overlap_intervals(
+            [(m_row[s.label][s.begin], m_row[s.label][s.end])
+             for s in self.merge.sources.values()]
+        )
+        return l_row[self.left.source.sequence], begin, end
 
 
 class GendasSliceDataset(GendasDataset):
     """
-    A dataset view of a source filtered by a gendas slice (a genomic regions definition)
+    A dataset view of a source filtered by a gendas slice (a genomic regions definition).
+
+    The rows are streamed in genomic order over the union of the slice segments, so a row that overlaps
+    several segments is returned only once. The segments that are close enough are read with only one
+    query (see GendasSource._mergeable) and each query stops at the end of its last segment.
     """
 
     def __init__(self, source: 'GendasSource', slice: 'GendasSlice'):
         super().__init__(source, slice.manager)
         self.slice = slice
-        self.rows = None
 
-    def _rows(self, p=None):
-        if self.rows is None:
-            self.rows = []
-            for s in self.slice.segments:
-                self.rows += list(self.source.query(s[0], s[1], s[2]))
+    def _rows(self, p=None, columns=None):
+        columns = self._source_columns(columns)
+        return self.slice._scan(self.source, 'rows', columns, lambda: self._segments_rows(columns))
+
+    def _groups(self):
+        """
+        Group the union of the segments to query them together
+
+        Returns:
+            A generator of tuples like (sequence, query_begin, query_end, begins, ends, previous) where begins
+            and ends are the sorted bounds of the grouped segments, and previous is the end of the previous
+            group at the same sequence (the rows that begin before it were already returned)
+        """
+        segments = self.slice.union()
+        previous = None
+        for sequence, begin, end, members in _coalesce(segments, self.source._mergeable):
+            begins = np.array([segments[i][1] for i in members])
+            ends = np.array([segments[i][2] for i in members])
+            last = previous[1] if previous is not None and previous[0] == sequence else None
+            yield (sequence,) + self.source.region(begin, end) + (begins, ends, last)
+            previous = sequence, end
+
+    def _segments_rows(self, columns=None):
+        source = self.source
+        for sequence, begin, end, begins, ends, previous in self._groups():
+            begins, ends = begins.tolist(), ends.tolist()
+            k = 0
+            for row in _query_rows(source, sequence, begin, end, columns=columns):
+                r_begin, r_end = row[source.begin], row[source.end]
+                if previous is not None and r_begin <= previous:
+                    continue
 
-        return self.rows
+                # First segment that ends after the row begins. The rows are sorted by begin.
+                while k < len(ends) and ends[k] < r_begin:
+                    k += 1
+                if k == len(ends):
+                    break
+                if begins[k] <= r_end:
+                    yield row
+
+    def _batches(self, batch_size, p=None, columns=None):
+        columns = self._source_columns(columns)
+        return self.slice._scan(self.source, batch_size, columns, lambda: self._segments_batches(batch_size, columns))
+
+    def _segments_batches(self, batch_size, columns=None):
+        source = self.source
+        for sequence, begin, end, begins, ends, previous in self._groups():
+            for batch in _query_batches(source, sequence, begin, end, batch_size, columns=columns):
+                r_begin, r_end = batch[source.begin], batch[source.end]
+                k = np.searchsorted(ends, r_begin, side='left')
+                mask = k < len(ends)
+                mask[mask] = begins[k[mask]] <= r_end[mask]
+                if previous is not None:
+                    mask &= r_begin > previous
+                if not mask.all():
+                    batch = {h: v[mask] for h, v in batch.items()}
+                if len(batch[source.begin]) > 0:
+                    yield batch
+
+                # The next batches begin after the last segment
+                if len(r_begin) > 0 and r_begin[-1] > ends[-1]:
+                    break
+
+    def _partitioned(self):
+        return False
+
+    def _regions(self):
+        return self.slice.union()
 
 
 class GendasColumn:
@@ -538,14 +1333,108 @@ class GendasColumn:
     A view of only one column of a dataset
     """
 
+    # The statistics functions read the column values in NumPy arrays (see gendas.statistics.columnar)
+    columnar = True
+
     def __init__(self, label: str, dataset: GendasDataset):
         self.dataset = dataset
         self.label = label
 
+    def _columns(self):
+        """
+        Returns: The columns that need to be read to get this column
+        """
+        return {self.dataset.source.label: {self.label}}
+
+    def expression(self):
+        """
+        Returns: A column expression of this column
+        """
+        return Column(self.dataset.source.label, self.label)
+
+    def _compare(self, op, other):
+        if isinstance(other, GendasColumn):
+            other = other.expression()
+        return Comparison(op, self.expression(), other)
+
+    def __eq__(self, other):
+        return self._compare('==', other)
+
+    def __ne__(self, other):
+        return self._compare('!=', other)
+
+    def __lt__(self, other):
+        return self._compare('<', other)
+
+    def __le__(self, other):
+        return self._compare('<=', other)
+
+    def __gt__(self, other):
+        return self._compare('>', other)
+
+    def __ge__(self, other):
+        return self._compare('>=', other)
+
+    __hash__ = object.__hash__
+
+    def isin(self, values):
+        """
+        Args:
+            values: A collection of values
+
+        Returns: A column expression that is true when the column value is one of the given values
+        """
+        return IsIn(self.expression(), values)
+
     def __iter__(self):
-        for r in self.dataset:
+        for r in self.dataset.__iter__(columns=self._columns()):
             yield r[self.label]
 
+    def iter_batches(self, batch_size=BATCH_SIZE):
+        """
+        Iterate the column values in NumPy arrays
+
+        Args:
+            batch_size: Maximum number of values at each array
+        """
+        for batch in self.dataset.iter_batches(batch_size=batch_size, columns=self._columns()):
+            yield batch[self.label]
+
+    def aggregate(self, state, batch_size=BATCH_SIZE):
+        """
+        Update a mergeable aggregate state (see gendas.statistics) with all the values of this column. When the
+        dataset is computed in parallel, each worker aggregates its partitions and only the partial states are
+        sent back to be merged.
+
+        Args:
+            state: An aggregate state
+            batch_size: Maximum number of values to update the state at once
+
+        Returns:
+            The updated state
+        """
+        if self.dataset._parallel():
+            for partial in self.dataset._partitions(lambda p: [self._aggregate(state.empty(), batch_size, p=p)]):
+                state.merge(partial)
+            return state
+
+        return self._aggregate(state, batch_size)
+
+    def _aggregate(self, state, batch_size, p=None):
+        for batch in self.dataset._batches(batch_size, p=p, columns=self._columns()):
+            if len(batch[self.label]) > 0:
+                state.update(batch[self.label])
+        return state
+
+    def values(self):
+        """
+        Returns: A NumPy array with all the values of this column
+        """
+        batches = list(self.iter_batches())
+        if len(batches) == 0:
+            return np.array([])
+        return np.concatenate(batches)
+
     def __len__(self):
         return len(self.dataset)
 
@@ -578,33 +1467,78 @@ class GendasGroupBy:
         """
         return self._aggregate_par(aggregator, **kwargs)
 
-    def _compute(self, aggregator, args, groups) -> dict:
+    def _compute(self, aggregator, args, groups, read=None) -> dict:
         label, segments = groups
         v = {self.field.label: label}
-        partition = GendasSlice(self.manager, segments)
         if type(aggregator) == dict:
+            # The aggregators of the same group share the scans of the columns that more than one reads
+            partition = GendasSlice(self.manager, segments, shared=len(aggregator) > 1)
             for f, aggregator in aggregator.items():
                 if len(args) > 0:
                     v[f] = aggregator(partition, **args)
                 else:
                     v[f] = aggregator(partition)
         else:
+            partition = GendasSlice(self.manager, segments)
             if len(args) > 0:
                 v = aggregator(partition, v, **args)
             else:
                 v = aggregator(partition, v)
+
+        if read is not None:
+            read.update(partition.read)
         return v
 
+    def _read(self, aggregator, args):
+        """
+        Find the sources that an aggregator reads, aggregating a group without segments
+
+        Returns:
+            A set of sources labels, or None if the aggregator fails without data
+        """
+        read = set()
+        try:
+            self._compute(aggregator, args, (None, []), read=read)
+        except Exception as e:
+            logger.debug("The sources that the aggregator reads are unknown: {}".format(e))
+            return None
+        return read
+
     def _compute_par(self, aggregator, args, groups):
         result = [self._compute(aggregator, args, group) for group in groups]
         return result
 
     def _mapfn(self, r):
-        return self._compute_par(self.aggregator, self.kwargs, r)
+        start = time.time()
+        result = self._compute_par(self.aggregator, self.kwargs, r)
+        return time.time() - start, result, _cache_stats(self.manager)
+
+    def _cost(self, segments, sources):
+        """
+        Estimate the cost of aggregating a group as its total span plus the compressed
+        bytes that the indexed sources have in its segments.
+
+        Args:
+            segments: A list of tuples like (sequence, begin, end)
+            sources: The sources that the aggregator reads
+        """
+        cost = 0
+        for seq, begin, end in segments:
+            cost += end - begin + 1
+            for source in sources:
+                nbytes = source.nbytes(seq, begin, end)
+                if nbytes is not None:
+                    cost += nbytes
+        return cost
 
     def _aggregate_par(self, aggregator: dict, **kwargs):
         """
-        Parallel implementation of the aggregate method
+        Parallel implementation of the aggregate method.
+
+        The groups are dispatched largest first in chunks with a similar estimated cost. There are always a
+        few more tasks than workers waiting, so idle workers take the next chunk as soon as they finish.
+        The chunks cost is adapted from the observed tasks duration to last around TASK_SECONDS, and it is
+        reduced at the end so that the last tasks are small.
         """
 
         cores = self.manager.workers
@@ -613,22 +1547,54 @@ class GendasGroupBy:
         labels = set(self.field)
         logger.debug("Retrive regions to aggregate")
         regions = list(filter(lambda r: r[0] in labels, regions))
-        regions_size = len(regions)
-        partitions = cores * self.manager.progress
-        chunksize = (regions_size // partitions) + 1
-        regions = list(_get_chunks(regions, size=chunksize))
-        logger.debug(
-            "{} chunks of {} regions (total {}) to run in {} partitions at {} cores".format(len(regions), chunksize,
-                                                                                            regions_size, partitions,
-                                                                                            cores))
-        # mapfn = lambda r: self._compute_par(aggregator, kwargs, r)
+        read = self._read(aggregator, kwargs)
+        sources = [s for label, s in self.manager.sources.items() if read is None or label in read]
+        costs = [self._cost(segments, sources) for _, segments in regions]
+        pending = deque(sorted(zip(costs, regions), key=lambda g: g[0], reverse=True))
+        remaining = sum(costs)
+
+        # Initial chunk cost until we have some tasks duration
+        budget = remaining / (cores * self.manager.progress)
+        speed = None
+        logger.debug("{} regions with a total cost of {} to run at {} cores".format(len(regions), remaining, cores))
 
         self.aggregator = aggregator
         self.kwargs = kwargs
 
         with self.manager.pool() as executor:
             logger.debug("pool created")
-            for items in executor.uimap(self._mapfn, regions):
+            done = queue.Queue()
+            running = 0
+            while len(pending) > 0 or running > 0:
+
+                # Keep the workers busy
+                while len(pending) > 0 and running < 2 * cores:
+                    limit = min(budget, remaining / (2 * cores))
+                    chunk, chunk_cost = [], 0
+                    while len(pending) > 0 and (len(chunk) == 0 or chunk_cost + pending[0][0] <= limit):
+                        cost, region = pending.popleft()
+                        chunk.append(region)
+                        chunk_cost += cost
+                    remaining -= chunk_cost
+                    _submit(executor, self._mapfn, chunk, chunk_cost, done)
+                    running += 1
+
+                # Wait for the next finished task
+                chunk_cost, result, error = done.get()
+                running -= 1
+                if error is not None:
+                    raise error
+
+                elapsed, items, stats = result
+                if stats is not None:
+                    self.manager.workers_cache_stats[stats['pid']] = stats
+
+                # Adapt the chunks cost to the observed speed
+                if chunk_cost > 0 and elapsed > 0:
+                    observed = chunk_cost / elapsed
+                    speed = observed if speed is None else 0.8 * speed + 0.2 * observed
+                    budget = speed * TASK_SECONDS
+
                 for item in items:
                     yield item
 
@@ -37,7 +37,7 @@ class HG19Source(GendasSource):
     def intersect(self, sequence, begin, end):
         yield sequence, begin, end
 
-    def query(self, sequence, begin, end):
+    def query(self, sequence, begin, end, columns=None):
         yield HG19Sequence(self, sequence, begin, end)
 
     def __len__(self):
@@ -0,0 +1,333 @@
+#
+#   Copyright 2018 Jordi Deu-Pons
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may not use this
+#   file except in compliance with the License. You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software distributed under
+#   the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+#   ANY KIND, either express or implied. See the License for the specific language
+#   governing permissions and limitations under the License.
+#
+
+"""
+    Declarative column expressions. Unlike a lambda function, the engine knows which columns an expression
+    reads, so it can evaluate each part of a filter as soon as the data of its sources is available and
+    evaluate it vectorized over column batches.
+
+    Expressions are created comparing dataset columns:
+
+        (gd['cadd']['PHRED'] > 20) & gd['genes']['STRAND'].isin(['+'])
+
+    All the expressions evaluate rows like {source_label: {column: value, ...}, ...} and batches
+    like {source_label: {column: array, ...}, ...}.
+"""
+
+import operator
+
+import numpy as np
+
+
+class Expression:
+    """
+    Base class of all the expressions
+    """
+
+    def evaluate(self, row):
+        """
+        Evaluate the expression on one row
+
+        Args:
+            row: A row like {source_label: {column: value, ...}, ...}
+
+        Returns:
+            The expression value
+        """
+        raise NotImplementedError()
+
+    def evaluate_batch(self, batch):
+        """
+        Evaluate the expression on a batch
+
+        Args:
+            batch: A batch like {source_label: {column: array, ...}, ...}
+
+        Returns:
+            A NumPy array with the value at each row
+        """
+        raise NotImplementedError()
+
+    def columns(self):
+        """
+        Returns: The columns that the expression reads as a dictionary like {source_label: {column, ...}, ...}
+        """
+        raise NotImplementedError()
+
+    def sources(self):
+        """
+        Returns: The set of source labels that the expression reads
+        """
+        return set(self.columns().keys())
+
+    def conjuncts(self):
+        """
+        Returns: A list of expressions that all of them need to be true for this expression to be true
+        """
+        return [self]
+
+    def __call__(self, row):
+        return self.evaluate(row)
+
+    def __and__(self, other):
+        return And(self, other)
+
+    def __or__(self, other):
+        return Or(self, other)
+
+    def __invert__(self):
+        return Not(self)
+
+
+class Column(Expression):
+    """
+    The value of a source column
+    """
+
+    def __init__(self, label, name):
+        """
+        Args:
+            label: Source label
+            name: Column name
+        """
+        self.label = label
+        self.name = name
+
+    def evaluate(self, row):
+        return row[self.label][self.name]
+
+    def evaluate_batch(self, batch):
+        return batch[self.label][self.name]
+
+    def columns(self):
+        return {self.label: {self.name}}
+
+    def __repr__(self):
+        return "{}.{}".format(self.label, self.name)
+
+
+class Comparison(Expression):
+    """
+    Compare a column with a value or with another column
+    """
+
+    OPERATORS = {
+        '==': operator.eq,
+        '!=': operator.ne,
+        '<': operator.lt,
+        '<=': operator.le,
+        '>': operator.gt,
+        '>=': operator.ge
+    }
+
+    def __init__(self, op, left, right):
+        """
+        Args:
+            op: The operator symbol (==, !=, <, <=, > or >=)
+            left: A column expression
+            right: A constant value or a column expression
+        """
+        self.op = op
+        self.fn = Comparison.OPERATORS[op]
+        self.left = left
+        self.right = right
+
+    def _value(self, value, evaluate):
+        return evaluate(value) if isinstance(value, Expression) else value
+
+    def evaluate(self, row):
+        return self.fn(self.left.evaluate(row), self._value(self.right, lambda e: e.evaluate(row)))
+
+    def evaluate_batch(self, batch):
+        return self.fn(self.left.evaluate_batch(batch), self._value(self.right, lambda e: e.evaluate_batch(batch)))
+
+    def columns(self):
+        return _union(self.left, self.right)
+
+    def __repr__(self):
+        return "({} {} {!r})".format(self.left, self.op, self.right)
+
+
+class IsIn(Expression):
+    """
+    Check if a column value is one of the given values
+    """
+
+    def __init__(self, column, values):
+        """
+        Args:
+            column: A column expression
+            values: A collection of values
+        """
+        self.column = column
+        self.values = list(values)
+        self._set = set(self.values)
+
+    def evaluate(self, row):
+        return self.column.evaluate(row) in self._set
+
+    def evaluate_batch(self, batch):
+        return np.isin(self.column.evaluate_batch(batch), self.values)
+
+    def columns(self):
+        return self.column.columns()
+
+    def __repr__(self):
+        return "{}.isin({!r})".format(self.column, self.values)
+
+
+class And(Expression):
+    """
+    Logical and of two expressions
+    """
+
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+
+    def evaluate(self, row):
+        return self.left.evaluate(row) and self.right.evaluate(row)
+
+    def evaluate_batch(self, batch):
+        return np.logical_and(self.left.evaluate_batch(batch), self.right.evaluate_batch(batch))
+
+    def columns(self):
+        return _union(self.left, self.right)
+
+    def conjuncts(self):
+        return self.left.conjuncts() + self.right.conjuncts()
+
+    def __repr__(self):
+        return "({!r} & {!r})".format(self.left, self.right)
+
+
+class Or(Expression):
+    """
+    Logical or of two expressions
+    """
+
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+
+    def evaluate(self, row):
+        return self.left.evaluate(row) or self.right.evaluate(row)
+
+    def evaluate_batch(self, batch):
+        return np.logical_or(self.left.evaluate_batch(batch), self.right.evaluate_batch(batch))
+
+    def columns(self):
+        return _union(self.left, self.right)
+
+    def __repr__(self):
+        return "({!r} | {!r})".format(self.left, self.right)
+
+
+class Not(Expression):
+    """
+    Logical negation of an expression
+    """
+
+    def __init__(self, expression):
+        self.expression = expression
+
+    def evaluate(self, row):
+        return not self.expression.evaluate(row)
+
+    def evaluate_batch(self, batch):
+        return np.logical_not(self.expression.evaluate_batch(batch))
+
+    def columns(self):
+        return self.expression.columns()
+
+    def __repr__(self):
+        return "~{!r}".format(self.expression)
+
+
+def conjunction(expressions):
+    """
+    Join a list of expressions with a logical and
+
+    Args:
+        expressions: A list of expressions
+
+    Returns:
+        An expression or None if the list is empty
+    """
+    result = None
+    for e in expressions:
+        result = e if result is None else And(result, e)
+    return result
+
+
+def split(expression, labels):
+    """
+    Split the conjuncts of an expression between the ones that only read the given sources and the others
+
+    Args:
+        expression: An expression
+        labels: A set of source labels
+
+    Returns:
+        A tuple like (expression_over_labels, rest_of_expression). Any of them can be None.
+    """
+    if expression is None:
+        return None, None
+
+    inside, outside = [], []
+    for c in expression.conjuncts():
+        (inside if c.sources() <= set(labels) else outside).append(c)
+    return conjunction(inside), conjunction(outside)
+
+
+def with_columns(columns, expression):
+    """
+    Add the columns that an expression reads to a columns of interest dictionary
+
+    Args:
+        columns: Columns of interest like {source_label: {column, ...}, ...} or None (all the columns)
+        expression: An expression
+
+    Returns:
+        A new columns of interest dictionary
+    """
+    if columns is None:
+        return None
+    return _union(expression, columns)
+
+
+def filter_batch(expression, batch):
+    """
+    Keep only the rows of a batch where the expression is true
+
+    Args:
+        expression: An expression
+        batch: A batch like {source_label: {column: array, ...}, ...}
+
+    Returns:
+        The filtered batch
+    """
+    mask = np.asarray(expression.evaluate_batch(batch), dtype=bool)
+    return {label: {c: v[mask] for c, v in values.items()} for label, values in batch.items()}
+
+
+def _union(*expressions):
+    columns = {}
+    for e in expressions:
+        if isinstance(e, Expression):
+            e = e.columns()
+        if isinstance(e, dict):
+            for label, names in e.items():
+                columns.setdefault(label, set()).update(names)
+    return columns
@@ -0,0 +1,308 @@
+#
+#   Copyright 2018 Jordi Deu-Pons
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may not use this
+#   file except in compliance with the License. You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software distributed under
+#   the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+#   ANY KIND, either express or implied. See the License for the specific language
+#   governing permissions and limitations under the License.
+#
+
+"""
+    Secondary indices of the sources columns. A secondary index maps each value of a column to the genomic
+    regions of the rows that have that value.
+
+    The indices are stored next to the data file, as binary sidecar files like '<data file>.<column>.gdi',
+    that are memory mapped when the sources are loaded. They are only rebuilt when the size or the modification
+    time of the data file change. The tabix indexed files are scanned in parallel by sequence.
+"""
+
+import logging
+import os
+
+import numpy as np
+import tabix
+from multiprocess import Pool
+
+from gendas.tabix.index import TabixIndex
+from gendas.tabix.reader import open_text
+from gendas.utils import _save_arrays, _load_arrays, _encode_strings, _decode_strings, _skip_comments
+from gendas.workers import _is_worker
+
+logger = logging.getLogger("gendas")
+
+# Increase it when the sidecar files format changes
+INDEX_VERSION = 1
+
+
+class ColumnIndex:
+    """
+    A read-only secondary index of a column
+    """
+
+    def __init__(self, path, arrays=None):
+        """
+        Args:
+            path: The sidecar file. None if the index is only in memory.
+            arrays: The index arrays. Defaults to None, map them from the sidecar file when needed.
+        """
+        self.path = path
+        self._arrays = arrays
+        self._keys = None
+        self._names = None
+        self._positions = None
+
+    def _load(self):
+        if self._arrays is None:
+            _, self._arrays = _load_arrays(self.path)
+        if self._keys is None:
+            self._keys = _decode_strings(self._arrays['keys'], self._arrays['keys_offsets'])
+            self._names = _decode_strings(self._arrays['names'], self._arrays['names_offsets'])
+        return self._arrays
+
+    def _segments(self, i):
+        arrays = self._load()
+        b, e = arrays['offsets'][i], arrays['offsets'][i + 1]
+        return [
+            (self._names[s], begin, end) for s, begin, end in zip(
+                arrays['sequence'][b:e].tolist(), arrays['begin'][b:e].tolist(), arrays['end'][b:e].tolist()
+            )
+        ]
+
+    def keys(self):
+        """
+        Returns: All the column values in order of first appearance at the data file
+        """
+        self._load()
+        return self._keys
+
+    def items(self):
+        """
+        Returns: A generator of tuples like (value, [(sequence, begin, end), ...]) in order of
+        first appearance at the data file
+        """
+        for i, key in enumerate(self.keys()):
+            yield key, self._segments(i)
+
+    def __getitem__(self, key):
+        if self._positions is None:
+            self._positions = {k: i for i, k in enumerate(self.keys())}
+        return self._segments(self._positions[key])
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_keys'] = None
+        state['_names'] = None
+        state['_positions'] = None
+
+        # Mapped arrays are mapped again when needed
+        if self.path is not None:
+            state['_arrays'] = None
+        return state
+
+
+def load_indices(filename, columns, sequence: int, begin: int, end: int, workers: int = None, scans=None):
+    """
+    Load the secondary indices of a data file, building the ones that are missing or stale.
+
+    Args:
+        filename: A tabulated data file, gzip or block-gzip compressed
+        columns: Index of the columns to index
+        sequence: Index of the sequence column
+        begin: Index of the begin column
+        end: Index of the end column
+        workers: Maximum number of processes to build the indices. Defaults to all the cores.
+        scans: The stale columns already scanned by the caller, as returned by 'scan_rows'. Defaults to None,
+            scan the data file if some index needs to be built.
+
+    Returns:
+        A dictionary with a ColumnIndex by column index
+    """
+    signature = _signature(filename, sequence, begin, end)
+
+    indices = {}
+    stale = []
+    for column in columns:
+        index = _fresh(filename, column, signature)
+        if index is None:
+            stale.append(column)
+        else:
+            indices[column] = index
+
+    if len(stale) == 0:
+        return indices
+
+    logger.info("building the indices of {}".format(filename))
+    if scans is None:
+        built = _build(filename, stale, sequence, begin, end, workers)
+    else:
+        built = _build_arrays(scans, stale)
+    for column, arrays in zip(stale, built):
+        path = _sidecar(filename, column)
+        try:
+            _save_arrays(path, dict(signature, column=column), arrays)
+        except OSError as e:
+            logger.warning("The index {} cannot be saved: {}".format(path, e))
+            path = None
+        indices[column] = ColumnIndex(path, arrays)
+
+    return indices
+
+
+def stale_indices(filename, columns, sequence: int, begin: int, end: int):
+    """
+    Args:
+        filename: A tabulated data file
+        columns: Index of the columns to index
+        sequence: Index of the sequence column
+        begin: Index of the begin column
+        end: Index of the end column
+
+    Returns:
+        The columns which index is missing or needs to be built again
+    """
+    signature = _signature(filename, sequence, begin, end)
+    return [column for column in columns if _fresh(filename, column, signature) is None]
+
+
+def scan_rows(rows, columns, sequence: int, begin: int, end: int):
+    """
+    Collect from some rows what is needed to build the indices of the given columns. It allows to build
+    the indices while the rows are read for other purposes.
+
+    Args:
+        rows: An iterable of rows as lists of strings
+        columns: Index of the columns to index
+        sequence: Index of the sequence column
+        begin: Index of the begin column
+        end: Index of the end column
+
+    Returns:
+        A list of scans to use at 'load_indices'
+    """
+    return [_scan(rows, columns, sequence, begin, end)]
+
+
+def _signature(filename, sequence, begin, end):
+    """
+    Returns: What an index depends on. An index is built again if the data file or the coordinates columns change.
+    """
+    stat = os.stat(filename)
+    return {
+        'version': INDEX_VERSION, 'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+        'coordinates': [sequence, begin, end]
+    }
+
+
+def _fresh(filename, column, signature):
+    """
+    Returns: The ColumnIndex of a column if its sidecar file is up to date, otherwise None
+    """
+    path = _sidecar(filename, column)
+    try:
+        meta, arrays = _load_arrays(path)
+        if meta == dict(signature, column=column):
+            return ColumnIndex(path, arrays)
+    except (OSError, ValueError, RuntimeError):
+        pass
+    return None
+
+
+def _sidecar(filename, column):
+    return "{}.{}.gdi".format(filename, column)
+
+
+def _build(filename, columns, sequence, begin, end, workers=None):
+    """
+    Scan a data file and build the index arrays of the given columns
+    """
+    indexfile = "{}.tbi".format(filename)
+    if os.path.exists(indexfile):
+        args = [(filename, name, columns, sequence, begin, end) for name in TabixIndex(indexfile).names]
+        processes = min(len(args), workers or os.cpu_count())
+        if processes > 1 and not _is_worker():
+            with Pool(processes) as pool:
+                scans = pool.map(_scan_sequence, args)
+        else:
+            scans = [_scan_sequence(a) for a in args]
+    else:
+        scans = [_scan_file(filename, columns, sequence, begin, end)]
+
+    return _build_arrays(scans, columns)
+
+
+def _build_arrays(scans, columns):
+    """
+    Build the index arrays of the given columns from the scanned rows
+    """
+
+    # Sequences ids in order of first appearance
+    names = {}
+    sequences = np.array([names.setdefault(s, len(names)) for scan in scans for s in scan[0]], dtype=np.int32)
+    begins = np.concatenate([scan[1] for scan in scans] + [np.array([], dtype=np.int64)])
+    ends = np.concatenate([scan[2] for scan in scans] + [np.array([], dtype=np.int64)])
+    names_data, names_offsets = _encode_strings(list(names.keys()))
+
+    for column in columns:
+        keys = {}
+        codes = np.array([keys.setdefault(v, len(keys)) for scan in scans for v in scan[3][column]], dtype=np.int64)
+
+        # Group the rows by value keeping the file order inside each group
+        order = np.argsort(codes, kind='stable')
+        offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(codes, minlength=len(keys)))
+        keys_data, keys_offsets = _encode_strings(list(keys.keys()))
+
+        yield {
+            'offsets': offsets,
+            'sequence': sequences[order],
+            'begin': begins[order],
+            'end': ends[order],
+            'keys': keys_data,
+            'keys_offsets': keys_offsets,
+            'names': names_data,
+            'names_offsets': names_offsets
+        }
+
+
+def _scan(rows, columns, sequence, begin, end):
+    """
+    Collect the coordinates and the values of the indexed columns of some rows
+
+    Returns:
+        A tuple like (sequences, begins, ends, {column: values})
+    """
+    sequences, begins, ends = [], [], []
+    values = {c: [] for c in columns}
+    for r in rows:
+        sequences.append(r[sequence])
+        begins.append(int(r[begin]))
+        ends.append(int(r[end]))
+        for c in columns:
+            values[c].append(r[c])
+    return sequences, np.array(begins, dtype=np.int64), np.array(ends, dtype=np.int64), values
+
+
+def _scan_sequence(args):
+    filename, name, columns, sequence, begin, end = args
+    return _scan(tabix.open(filename).querys(name), columns, sequence, begin, end)
+
+
+def _scan_file(filename, columns, sequence, begin, end):
+    with open_text(filename, threads=1 if _is_worker() else None) as fd:
+        rows = (line.rstrip('\n').split('\t') for line in _skip_comments(fd, '#'))
+        return _scan(rows, columns, sequence, begin, end)
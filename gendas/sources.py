@@ -16,23 +16,43 @@
 Module with all the available data sources
 """
 
+import atexit
 import csv
-import gzip
 import logging
+import os
+import struct
 import tabix
-from collections import OrderedDict
+import zlib
+from bisect import bisect_right
 from collections import defaultdict
+from functools import partial
+from itertools import islice
 
-from intervaltree import IntervalTree
-from gendas.utils import _skip_partitions, _skip_comments
+import numpy as np
+from intervaltree import IntervalTree, Interval
+from multiprocess import Pool
+from gendas import workers
+from gendas.indices import load_indices, stale_indices, scan_rows
+from gendas.tabix.constants import BLOCK_HEADER_LENGTH, BLOCK_LENGTH_OFFSET
+from gendas.tabix.index import TabixIndex
+from gendas.tabix.reader import TabixFile, open_text
+from gendas.utils import _skip_partitions, _skip_comments, _get_chunks, _column, _rows_to_batches, _coalesce, \
+    _save_arrays, _load_arrays, _shared_path
 
 logger = logging.getLogger("gendas")
 
+# Default number of rows of each column batch
+BATCH_SIZE = 10000
+
 
 class GendasSource:
     """
     Abstract class to define the source interface
     """
+
+    # Cost of a random access query measured in rows read sequentially
+    QUERY_COST = 1
+
     def __init__(self, sequence=None, begin=None, end=None, header=None, ctypes=None):
         """
         Initialize a source
@@ -45,12 +65,21 @@ class GendasSource:
             ctypes: List of column data types
         """
         self.label = None
+        self.uid = None
+        self.block_cache = None
+        self.region_cache = None
         self.sequence = sequence
         self.begin = begin
         self.end = end
         self.header = header
         self.ctypes = ctypes
 
+    def __reduce_ex__(self, protocol):
+        # Sources already loaded at the workers are serialized as a reference
+        if workers.shared(self.uid):
+            return workers._shared_source, (self.uid,)
+        return super().__reduce_ex__(protocol)
+
     def index(self, label: str):
         """
         An iterable over all the possible values of an indexed column and a list of genomic regions that contain
@@ -65,7 +94,7 @@ class GendasSource:
         """
         raise NotImplementedError()
 
-    def query(self, sequence, begin, end):
+    def query(self, sequence, begin, end, columns=None):
         """
         Returns a generator that iterates all the rows in a 'sequence' from 'begin' to
         'end' (both included). Each row it's a dictionary following this format:
@@ -75,9 +104,67 @@ class GendasSource:
             sequence: Sequence identifier
             begin: Start position in the sequence
             end: End position in the sequence
+            columns: Columns of interest. The sequence, begin and end columns are always included.
+                Sources can ignore it and return all the columns. Defaults to None, all the columns.
         """
         raise NotImplementedError()
 
+    def query_many(self, regions, columns=None):
+        """
+        Rows of several regions at once. The regions are sorted and the ones that overlap or that are
+        close enough are read with only one query, then the rows are assigned back to each region.
+
+        Args:
+            regions: A list of tuples like (sequence, begin, end) with the same positions than 'query'
+            columns: Columns of interest (see 'query')
+
+        Returns:
+            A list with the rows of each region, in the same order than the regions
+        """
+        results = [[] for _ in regions]
+
+        # Skip the regions of empty queries
+        valid = [i for i, (_, begin, end) in enumerate(regions) if self._covered(begin, end) is not None]
+
+        for sequence, begin, end, members in _coalesce([regions[i] for i in valid], self._mergeable):
+            members = [valid[k] for k in members]
+            rows = self.query(sequence, begin, end, columns=columns)
+            if len(members) == 1:
+                results[members[0]] = list(rows)
+                continue
+
+            # Sweep the rows, sorted by begin, keeping the regions that can still overlap them
+            bounds = [self._covered(regions[i][1], regions[i][2]) for i in members]
+            firsts = [b for b, _ in bounds]
+            added, active = 0, []
+            for row in rows:
+                r_begin, r_end = row[self.begin], row[self.end]
+                last = bisect_right(firsts, r_end)
+                if last > added:
+                    active.extend(range(added, last))
+                    added = last
+                active = [k for k in active if bounds[k][1] >= r_begin]
+                for k in active:
+                    if bounds[k][0] <= r_end:
+                        results[members[k]].append(row)
+
+        return results
+
+    def _covered(self, begin, end):
+        """
+        The inverse of 'region'. Closed interval of row coordinates that a query covers, or None if the query
+        is always empty.
+        """
+        return begin, end
+
+    def _mergeable(self, sequence, end, begin):
+        """
+        Returns: True if a query region that ends at 'end' and the next one that starts at 'begin' are cheaper
+        to read with only one query, because there are less rows between them than the cost of a query
+        """
+        rows = self.estimate(sequence, end, begin)
+        return rows is not None and rows <= self.QUERY_COST
+
     def intersect(self, sequence, begin, end):
         """
         Get all the available intervals that contains some data in a given region
@@ -92,15 +179,144 @@ class GendasSource:
         """
         raise NotImplementedError()
 
-    def __iter__(self, p=None):
+    def blocks(self, sequence, begin, end):
+        """
+        Estimate how many storage blocks need to be read to query a region. The engine uses it to choose
+        between one query per row or a single sequential pass when merging.
+
+        Args:
+            sequence: Sequence identifier
+            begin: Start position in the sequence
+            end: End position in the sequence
+
+        Returns:
+            Estimated number of blocks or None if random access queries have no significant cost
+        """
+        return None
+
+    def nbytes(self, sequence, begin, end):
+        """
+        Estimate how many bytes need to be read to query a region
+
+        Args:
+            sequence: Sequence identifier
+            begin: Start position in the sequence
+            end: End position in the sequence
+
+        Returns:
+            Estimated number of bytes or None if it is unknown
+        """
+        return None
+
+    def statistics(self):
+        """
+        Cheap statistics of the source that the engine uses to plan the merges
+
+        Returns:
+            A dictionary like {sequence: (rows, begin, end), ...} with the estimated number of rows and the
+            covered span of each sequence, or None if they are unknown
+        """
+        return None
+
+    def width(self):
+        """
+        Returns: Estimated average length of the rows regions or None if it is unknown
+        """
+        return None
+
+    def estimate(self, sequence, begin, end):
+        """
+        Estimate how many rows overlap a region, assuming that the rows of a sequence
+        are uniformly distributed along its span.
+
+        Args:
+            sequence: Sequence identifier
+            begin: Start position in the sequence
+            end: End position in the sequence
+
+        Returns:
+            Estimated number of rows or None if it is unknown
+        """
+        statistics = self.statistics()
+        if statistics is None:
+            return None
+
+        if sequence not in statistics:
+            return 0
+
+        rows, s_begin, s_end = statistics[sequence]
+        overlap = min(end, s_end) - max(begin, s_begin)
+        return 0 if overlap <= 0 else rows * overlap / max(1, s_end - s_begin)
+
+    def region(self, begin, end):
+        """
+        Query arguments to get the rows that overlap a closed interval of row coordinates. A row overlaps
+        it when its begin value is lower or equal than 'end' and its end value is greater or equal than 'begin'.
+
+        Args:
+            begin: First position of the interval
+            end: Last position of the interval
+
+        Returns:
+            A tuple like (begin, end) to use at 'query'
+        """
+        return begin, end
+
+    def __iter__(self, p=None, columns=None):
         """
         Iterate the whole data source
 
         Args:
             p:
+            columns: Columns of interest (see 'query')
         """
         raise NotImplementedError()
 
+    def _fields(self, columns=None):
+        """
+        Fields to parse when only some columns are of interest
+
+        Args:
+            columns: Columns of interest or None for all of them
+
+        Returns:
+            A list of tuples like (column_index, header, ctype) in the header order
+        """
+        if columns is None:
+            return list(zip(range(len(self.header)), self.header, self.ctypes))
+
+        selected = set(columns) | {self.sequence, self.begin, self.end}
+        return [(i, h, c) for i, (h, c) in enumerate(zip(self.header, self.ctypes)) if h in selected]
+
+    def query_batches(self, sequence, begin, end, batch_size=BATCH_SIZE, columns=None):
+        """
+        Same rows than 'query' but grouped in column batches. Each batch is a dictionary
+        with a NumPy array for each column: { 'field_01_key': array([...]), ... }
+
+        Args:
+            sequence: Sequence identifier
+            begin: Start position in the sequence
+            end: End position in the sequence
+            batch_size: Maximum number of rows at each batch
+            columns: Columns of interest
+        """
+        fields = self._fields(columns)
+        return _rows_to_batches(self.query(sequence, begin, end, columns=columns),
+                                [h for _, h, _ in fields], [c for _, _, c in fields], batch_size)
+
+    def iter_batches(self, batch_size=BATCH_SIZE, p=None, columns=None):
+        """
+        Iterate the whole data source in column batches
+
+        Args:
+            batch_size: Maximum number of rows at each batch
+            p: Partition
+            columns: Columns of interest
+        """
+        fields = self._fields(columns)
+        return _rows_to_batches(self.__iter__(p=p, columns=columns),
+                                [h for _, h, _ in fields], [c for _, _, c in fields], batch_size)
+
     def __len__(self):
         """
         Returns: Total number of rows in the dataset
@@ -116,7 +332,15 @@ class TabixSource(GendasSource):
     In a way that, given a region, you only need to decompress the blocks that contain that region to access
     them.
     """
-    def __init__(self, filename, sequence=None, begin=None, end=None, header=None, ctypes=None, indices=None):
+
+    # A random access query decompresses at least one whole block (up to 64 KiB), a few hundred rows
+    QUERY_COST = 300
+
+    # Available readers. 'pytabix' is the C extension and 'gendas' the pure python reader at gendas.tabix
+    BACKENDS = ('pytabix', 'gendas')
+
+    def __init__(self, filename, sequence=None, begin=None, end=None, header=None, ctypes=None, indices=None,
+                 backend='pytabix'):
         """
         Initialize a tabix source
 
@@ -128,44 +352,161 @@ class TabixSource(GendasSource):
             header: Ordered list with all the column headers
             ctypes: Ordered list with all the column data types
             indices: List with all the columns that we want to create an index
+            backend: The tabix reader, 'pytabix' or 'gendas'. Defaults to 'pytabix'.
         """
+        if backend not in TabixSource.BACKENDS:
+            raise ValueError("Unknown tabix backend '{}'".format(backend))
+
         super().__init__(sequence=sequence, begin=begin, end=end, header=header, ctypes=ctypes)
 
         self.sequence_idx = self._idx(sequence)
         self.begin_idx = self._idx(begin)
         self.end_idx = self._idx(end)
         self.tb = None
+        self.tbi = None
+        self.tiles = None
+        self.stats = None
+        self.sample = None
         self.filename = filename
+        self.backend = backend
 
-        self.indices = {} if indices is None else {self._idx(i): OrderedDict() for i in indices}
-        if len(self.indices) > 0:
-            with gzip.open(filename, 'rt') as fd:
-                reader = csv.reader(fd, delimiter='\t')
-                for row in reader:
-                    for i in self.indices.keys():
-                        if row[i] not in self.indices[i]:
-                            self.indices[i][row[i]] = []
-                        self.indices[i][row[i]].append(
-                            (row[self.sequence_idx], int(row[self.begin_idx]), int(row[self.end_idx])))
+        self.indices = {} if indices is None else load_indices(
+            filename, [self._idx(i) for i in indices], self.sequence_idx, self.begin_idx, self.end_idx
+        )
 
     def index(self, label: str):
         return self.indices[self._idx(label)].items()
 
+    def _index(self):
+        """
+        Returns: The tabix index of this file or None if the file is not indexed
+        """
+        if self.tbi is None:
+            indexfile = "{}.tbi".format(self.filename)
+            if os.path.exists(indexfile):
+                self.tbi = TabixIndex(indexfile, cache=True)
+
+        return self.tbi
+
+    def _tiles(self, p):
+        """
+        Genomic tiles of a partition. The tiles are computed from the tabix index to have a similar
+        amount of compressed bytes at each partition.
+
+        Args:
+            p: Partition as a tuple like (partition, total_partitions)
+
+        Returns:
+            A list of (sequence, begin, end) tiles or None if the file is not indexed
+        """
+        if self.tiles is None or self.tiles[0] != p[1]:
+            index = self._index()
+            if index is None:
+                return None
+            self.tiles = (p[1], index.tiles(p[1], size=os.path.getsize(self.filename)))
+
+        return self.tiles[1][p[0]]
+
+    def blocks(self, sequence, begin, end):
+        index = self._index()
+        if index is None:
+            return None
+        return index.blocks(sequence, max(0, begin - 1), end)
+
+    def region(self, begin, end):
+        # The begin column of UCSC like files is zero-based, so their rows overlap one position less
+        index = self._index()
+        if index is not None and index.zero_based:
+            return begin, end + 1
+        return begin, end
+
+    def _covered(self, begin, end):
+        index = self._index()
+        if index is not None and index.zero_based:
+            return begin, end - 1
+        return begin, end
+
+    def nbytes(self, sequence, begin, end):
+        index = self._index()
+        if index is None:
+            return None
+        return index.nbytes(sequence, max(0, begin - 1), end)
+
+    def statistics(self):
+        if self.stats is None:
+            index = self._index()
+            if index is None:
+                return None
+
+            stats = {}
+            for sequence, (nbytes, begin, end) in index.sequences(size=os.path.getsize(self.filename)).items():
+                rows = index.mapped(sequence)
+                if rows is None:
+                    rows = nbytes * self._sample()[0]
+                stats[sequence] = (rows, begin, end)
+            self.stats = stats
+
+        return self.stats
+
+    def width(self):
+        return self._sample()[1]
+
+    def _sample(self):
+        """
+        Parse the first compressed block of the file.
+
+        Returns:
+            A tuple like (rows_per_compressed_byte, average_width)
+        """
+        if self.sample is None:
+            with open(self.filename, 'rb') as fd:
+                header = fd.read(BLOCK_HEADER_LENGTH)
+                size = struct.unpack('<H', header[BLOCK_LENGTH_OFFSET:BLOCK_LENGTH_OFFSET + 2])[0] + 1
+                data = zlib.decompress(header + fd.read(size - BLOCK_HEADER_LENGTH), 31)
+
+            # The last line can be incomplete
+            widths = []
+            for line in data.decode().split('\n')[:-1]:
+                r = line.split('\t')
+                try:
+                    widths.append(int(r[self.end_idx]) - int(r[self.begin_idx]) + 1)
+                except (IndexError, ValueError):
+                    # Comments and header lines
+                    continue
+
+            self.sample = (
+                len(widths) / size,
+                sum(widths) / len(widths) if len(widths) > 0 else None
+            )
+
+        return self.sample
+
     def _tabix(self):
         try:
             if self.tb is None:
-                self.tb = tabix.open(self.filename)
-        except tabix.TabixError:
+                if self.backend == 'gendas':
+                    self.tb = TabixFile(self.filename, index=self._index(), mmap=True, cache=self.block_cache)
+                else:
+                    self.tb = tabix.open(self.filename)
+        except (tabix.TabixError, IOError, RuntimeError):
             msg = "Error opening tabix file {}".format(self.filename)
             logger.error(msg)
             raise RuntimeError(msg)
 
         return self.tb
 
-    def query(self, sequence, begin, end):
+    def query(self, sequence, begin, end, columns=None):
+        fields = self._fields(columns)
+        if self.backend == 'gendas':
+            # Only the text columns are decoded
+            fields = [(i, h, _from_bytes(c)) for i, h, c in fields]
+            for row in self._tabix().query_bytes(sequence, begin, end):
+                yield {h: c(row[i]) for i, h, c in fields}
+            return
+
         try:
             for row in self._tabix().query(sequence, begin, end):
-                yield {h: c(v) for c, v, h in zip(self.ctypes, row, self.header)}
+                yield {h: c(row[i]) for i, h, c in fields}
         except tabix.TabixError:
             logger.error("Fail tabix query {}:{}-{} at {}".format(sequence, begin, end, self.filename))
 
@@ -179,8 +520,16 @@ class TabixSource(GendasSource):
 
         return self.header.index(label)
 
-    def __iter__(self, p=None):
-        with gzip.open(self.filename, 'rt') as fd:
+    def __iter__(self, p=None, columns=None):
+        tiles = None if p is None else self._tiles(p)
+        if tiles is not None:
+            for r in self._iter_tiles(tiles, columns):
+                yield r
+            return
+
+        fields = self._fields(columns)
+        splits = max(i for i, _, _ in fields) + 1
+        with _open_text(self.filename) as fd:
 
             if p is None:
                 it = fd
@@ -190,14 +539,104 @@ class TabixSource(GendasSource):
             # Skip comments
             it = _skip_comments(it, '#')
 
-            reader = csv.reader(it, delimiter='\t')
-            for r in reader:
-                yield {h: c(v) for c, v, h in zip(self.ctypes, r, self.header)}
+            for line in it:
+                line = line.rstrip('\n')
+                if line == '':
+                    continue
+                r = line.split('\t', splits)
+                if len(r) < splits:
+                    # Short rows only have the fields that they contain
+                    yield {h: c(r[i]) for i, h, c in fields if i < len(r)}
+                    continue
+                yield {h: c(r[i]) for i, h, c in fields}
+
+    def _iter_tiles(self, tiles, columns=None):
+        """
+        Iterate only the blocks that contain the given tiles. A row that overlaps more than one tile is
+        only returned by the tile that contains its begin position.
+
+        Args:
+            tiles: A list of (sequence, begin, end) tiles with zero-based positions
+            columns: Columns to parse
+        """
+        fields = self._fields(columns)
+        shift = 0 if self._index().zero_based else 1
+        for sequence, begin, end in tiles:
+            for row in self._tabix().query(sequence, begin + 1, end):
+                if begin <= int(row[self.begin_idx]) - shift < end:
+                    yield {h: c(row[i]) for i, h, c in fields}
+
+    def _batch(self, fields, columns):
+        """
+        Parse a column batch
+
+        Args:
+            fields: The fields to parse
+            columns: A list with the text values of each field
+        """
+        return {h: _column(v, c, parse=True) for (_, h, c), v in zip(fields, columns)}
+
+    def query_batches(self, sequence, begin, end, batch_size=BATCH_SIZE, columns=None):
+        fields = self._fields(columns)
+        # The numbers are parsed from the bytes, only the other columns are decoded
+        decode = [c not in (int, float) for _, _, c in fields] if self.backend == 'gendas' else None
+        try:
+            if decode is None:
+                rows = self._tabix().query(sequence, begin, end)
+            else:
+                rows = self._tabix().query_bytes(sequence, begin, end)
+            for chunk in _get_chunks(rows, size=batch_size):
+                if len(chunk) > 0:
+                    columns = [[row[i] for row in chunk] for i, _, _ in fields]
+                    if decode is not None:
+                        columns = [[v.decode("utf-8") for v in c] if d else c for d, c in zip(decode, columns)]
+                    yield self._batch(fields, columns)
+        except tabix.TabixError:
+            logger.error("Fail tabix query {}:{}-{} at {}".format(sequence, begin, end, self.filename))
+
+    def iter_batches(self, batch_size=BATCH_SIZE, p=None, columns=None):
+        tiles = None if p is None else self._tiles(p)
+        if tiles is not None:
+            shift = 0 if self._index().zero_based else 1
+            for sequence, begin, end in tiles:
+                for batch in self.query_batches(sequence, begin + 1, end, batch_size=batch_size, columns=columns):
+                    position = batch[self.header[self.begin_idx]] - shift
+                    owned = (position >= begin) & (position < end)
+                    yield batch if owned.all() else {h: v[owned] for h, v in batch.items()}
+            return
+
+        if p is not None:
+            for batch in super().iter_batches(batch_size=batch_size, p=p, columns=columns):
+                yield batch
+            return
+
+        fields = self._fields(columns)
+        size = len(self.header)
+        with _open_text(self.filename) as fd:
+            for chunk in _get_chunks(_skip_comments(fd, '#'), size=batch_size):
+                if len(chunk) == 0:
+                    continue
+
+                # Split all the lines at once when all of them have the expected number of columns
+                values = "".join(chunk).replace('\n', '\t').split('\t')
+                if values[-1] == '':
+                    values.pop()
+                if len(values) == size * len(chunk):
+                    columns = [values[i::size] for i, _, _ in fields]
+                else:
+                    # Skip blank lines and pad the short rows with empty values
+                    rows = [line.rstrip('\n').split('\t') for line in chunk if line.rstrip('\n') != '']
+                    if len(rows) == 0:
+                        continue
+                    rows = [r if len(r) >= size else r + [''] * (size - len(r)) for r in rows]
+                    columns = [[r[i] for r in rows] for i, _, _ in fields]
+
+                yield self._batch(fields, columns)
 
     def __getstate__(self):
         state = dict(self.__dict__)
         state['tb'] = None
-        state['indices'] = {}
+        state['tbi'] = None
         return state
 
 
@@ -208,7 +647,8 @@ class IntervalTreeSource(GendasSource):
     The current implementation only supports simple tabulated text files, but more standard formats like
     VCF and MAF files will be added later.
     """
-    def __init__(self, filename, sequence=None, begin=None, end=None, header=None, ctypes=None, indices=None):
+    def __init__(self, filename, sequence=None, begin=None, end=None, header=None, ctypes=None, indices=None,
+                 processes: int = 1):
         """
         Initialize a regions source dataset
 
@@ -220,6 +660,8 @@ class IntervalTreeSource(GendasSource):
             header: Ordered list with all the column headers
             ctypes: Ordered list with all the column data types
             indices: List with all the columns that we want to create an index
+            processes: Number of processes to build the trees of the sequences in parallel. It is only used
+                when the data file has a tabix index. Defaults to 1.
         """
         super().__init__(sequence=sequence, begin=begin, end=end, header=header, ctypes=ctypes)
 
@@ -229,51 +671,346 @@ class IntervalTreeSource(GendasSource):
         self.tb = None
         self.filename = filename
 
-        self.indices = {} if indices is None else {self._idx(i): OrderedDict() for i in indices}
-        if len(self.indices) > 0:
-            with gzip.open(filename, 'rt') as fd:
-                reader = csv.reader(fd, delimiter='\t')
-                for row in reader:
-                    for i in self.indices.keys():
-                        if row[i] not in self.indices[i]:
-                            self.indices[i][row[i]] = []
-                        self.indices[i][row[i]].append(
-                            (row[self.sequence_idx], int(row[self.begin_idx]), int(row[self.end_idx])))
+        # The trees and the missing indices are built reading the file only once
+        columns = [] if indices is None else [self._idx(i) for i in indices]
+        stale = stale_indices(filename, columns, self.sequence_idx, self.begin_idx, self.end_idx)
+
+        indexfile = "{}.tbi".format(filename)
+        if processes > 1 and os.path.exists(indexfile) and not workers._is_worker():
+            args = [(self, name, stale) for name in TabixIndex(indexfile).names]
+            with Pool(min(processes, len(args))) as pool:
+                loaded = pool.map(_sequence_trees, args)
+        else:
+            with _open_text(filename) as fd:
+                loaded = [self._build_trees(csv.reader(fd, delimiter='\t'), stale)]
 
         self._trees = defaultdict(IntervalTree)
-        with gzip.open(filename, 'rt') as fd:
-            reader = csv.reader(fd, delimiter='\t')
-            for r in reader:
-                self._trees[r[self.sequence_idx]][int(r[self.begin_idx]):int(r[self.end_idx]) + 1] = \
+        scans = []
+        for trees, scan in loaded:
+            self._trees.update(trees)
+            scans.extend(scan)
+
+        self.indices = {} if indices is None else load_indices(
+            filename, columns, self.sequence_idx, self.begin_idx, self.end_idx, scans=scans
+        )
+
+    def _build_trees(self, rows, columns):
+        """
+        Build the interval trees of some rows and scan them to build the indices of the given columns
+
+        Args:
+            rows: An iterable of rows as lists of strings
+            columns: Columns to index
+
+        Returns:
+            A tuple like (trees, scans) with a dictionary of trees by sequence and the scans for 'load_indices'
+        """
+        intervals = defaultdict(list)
+
+        def parse():
+            for r in rows:
+                intervals[r[self.sequence_idx]].append(Interval(
+                    int(r[self.begin_idx]), int(r[self.end_idx]) + 1,
                     {h: c(v) for c, v, h in zip(self.ctypes, r, self.header)}
+                ))
+                yield r
+
+        if len(columns) > 0:
+            scans = scan_rows(parse(), columns, self.sequence_idx, self.begin_idx, self.end_idx)
+        else:
+            scans = []
+            for _ in parse():
+                pass
+
+        # Building each tree at once is faster than adding the intervals one by one
+        return {name: IntervalTree(values) for name, values in intervals.items()}, scans
 
     def index(self, label: str):
         return self.indices[self._idx(label)].items()
 
-    def query(self, sequence, begin, end):
-        for row in self._trees[sequence][begin:end]:
+    def query(self, sequence, begin, end, columns=None):
+        for row in sorted(self._trees[sequence][begin:end], key=lambda iv: (iv.begin, iv.end)):
             yield row.data
 
     def intersect(self, sequence, begin, end):
         for row in self._trees[sequence][begin:end]:
             yield sequence, row.begin, row.end + 1
 
+    def statistics(self):
+        return {
+            sequence: (len(tree), tree.begin(), tree.end())
+            for sequence, tree in self._trees.items() if len(tree) > 0
+        }
+
+    def width(self):
+        widths = [iv.end - iv.begin for tree in self._trees.values() for iv in islice(tree, 1000)][:1000]
+        return sum(widths) / len(widths) if len(widths) > 0 else None
+
+    def region(self, begin, end):
+        return begin, end + 1
+
+    def _covered(self, begin, end):
+        return None if begin >= end else (begin, end - 1)
+
     def _idx(self, label):
         if type(label) == int:
             return label
 
         return self.header.index(label)
 
-    def __iter__(self, p=None):
-        with gzip.open(self.filename, 'rt') as fd:
-            reader = csv.reader(fd, delimiter='\t')
+    def __iter__(self, p=None, columns=None):
+        with _open_text(self.filename) as fd:
+            it = fd if p is None else _skip_partitions(fd, p)
+            reader = csv.reader(it, delimiter='\t')
             for r in reader:
                 yield {h: c(v) for c, v, h in zip(self.ctypes, r, self.header)}
 
 
+class ArraySource(GendasSource):
+    """
+    Source that loads a genomic regions data file all in memory as typed NumPy arrays.
+
+    The rows of each sequence are sorted by begin position together with the running maximum of the
+    end positions, so a query only needs two binary searches. It answers the same queries than the
+    IntervalTreeSource using much less memory.
+
+    When the source is sent to the workers, the arrays are written once to a shared memory file that
+    all the processes map read-only, instead of having a copy at each worker.
+    """
+
+    def __init__(self, filename, sequence=None, begin=None, end=None, header=None, ctypes=None, indices=None,
+                 shared=True):
+        """
+        Initialize an arrays source dataset
+
+        Args:
+            filename: Path to a gzip compressed tabulated text file
+            sequence: Header that identifies the sequence column
+            begin: Header that identifies the begin column
+            end: Header that identifies the end column
+            header: Ordered list with all the column headers
+            ctypes: Ordered list with all the column data types
+            indices: List with all the columns that we want to create an index
+            shared: True to share the arrays with the workers through shared memory. Disable it when the
+                workers run at other hosts.
+        """
+        super().__init__(sequence=sequence, begin=begin, end=end, header=header, ctypes=ctypes)
+
+        self.sequence_idx = self._idx(sequence)
+        self.begin_idx = self._idx(begin)
+        self.end_idx = self._idx(end)
+        self.filename = filename
+        self.shared = shared
+        self._shared_path = None
+
+        self.indices = {} if indices is None else load_indices(
+            filename, [self._idx(i) for i in indices], self.sequence_idx, self.begin_idx, self.end_idx
+        )
+
+        self._arrays = self._load()
+
+    def _load(self):
+        """
+        Parse the data file in column batches and split the columns by sequence
+
+        Returns:
+            A dictionary like {sequence: {column: array, ...}, ...} with the rows sorted by begin and
+            an extra 'maxend' array with the running maximum of the end column
+        """
+        size = len(self.header)
+        batches = []
+        with _open_text(self.filename) as fd:
+            for chunk in _get_chunks(_skip_comments(fd, '#'), size=BATCH_SIZE):
+                if len(chunk) == 0:
+                    continue
+                values = "".join(chunk).replace('\n', '\t').split('\t')
+                if values[-1] == '':
+                    values.pop()
+                if len(values) != size * len(chunk):
+                    # Skip blank lines and pad the short rows with empty values
+                    rows = [line.rstrip('\n').split('\t') for line in chunk if line.rstrip('\n') != '']
+                    if len(rows) == 0:
+                        continue
+                    values = [v for r in rows for v in (r + [''] * (size - len(r)))[:size]]
+                batches.append([_column(values[i::size], c, parse=True) for i, c in enumerate(self.ctypes)])
+
+        if len(batches) == 0:
+            return {}
+
+        columns = [np.concatenate([b[i] for b in batches]) for i in range(size)]
+        sequences = columns[self.sequence_idx]
+
+        arrays = {}
+        for name in dict.fromkeys(sequences.tolist()):
+            rows = np.flatnonzero(sequences == name)
+            rows = rows[np.lexsort((columns[self.end_idx][rows], columns[self.begin_idx][rows]))]
+            arrays[name] = {h: c[rows] for h, c in zip(self.header, columns)}
+            arrays[name]['maxend'] = np.maximum.accumulate(arrays[name][self.end])
+        return arrays
+
+    def _share(self):
+        """
+        Move the arrays to a shared memory file and map them from there
+
+        Returns:
+            The shared file path or None if the arrays cannot be shared
+        """
+        if self._shared_path is None:
+            if any(a.dtype.hasobject for arrays in self._arrays.values() for a in arrays.values()):
+                return None
+
+            names = list(self._arrays.keys())
+            flat = {
+                "{}/{}".format(i, column): array
+                for i, arrays in enumerate(self._arrays.values()) for column, array in arrays.items()
+            }
+            path = _shared_path('gendas-{}-'.format(self.label or 'array'))
+            _save_arrays(path, {'sequences': names}, flat)
+            atexit.register(_remove, path)
+
+            self._shared_path = path
+            self._arrays = _map_arrays(path)
+
+        return self._shared_path
+
+    def __getstate__(self):
+        shared = self.shared and self._share() is not None
+        state = dict(self.__dict__)
+        if shared:
+            state['_arrays'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._arrays is None:
+            self._arrays = _map_arrays(self._shared_path)
+
+    def index(self, label: str):
+        return self.indices[self._idx(label)].items()
+
+    def _selection(self, sequence, begin, end):
+        """
+        Rows that overlap a region
+
+        Returns:
+            A tuple like (arrays, selection) where selection is a slice or an array of row positions.
+            The arrays are None if there are no rows.
+        """
+        arrays = self._arrays.get(sequence)
+        if arrays is None or begin >= end:
+            return None, None
+
+        # Rows with a begin lower than 'end' and an end greater or equal than 'begin'
+        first = np.searchsorted(arrays['maxend'], begin, side='left')
+        last = np.searchsorted(arrays[self.begin], end, side='left')
+        if first >= last:
+            return None, None
+
+        mask = arrays[self.end][first:last] >= begin
+        return arrays, slice(first, last) if mask.all() else np.flatnonzero(mask) + first
+
+    def _dicts(self, arrays, selection, columns=None):
+        headers = [h for _, h, _ in self._fields(columns)]
+        values = [arrays[h][selection].tolist() for h in headers]
+        return [dict(zip(headers, row)) for row in zip(*values)]
+
+    def query(self, sequence, begin, end, columns=None):
+        arrays, selection = self._selection(sequence, begin, end)
+        if arrays is None:
+            return iter([])
+        return iter(self._dicts(arrays, selection, columns))
+
+    def query_many(self, regions, columns=None):
+        results = [[] for _ in regions]
+
+        # Binary search all the regions of each sequence at once
+        by_sequence = defaultdict(list)
+        for i, (sequence, _, _) in enumerate(regions):
+            by_sequence[sequence].append(i)
+
+        for sequence, members in by_sequence.items():
+            arrays = self._arrays.get(sequence)
+            if arrays is None:
+                continue
+
+            begins = np.array([regions[i][1] for i in members])
+            ends = np.array([regions[i][2] for i in members])
+            firsts = np.searchsorted(arrays['maxend'], begins, side='left')
+            lasts = np.searchsorted(arrays[self.begin], ends, side='left')
+            for i, b, e, first, last in zip(members, begins.tolist(), ends.tolist(), firsts.tolist(), lasts.tolist()):
+                if b >= e or first >= last:
+                    continue
+                selection = np.flatnonzero(arrays[self.end][first:last] >= b) + first
+                results[i] = self._dicts(arrays, selection, columns)
+
+        return results
+
+    def query_batches(self, sequence, begin, end, batch_size=BATCH_SIZE, columns=None):
+        arrays, selection = self._selection(sequence, begin, end)
+        if arrays is None:
+            return
+
+        headers = [h for _, h, _ in self._fields(columns)]
+        selected = {h: arrays[h][selection] for h in headers}
+        total = len(selected[self.begin])
+        for i in range(0, total, batch_size):
+            yield {h: v[i:i + batch_size] for h, v in selected.items()}
+
+    def intersect(self, sequence, begin, end):
+        arrays, selection = self._selection(sequence, begin, end)
+        if arrays is None:
+            return
+        for b, e in zip(arrays[self.begin][selection].tolist(), arrays[self.end][selection].tolist()):
+            yield sequence, b, e + 1
+
+    def statistics(self):
+        return {
+            sequence: (len(arrays[self.begin]), int(arrays[self.begin][0]), int(arrays['maxend'][-1]) + 1)
+            for sequence, arrays in self._arrays.items()
+        }
+
+    def width(self):
+        widths = [
+            (arrays[self.end][:1000] + 1 - arrays[self.begin][:1000]) for arrays in self._arrays.values()
+        ]
+        widths = np.concatenate(widths)[:1000] if len(widths) > 0 else []
+        return float(np.mean(widths)) if len(widths) > 0 else None
+
+    def region(self, begin, end):
+        return begin, end + 1
+
+    def _covered(self, begin, end):
+        return None if begin >= end else (begin, end - 1)
+
+    def _idx(self, label):
+        if type(label) == int:
+            return label
+
+        return self.header.index(label)
+
+    def iter_batches(self, batch_size=BATCH_SIZE, p=None, columns=None):
+        headers = [h for _, h, _ in self._fields(columns)]
+        for arrays in self._arrays.values():
+            selected = {h: arrays[h] if p is None else arrays[h][p[0]::p[1]] for h in headers}
+            total = len(selected[self.begin])
+            for i in range(0, total, batch_size):
+                yield {h: v[i:i + batch_size] for h, v in selected.items()}
+
+    def __iter__(self, p=None, columns=None):
+        for batch in self.iter_batches(p=p, columns=columns):
+            yield from _batch_dicts(batch)
+
+    def __len__(self):
+        return sum(len(arrays[self.begin]) for arrays in self._arrays.values())
+
+
 class PandasSource(GendasSource):
     """
-    A data source that queries a Pandas dataframe loaded in memory
+    A data source that queries a Pandas dataframe loaded in memory.
+
+    The rows of each sequence are indexed by their position at the dataframe, sorted by begin position
+    together with the running maximum of the end positions, like at the ArraySource. The values are read
+    from NumPy views of the dataframe columns, the dataframe is not copied.
     """
     def __init__(self, df, sequence=None, begin=None, end=None):
         """
@@ -285,19 +1022,200 @@ class PandasSource(GendasSource):
         """
         super().__init__(sequence=sequence, begin=begin, end=end, header=df.columns.tolist(), ctypes=df.dtypes.tolist())
         self.df = df
+        self._columns = None
+        self._positions = self._build()
+
+    def _views(self):
+        """
+        Returns: A dictionary with a NumPy array of each column, a view of the dataframe data when possible
+        """
+        if self._columns is None:
+            self._columns = {h: self.df[h].to_numpy() for h in self.header}
+        return self._columns
+
+    def _build(self):
+        """
+        Build the positional index
+
+        Returns:
+            A dictionary like {sequence: {'rows': positions, begin: array, end: array, 'maxend': array}, ...}
+            with the rows sorted by begin position. Empty if the dataframe has no genomic coordinates.
+        """
+        if not self._located() or len(self.df) == 0:
+            return {}
+
+        columns = self._views()
+
+        names, firsts, codes = np.unique(columns[self.sequence], return_index=True, return_inverse=True)
+        begins = columns[self.begin].astype(np.int64, copy=False)
+        ends = columns[self.end].astype(np.int64, copy=False)
+        order = np.lexsort((ends, begins, codes))
+        bounds = np.searchsorted(codes[order], np.arange(len(names) + 1), side='left')
+
+        # Sequences in order of first appearance
+        positions = {}
+        for i in np.argsort(firsts, kind='stable').tolist():
+            rows = order[bounds[i]:bounds[i + 1]]
+            positions[names[i]] = {
+                'rows': rows,
+                self.begin: begins[rows],
+                self.end: ends[rows],
+                'maxend': np.maximum.accumulate(ends[rows])
+            }
+        return positions
+
+    def __getstate__(self):
+        # The columns views are created again from the dataframe
+        state = dict(self.__dict__)
+        state['_columns'] = None
+        return state
 
     def index(self, label: str):
         return label
 
-    def query(self, sequence, begin, end):
-        raise NotImplementedError()
+    def _located(self):
+        """
+        Returns: True if the sequence, begin and end columns are defined
+        """
+        return None not in (self.sequence, self.begin, self.end)
+
+    def _selection(self, sequence, begin, end):
+        """
+        Rows that overlap a region
+
+        Returns:
+            An array with the positions of the rows at the dataframe sorted by begin, or None if there are no rows
+        """
+        if not self._located():
+            raise ValueError("A PandasSource needs the sequence, begin and end columns to query a region")
+
+        index = self._positions.get(sequence)
+        if index is None or begin >= end:
+            return None
+
+        # Rows with a begin lower than 'end' and an end greater or equal than 'begin'
+        first = np.searchsorted(index['maxend'], begin, side='left')
+        last = np.searchsorted(index[self.begin], end, side='left')
+        if first >= last:
+            return None
+
+        mask = index[self.end][first:last] >= begin
+        return index['rows'][first:last] if mask.all() else index['rows'][first:last][mask]
+
+    def _selected(self, rows, columns=None):
+        views = self._views()
+        return {h: views[h][rows] for _, h, _ in self._fields(columns)}
+
+    def query(self, sequence, begin, end, columns=None):
+        rows = self._selection(sequence, begin, end)
+        if rows is None:
+            return iter([])
+        return _batch_dicts(self._selected(rows, columns))
+
+    def query_batches(self, sequence, begin, end, batch_size=BATCH_SIZE, columns=None):
+        rows = self._selection(sequence, begin, end)
+        if rows is None:
+            return
+        for i in range(0, len(rows), batch_size):
+            yield self._selected(rows[i:i + batch_size], columns)
 
     def intersect(self, sequence, begin, end):
-        raise NotImplementedError()
+        rows = self._selection(sequence, begin, end)
+        if rows is None:
+            return
+        columns = self._views()
+        for b, e in zip(columns[self.begin][rows].tolist(), columns[self.end][rows].tolist()):
+            yield sequence, b, e + 1
 
-    def __iter__(self, p=None):
-        for r in self.df.iterrows():
-            yield r[1].to_dict()
+    def statistics(self):
+        if not self._located():
+            return None
+        return {
+            sequence: (len(index['rows']), int(index[self.begin][0]), int(index['maxend'][-1]) + 1)
+            for sequence, index in self._positions.items()
+        }
+
+    def width(self):
+        if not self._located() or len(self.df) == 0:
+            return None
+        columns = self._views()
+        return float(np.mean(columns[self.end][:1000] + 1 - columns[self.begin][:1000]))
+
+    def region(self, begin, end):
+        return begin, end + 1
+
+    def _covered(self, begin, end):
+        return None if begin >= end else (begin, end - 1)
+
+    def iter_batches(self, batch_size=BATCH_SIZE, p=None, columns=None):
+        headers = [h for _, h, _ in self._fields(columns)]
+        views = self._views()
+        selected = {h: views[h] if p is None else views[h][p[0]::p[1]] for h in headers}
+        total = len(self.df) if p is None else len(range(p[0], len(self.df), p[1]))
+        for i in range(0, total, batch_size):
+            yield {h: v[i:i + batch_size] for h, v in selected.items()}
+
+    def __iter__(self, p=None, columns=None):
+        for batch in self.iter_batches(p=p, columns=columns):
+            yield from _batch_dicts(batch)
 
     def __len__(self):
         return len(self.df)
+
+
+def _batch_dicts(batch):
+    """
+    Returns: A generator of rows as dictionaries from a batch like {column: array, ...}
+    """
+    headers = list(batch.keys())
+    for row in zip(*[batch[h].tolist() for h in headers]):
+        yield dict(zip(headers, row))
+
+
+def _sequence_trees(args):
+    """
+    Build the interval trees of one sequence of an IntervalTreeSource at a pool process
+    """
+    source, name, columns = args
+    return source._build_trees(tabix.open(source.filename).querys(name), columns)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _map_arrays(path):
+    """
+    Map the arrays of an ArraySource shared file
+
+    Returns:
+        A dictionary like {sequence: {column: array, ...}, ...}
+    """
+    meta, flat = _load_arrays(path)
+    arrays = {name: {} for name in meta['sequences']}
+    for key, array in flat.items():
+        i, column = key.split('/', 1)
+        arrays[meta['sequences'][int(i)]][column] = array
+    return arrays
+
+
+def _open_text(filename):
+    """
+    Open a compressed text file to scan it. The workers decompress with only one thread, because
+    they already run in parallel.
+    """
+    return open_text(filename, threads=1 if workers._is_worker() else None)
+
+
+def _from_bytes(ctype):
+    """
+    Returns: A function that parses the bytes of a value. Numbers are parsed without decoding them.
+    """
+    if ctype in (int, float):
+        return ctype
+    if ctype == str:
+        return partial(str, encoding="utf-8")
+    return lambda v: ctype(v.decode("utf-8"))
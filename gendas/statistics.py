@@ -15,11 +15,38 @@
 """
     Basic statistic algorithms computed over an iterable collection without loading
     all the values into memory.
+
+    The aggregates are also available as mergeable states (Moments, Extremes, HyperLogLog, TDigest,
+    Histogram, ...). A state is updated with arrays of values and two states of the same kind can be
+    merged, so the engine aggregates each partition of a gendas column at the workers and only merges
+    the partial states (see GendasColumn.aggregate).
 """
 
 import builtins
 import itertools
-import statistics
+import math
+import zlib
+
+import numpy as np
+
+# Statistics that 'describe' computes
+STATISTICS = ('count', 'sum', 'mean', 'min', 'max', 'var', 'std')
+
+# Values per array when a collection is not columnar
+CHUNK_SIZE = 10000
+
+# Statistics that 'describe' computes from the moments of the values
+MOMENTS = ('sum', 'mean', 'var', 'std')
+
+# Maximum number of values drawn at once when resampling
+RESAMPLE_BLOCK = 2 ** 22
+
+# Relative tolerance to compare a resampled mean with the observed one
+RESAMPLE_TOLERANCE = 1e-12
+
+# Multiplicative constant of the 64 bits FNV-1a hash
+FNV_PRIME = np.uint64(1099511628211)
+FNV_OFFSET = np.uint64(14695981039346656037)
 
 
 def peek(iterable):
@@ -64,6 +91,427 @@ def empty(fn, values, default=None):
     return fn(iterator)
 
 
+def columnar(values):
+    """
+    Check if a collection iterates its values in NumPy arrays. Only a gendas column does, datasets
+    and sources also have an 'iter_batches' method but their batches are dictionaries of columns.
+
+    Args:
+        values: An iterable collection
+
+    Returns:
+        True if the collection is columnar
+    """
+    return getattr(values, 'columnar', False) is True
+
+
+def batches(values):
+    """
+    Get the NumPy batches of a collection that supports columnar iteration (like a gendas column)
+
+    Args:
+        values: An iterable collection
+
+    Returns:
+        A generator of non empty NumPy arrays or None if the collection is not columnar
+    """
+    if not columnar(values):
+        return None
+    return (b for b in values.iter_batches() if len(b) > 0)
+
+
+def reduce(fn, arrays):
+    """
+    Apply a reduction to each array and then to all the partial results. Numeric arrays are
+    reduced with NumPy and the others (strings, objects) with the python function.
+
+    Args:
+        fn: A python reduction function (like min)
+        arrays: An iterable of non empty NumPy arrays
+
+    Returns:
+        The reduced value or None if there aren't arrays
+    """
+    np_fn = {builtins.min: np.min, builtins.max: np.max}[fn]
+    partials = [np_fn(a).item() if a.dtype.kind in 'biuf' else fn(a.tolist()) for a in arrays]
+    if len(partials) == 0:
+        return None
+    return fn(partials)
+
+
+def chunks(values):
+    """
+    Get a collection as NumPy arrays, in batches if it is columnar or in chunks of CHUNK_SIZE values otherwise
+
+    Args:
+        values: An iterable collection
+
+    Returns:
+        A generator of non empty NumPy arrays
+    """
+    arrays = batches(values)
+    if arrays is not None:
+        return arrays
+
+    iterator = iter(values)
+    return (np.asarray(c) for c in iter(lambda: list(itertools.islice(iterator, CHUNK_SIZE)), []))
+
+
+class Aggregate:
+    """
+    Base class of the mergeable aggregate states
+    """
+
+    def update(self, values):
+        """
+        Add values to the aggregate
+
+        Args:
+            values: A non empty NumPy array
+        """
+        raise NotImplementedError()
+
+    def merge(self, other):
+        """
+        Add the values of another state of the same kind and parameters
+
+        Args:
+            other: An aggregate state
+        """
+        raise NotImplementedError()
+
+    def result(self):
+        """
+        Returns: The aggregated value
+        """
+        raise NotImplementedError()
+
+    def empty(self):
+        """
+        Returns: A new state without values with the same parameters than this one
+        """
+        return type(self)()
+
+
+def _sum(values):
+    """
+    Sum of an array. Integers are added as python integers when the NumPy sum could overflow.
+    """
+    if values.dtype.kind in 'iu':
+        bound = builtins.max(abs(int(values.min())), abs(int(values.max())))
+        if bound * len(values) >= 2 ** 63:
+            return builtins.sum(values.tolist())
+    return values.sum().item()
+
+
+def _mean(total, count):
+    """
+    Mean of a sum like 'statistics.mean', an integer when the mean of integers is exact
+    """
+    if isinstance(total, int) and total % count == 0:
+        return total // count
+    return float(total / count)
+
+
+class Moments(Aggregate):
+    """
+    Count, sum, mean and variance. The mean and the sum of squared differences of each array are
+    combined with the Chan et al. pairwise update, that is stable with floats.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def _add(self, count, total, mean, m2):
+        delta = mean - self.mean
+        size = self.count + count
+        self.m2 += m2 + delta * delta * self.count * count / size
+        self.mean += delta * count / size
+        self.sum += total
+        self.count = size
+
+    def update(self, values):
+        total = _sum(values)
+        mean = total / len(values)
+        self._add(len(values), total, mean, float(((values - mean) ** 2).sum()))
+
+    def merge(self, other):
+        if other.count > 0:
+            self._add(other.count, other.sum, other.mean, other.m2)
+
+    def result(self):
+        """
+        Returns: A dictionary with the count, sum, mean, sample variance and sample standard deviation.
+            The mean is None without values and the variance with less than two values.
+        """
+        var = self.m2 / (self.count - 1) if self.count > 1 else None
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': _mean(self.sum, self.count) if self.count > 0 else None,
+            'var': var,
+            'std': None if var is None else math.sqrt(var)
+        }
+
+
+class Extremes(Aggregate):
+    """
+    Minimum and maximum values. Numeric arrays are reduced with NumPy and the others with python.
+    """
+
+    def __init__(self):
+        self.min = None
+        self.max = None
+
+    def _add(self, lowest, highest):
+        self.min = lowest if self.min is None else builtins.min(self.min, lowest)
+        self.max = highest if self.max is None else builtins.max(self.max, highest)
+
+    def update(self, values):
+        self._add(reduce(builtins.min, [values]), reduce(builtins.max, [values]))
+
+    def merge(self, other):
+        if other.min is not None:
+            self._add(other.min, other.max)
+
+    def result(self):
+        """
+        Returns: A dictionary with the min and the max, None without values
+        """
+        return {'min': self.min, 'max': self.max}
+
+
+class Describe(Aggregate):
+    """
+    Several statistics of the same values, see 'describe'
+    """
+
+    def __init__(self, names=('count', 'mean', 'min', 'max', 'std')):
+        """
+        Args:
+            names: The statistics to compute (any of STATISTICS)
+        """
+        unknown = set(names) - set(STATISTICS)
+        if len(unknown) > 0:
+            raise ValueError("Unknown statistics: {}".format(", ".join(sorted(unknown))))
+
+        self.names = list(names)
+        self.count = 0
+        self.moments = None if set(MOMENTS).isdisjoint(names) else Moments()
+        self.extremes = None if {'min', 'max'}.isdisjoint(names) else Extremes()
+
+    def update(self, values):
+        self.count += len(values)
+        for state in (self.moments, self.extremes):
+            if state is not None:
+                state.update(values)
+
+    def merge(self, other):
+        self.count += other.count
+        for state, partial in ((self.moments, other.moments), (self.extremes, other.extremes)):
+            if state is not None:
+                state.merge(partial)
+
+    def result(self):
+        """
+        Returns: A dictionary with the value of each statistic
+        """
+        result = {'count': self.count}
+        for state in (self.moments, self.extremes):
+            if state is not None:
+                result.update(state.result())
+        return {name: result[name] for name in self.names}
+
+    def empty(self):
+        return Describe(self.names)
+
+
+class HyperLogLog(Aggregate):
+    """
+    Approximated count of distinct values. The relative error is around 1.04 / sqrt(2 ** precision).
+    The values are hashed by their content, so the states of different processes can be merged.
+    """
+
+    def __init__(self, precision: int = 14):
+        """
+        Args:
+            precision: Number of bits of the hash that select a register, from 4 to 18
+        """
+        if not 4 <= precision <= 18:
+            raise ValueError("The precision must be between 4 and 18")
+        self.precision = precision
+        self.registers = np.zeros(2 ** precision, dtype=np.uint8)
+
+    def update(self, values):
+        hashes = _hash(values)
+        bits = 64 - self.precision
+        registers = (hashes >> np.uint64(bits)).astype(np.int64)
+
+        # Position of the first 1 bit at the remaining bits
+        rest = hashes & np.uint64(2 ** bits - 1)
+        rank = bits + 1 - _bit_length(rest)
+        np.maximum.at(self.registers, registers, rank.astype(np.uint8))
+
+    def merge(self, other):
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def result(self):
+        """
+        Returns: The estimated number of distinct values
+        """
+        m = len(self.registers)
+        alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(m, 0.7213 / (1 + 1.079 / m))
+        estimate = alpha * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+
+        # Linear counting for small cardinalities
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and zeros > 0:
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+    def empty(self):
+        return HyperLogLog(self.precision)
+
+
+class TDigest(Aggregate):
+    """
+    Approximated quantiles of numeric values. The values are kept as weighted centroids that are smaller
+    near the extremes, so the tails have a better accuracy than the median.
+    """
+
+    def __init__(self, quantiles=(0.25, 0.5, 0.75), compression: int = 100):
+        """
+        Args:
+            quantiles: The quantiles that 'result' returns
+            compression: Approximated maximum number of centroids. More centroids are more accurate.
+        """
+        self.quantiles = list(quantiles)
+        self.compression = compression
+        self.means = np.array([], dtype=np.float64)
+        self.weights = np.array([], dtype=np.float64)
+        self.min = None
+        self.max = None
+
+    def _add(self, means, weights, lowest, highest):
+        self.min = lowest if self.min is None else builtins.min(self.min, lowest)
+        self.max = highest if self.max is None else builtins.max(self.max, highest)
+
+        means = np.concatenate([self.means, means])
+        weights = np.concatenate([self.weights, weights])
+        order = np.argsort(means, kind='stable')
+        means, weights = means[order], weights[order]
+
+        # Merge the neighbour centroids that fall at the same unit of the k1 scale function
+        total = weights.sum()
+        q = (np.cumsum(weights) - weights / 2) / total
+        k = np.floor(self.compression * (np.arcsin(2 * q - 1) / math.pi + 0.5)).astype(np.int64)
+        starts = np.flatnonzero(np.concatenate([[True], k[1:] != k[:-1]]))
+        self.weights = np.add.reduceat(weights, starts)
+        self.means = np.add.reduceat(means * weights, starts) / self.weights
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        self._add(values, np.ones(len(values)), float(values.min()), float(values.max()))
+
+    def merge(self, other):
+        if other.min is not None:
+            self._add(other.means, other.weights, other.min, other.max)
+
+    def quantile(self, q):
+        """
+        Args:
+            q: A quantile between 0 and 1
+
+        Returns:
+            The estimated value or None without values
+        """
+        if self.min is None:
+            return None
+
+        # Interpolate between the centroids centers, and the extremes at the borders
+        centers = (np.cumsum(self.weights) - self.weights / 2) / self.weights.sum()
+        xs = np.concatenate([[0.0], centers, [1.0]])
+        ys = np.concatenate([[self.min], self.means, [self.max]])
+        return float(np.interp(q, xs, ys))
+
+    def result(self):
+        """
+        Returns: A list with the estimated value of each quantile
+        """
+        return [self.quantile(q) for q in self.quantiles]
+
+    def empty(self):
+        return TDigest(self.quantiles, self.compression)
+
+
+class Histogram(Aggregate):
+    """
+    Count of the values at fixed bins. The values outside the bins are not counted.
+    """
+
+    def __init__(self, edges):
+        """
+        Args:
+            edges: The increasing edges of the bins. All the bins are half open, except the last one.
+        """
+        self.edges = np.asarray(edges, dtype=np.float64)
+        self.counts = np.zeros(len(self.edges) - 1, dtype=np.int64)
+
+    def update(self, values):
+        self.counts += np.histogram(values, bins=self.edges)[0]
+
+    def merge(self, other):
+        self.counts += other.counts
+
+    def result(self):
+        """
+        Returns: An array with the count of each bin
+        """
+        return self.counts
+
+    def empty(self):
+        return Histogram(self.edges)
+
+
+def aggregate(values, state):
+    """
+    Update an aggregate state with all the values. If the values are a gendas column, the partitions
+    are aggregated at the engine workers.
+
+    Args:
+        values: An iterable collection
+        state: An aggregate state
+
+    Returns:
+        The updated state
+    """
+    if columnar(values):
+        return values.aggregate(state)
+
+    for a in chunks(values):
+        state.update(a)
+    return state
+
+
+def describe(values, names=('count', 'mean', 'min', 'max', 'std')):
+    """
+    Computes several statistics reading the values only once
+
+    Args:
+        values: An iterable collection
+        names: The statistics to compute (any of STATISTICS). The variance and the standard
+            deviation are the sample ones (divided by count - 1).
+
+    Returns:
+        A dictionary with the value of each statistic. All of them are None if values it's empty, except
+        the count and the sum, and the variance is None with less than two values.
+    """
+    return aggregate(values, Describe(names)).result()
+
+
 def mean(values):
     """
     Computes the mean value
@@ -75,7 +523,7 @@ def mean(values):
         The mean or None if values it's empty
 
     """
-    return empty(statistics.mean, values)
+    return describe(values, ['mean'])['mean']
 
 
 def min(values):
@@ -89,6 +537,9 @@ def min(values):
         The minimum value or None if values it's empty
 
     """
+    if columnar(values):
+        return describe(values, ['min'])['min']
+
     return empty(builtins.min, values)
 
 
@@ -103,6 +554,9 @@ def max(values):
         The maximum value or None if values it's empty
 
     """
+    if columnar(values):
+        return describe(values, ['max'])['max']
+
     return empty(builtins.max, values)
 
 
@@ -117,4 +571,127 @@ def count(iterator):
         How many elements you have in the iterator
 
     """
+    if columnar(iterator):
+        return describe(iterator, ['count'])['count']
+
     return sum(1 for i in iterator)
+
+
+def group_seed(seed, label):
+    """
+    A seed for the random numbers of one group that only depends on a global seed and on the group
+    label, so the results of a group are the same whatever worker computes it and in any order.
+
+    Args:
+        seed: A global integer seed
+        label: The group label (any value with a stable string representation)
+
+    Returns:
+        A NumPy SeedSequence
+    """
+    return np.random.SeedSequence([seed, zlib.crc32(str(label).encode("utf-8"))])
+
+
+def resample_means(background, size: int, n: int, seed=None):
+    """
+    Means of random samples with replacement of the background values. All the samples are drawn
+    as index matrices of at most RESAMPLE_BLOCK values.
+
+    Args:
+        background: The values to sample, an array, an iterable or a gendas column
+        size: Number of values of each sample
+        n: Number of samples
+        seed: A seed for NumPy 'default_rng' (an integer or a SeedSequence, see 'group_seed').
+            Defaults to None, a random seed.
+
+    Returns:
+        An array with the mean of each sample
+    """
+    values = _values(background)
+    if len(values) == 0 or size <= 0:
+        raise ValueError("Cannot sample {} values from {} background values".format(size, len(values)))
+
+    rng = np.random.default_rng(seed)
+    means = np.empty(n, dtype=np.float64)
+    rows = builtins.max(1, RESAMPLE_BLOCK // size)
+    for i in range(0, n, rows):
+        block = builtins.min(rows, n - i)
+        means[i:i + block] = values[rng.integers(0, len(values), size=(block, size))].mean(axis=1)
+    return means
+
+
+def resample_mean_pvalue(background, observed, n: int = 10000, seed=None):
+    """
+    Empirical p-value of the mean of the observed values against the means of n random samples of the
+    same size from the background values (see 'resample_means').
+
+    Args:
+        background: The background values, an array, an iterable or a gendas column
+        observed: The observed values, an array, an iterable or a gendas column
+        n: Number of samples
+        seed: A seed for the random samples (see 'resample_means')
+
+    Returns:
+        The fraction of samples with a mean greater or equal than the observed one (at least 1 / n),
+        or None if there are no observed values
+    """
+    observed = _values(observed)
+    if len(observed) == 0:
+        return None
+
+    means = resample_means(background, len(observed), n, seed=seed)
+    threshold = observed.mean()
+    threshold -= RESAMPLE_TOLERANCE * abs(threshold)
+    return builtins.max(1, int(np.count_nonzero(means >= threshold))) / n
+
+
+def _values(values):
+    """
+    Returns: All the values of a collection as a float NumPy array
+    """
+    arrays = batches(values)
+    if arrays is not None:
+        arrays = list(arrays)
+        return np.concatenate(arrays).astype(np.float64) if len(arrays) > 0 else np.array([], dtype=np.float64)
+    return np.asarray(values if hasattr(values, '__len__') else list(values), dtype=np.float64)
+
+
+def _hash(values):
+    """
+    Hash the values of an array by their content
+
+    Returns:
+        An array of 64 bits hashes
+    """
+    values = np.asarray(values)
+    if values.dtype.kind in 'biu':
+        hashes = values.astype(np.int64).view(np.uint64)
+    elif values.dtype.kind == 'f':
+        hashes = values.astype(np.float64).view(np.uint64)
+    else:
+        # FNV-1a over the unicode code points of the strings. The array pads them to the longest one,
+        # only the code points of each string are hashed so a hash does not depend on the other values.
+        strings = values.astype(str)
+        lengths = np.char.str_len(strings)
+        codes = strings.view(np.uint32).reshape(len(strings), -1).astype(np.uint64)
+        hashes = np.full(len(codes), FNV_OFFSET, dtype=np.uint64)
+        for i in range(codes.shape[1]):
+            hashes = np.where(lengths > i, (hashes ^ codes[:, i]) * FNV_PRIME, hashes)
+
+    # Finalizer of splitmix64, so all the bits depend on all the input bits
+    hashes = (hashes ^ (hashes >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    hashes = (hashes ^ (hashes >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return hashes ^ (hashes >> np.uint64(31))
+
+
+def _bit_length(values):
+    """
+    Returns: The number of bits needed to represent each value of an array of unsigned integers
+    """
+    values = values.copy()
+    length = np.zeros(len(values), dtype=np.int64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        mask = values >= np.uint64(2 ** shift)
+        length[mask] += shift
+        values[mask] >>= np.uint64(shift)
+    return length + (values > 0)
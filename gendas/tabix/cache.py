@@ -0,0 +1,238 @@
+#
+#   Copyright 2018 Jordi Deu-Pons
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may not use this
+#   file except in compliance with the License. You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software distributed under
+#   the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+#   ANY KIND, either express or implied. See the License for the specific language
+#   governing permissions and limitations under the License.
+#
+
+"""
+    Caches of uncompressed blocks. A cache can be shared by several block readers (all the sources
+    of an engine) and the shared memory cache also by all the processes of one host.
+"""
+
+import atexit
+import collections
+import hashlib
+import os
+import shutil
+import struct
+import tempfile
+
+from gendas.utils import SHARED_MEMORY
+
+# Approximated memory overhead of each cached entry
+ENTRY_OVERHEAD = 200
+
+
+class BlockCache:
+    """
+    A least recently used cache of blocks bounded by the total size of the contents
+    """
+
+    def __init__(self, max_bytes: int):
+        """
+        Args:
+            max_bytes: Maximum number of bytes of all the cached contents
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+
+    def get(self, key):
+        """
+        Args:
+            key: A hashable block identifier
+
+        Returns:
+            The cached value or None if it is not in the cache
+        """
+        value = self._entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        """
+        Args:
+            key: A hashable block identifier
+            value: A tuple like (compressed_length, content), where content are bytes or text
+        """
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self.nbytes -= _size(previous)
+
+        size = _size(value)
+        if size > self.max_bytes:
+            return
+
+        self._entries[key] = value
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.nbytes -= _size(evicted)
+            self.evictions += 1
+
+    def stats(self):
+        """
+        Returns: A dictionary with the cache counters
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+            'bytes': self.nbytes
+        }
+
+    def clear(self):
+        self._entries.clear()
+        self.nbytes = 0
+
+    def __getstate__(self):
+        # The contents are not sent to other processes and each process has its own counters
+        state = dict(self.__dict__)
+        state['_entries'] = collections.OrderedDict()
+        state.update(nbytes=0, hits=0, misses=0, evictions=0)
+        return state
+
+
+class SharedBlockCache(BlockCache):
+    """
+    A cache of blocks stored as files at a shared memory directory, so all the processes of one host
+    reuse the blocks that any of them has uncompressed. The most recently used blocks are also kept
+    at a small cache in the memory of each process.
+
+    The shared blocks are evicted by age when the directory grows over the maximum size.
+    """
+
+    # Header of each shared file: compressed length and a flag that is 1 for text contents
+    HEADER = struct.Struct('<IB')
+
+    def __init__(self, max_bytes: int, local_bytes: int = 32 * 2 ** 20, path: str = None):
+        """
+        Args:
+            max_bytes: Maximum number of bytes at the shared directory
+            local_bytes: Maximum number of bytes of the cache in the memory of each process
+            path: The shared directory. Defaults to None, create a new directory at /dev/shm (or at
+                the temporary directory if there is no /dev/shm) that is removed at exit.
+        """
+        super().__init__(min(local_bytes, max_bytes))
+        self.shared_max_bytes = max_bytes
+        self.shared_hits = 0
+        self.shared_evictions = 0
+        self._written = 0
+
+        if path is None:
+            path = tempfile.mkdtemp(prefix='gendas-', dir=SHARED_MEMORY if os.path.isdir(SHARED_MEMORY) else None)
+            self._owner = os.getpid()
+            atexit.register(self.close)
+        else:
+            os.makedirs(path, exist_ok=True)
+            self._owner = None
+        self.path = path
+
+    def get(self, key):
+        value = self._entries.get(key)
+        if value is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return value
+
+        try:
+            with open(self._file(key), 'rb') as fd:
+                data = fd.read()
+        except OSError:
+            self.misses += 1
+            return None
+
+        length, text = SharedBlockCache.HEADER.unpack_from(data)
+        content = data[SharedBlockCache.HEADER.size:]
+        value = length, content.decode("utf-8") if text else content
+        self.hits += 1
+        self.shared_hits += 1
+        super().set(key, value)
+        return value
+
+    def set(self, key, value):
+        super().set(key, value)
+
+        length, content = value
+        text = isinstance(content, str)
+        data = SharedBlockCache.HEADER.pack(length, text) + (content.encode("utf-8") if text else content)
+        path = self._file(key)
+        temporary = "{}.{}.tmp".format(path, os.getpid())
+        try:
+            with open(temporary, 'wb') as fd:
+                fd.write(data)
+            os.replace(temporary, path)
+        except OSError:
+            return
+
+        self._written += len(data)
+        if self._written > self.shared_max_bytes // 8:
+            self._trim()
+
+    def _file(self, key):
+        return os.path.join(self.path, hashlib.sha1(repr(key).encode("utf-8")).hexdigest())
+
+    def _trim(self):
+        """
+        Remove the oldest shared blocks until the directory is under the maximum size
+        """
+        self._written = 0
+        files = []
+        for entry in os.scandir(self.path):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.shared_max_bytes:
+                break
+            try:
+                os.remove(path)
+                self.shared_evictions += 1
+            except OSError:
+                pass
+            total -= size
+
+    def stats(self):
+        stats = super().stats()
+        stats['shared_hits'] = self.shared_hits
+        stats['shared_evictions'] = self.shared_evictions
+        return stats
+
+    def close(self):
+        """
+        Remove the shared directory if this process created it
+        """
+        if self._owner == os.getpid():
+            shutil.rmtree(self.path, ignore_errors=True)
+            atexit.unregister(self.close)
+            self._owner = None
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state.update(_owner=None, _written=0, shared_hits=0, shared_evictions=0)
+        return state
+
+
+def _size(value):
+    return len(value[1]) + ENTRY_OVERHEAD
@@ -22,6 +22,11 @@ SHIFT_AMOUNT = 16
 OFFSET_MASK = 0xffff
 ADDRESS_MASK = 0xFFFFFFFFFFFF
 
+# Tabix index presets
+PRESET_GENERIC = 0
+PRESET_SAM = 1
+PRESET_VCF = 2
+
 # Compression level
 COMPRESSION_LEVEL = 5
 
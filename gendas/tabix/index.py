@@ -13,11 +13,20 @@
 #
 
 import gzip
+import logging
+import os
 import struct
+import warnings
 from os import path
 from pprint import pprint
 
 import click
+import numpy as np
+
+from gendas.tabix.constants import SHIFT_AMOUNT
+from gendas.utils import _save_arrays, _load_arrays
+
+logger = logging.getLogger("gendas")
 
 
 class TabixIndex:
@@ -27,83 +36,328 @@ class TabixIndex:
     MAX_BIN = 37450
     TAD_MIN_CHUNK_GAP = 32768
     TAD_LIDX_SHIFT = 14
+    TI_FLAG_UCSC = 0x10000
+    MAX_POSITION = 1 << 29
 
-    def __init__(self, indexfile):
+    def __init__(self, indexfile, cache: bool = False):
+        """
+        Load a tabix index
 
-        with gzip.open(indexfile, 'rb') as idx:
+        Args:
+            indexfile: Path to a '.tbi' file
+            cache: True to keep a decoded copy of the index next to it (a '.tbi.gdc' file) that is memory
+                mapped the next times. The copy is updated when the index file changes.
+        """
+        meta, arrays = None, None
+        if cache:
+            cachefile = "{}.gdc".format(indexfile)
+            stat = os.stat(indexfile)
+            signature = [stat.st_size, stat.st_mtime_ns]
+            try:
+                meta, arrays = _load_arrays(cachefile)
+                if meta.get('signature') != signature:
+                    meta, arrays = None, None
+            except (OSError, ValueError, RuntimeError):
+                meta, arrays = None, None
+
+            if arrays is None:
+                meta, arrays = self._parse(indexfile)
+                meta['signature'] = signature
+                try:
+                    _save_arrays(cachefile, meta, arrays)
+                except OSError as e:
+                    logger.warning("The index cache {} cannot be saved: {}".format(cachefile, e))
+        else:
+            meta, arrays = self._parse(indexfile)
+
+        self.names = meta['names']
+        self.conf = meta['conf']
+        self.more = meta['more']
+        self.mSeq = len(self.names)
+        self.arrays = arrays
+        self._bins = {}
+        self._ids = {name: i for i, name in enumerate(self.names)}
+
+        seq_linear = arrays['seq_linear']
+        self.linear = {
+            name: {
+                'size': int(seq_linear[i + 1] - seq_linear[i]),
+                'offset': arrays['linear'][seq_linear[i]:seq_linear[i + 1]]
+            } for i, name in enumerate(self.names)
+        }
+
+    @staticmethod
+    def _parse(indexfile):
+        """
+        Parse a '.tbi' file into flat arrays
 
-            # Magic number
-            magic = idx.read(4)
-            if magic != b'TBI\x01':
-                raise RuntimeError("[tabix index] wrong magic number")
-
-            # idx->n
-            self.mSeq = struct.unpack('i', idx.read(4))[0]
-
-            # typedef struct
-            # {
-            #     int32_t preset;
-            #     int32_t sc, bc, ec; // seq col., beg col. and end col.
-            #     int32_t meta_char, line_skip;
-            # } ti_conf_t;
-            self.conf = {
-                'preset': struct.unpack('i', idx.read(4))[0],
-                'sc': struct.unpack('i', idx.read(4))[0],
-                'bc': struct.unpack('i', idx.read(4))[0],
-                'ec': struct.unpack('i', idx.read(4))[0],
-                'meta_char': struct.unpack('i', idx.read(4))[0],
-                'line_skip': struct.unpack('i', idx.read(4))[0]
+        Returns:
+            A tuple like (meta, arrays). Where 'meta' has the sequence names and the configuration, and
+            'arrays' has the bins ids ('bins'), the bins of each sequence ('seq_bins'), the chunks of each
+            bin ('bin_chunks'), all the chunks ('chunks_begin' and 'chunks_end'), all the linear index
+            offsets ('linear') and the offsets of each sequence ('seq_linear').
+        """
+        with gzip.open(indexfile, 'rb') as idx:
+            buf = idx.read()
+
+        # Magic number
+        if buf[:4] != b'TBI\x01':
+            raise RuntimeError("[tabix index] wrong magic number")
+
+        # typedef struct
+        # {
+        #     int32_t preset;
+        #     int32_t sc, bc, ec; // seq col., beg col. and end col.
+        #     int32_t meta_char, line_skip;
+        # } ti_conf_t;
+        n_seq, preset, sc, bc, ec, meta_char, line_skip, l_nm = struct.unpack_from('<8i', buf, 4)
+        conf = {'preset': preset, 'sc': sc, 'bc': bc, 'ec': ec, 'meta_char': meta_char, 'line_skip': line_skip}
+        pos = 36
+
+        # Target names
+        names = [n.decode() for n in buf[pos:pos + l_nm].split(b'\0')[:n_seq]]
+        pos += l_nm
+
+        # Only walk the bins headers, the chunks and the linear offsets are read in bulk later
+        bins, bin_sizes, bin_positions = [], [], []
+        seq_bins = [0]
+        linear_sizes, linear_positions = [], []
+        for _ in range(n_seq):
+            n_bin = struct.unpack_from('<i', buf, pos)[0]
+            pos += 4
+            for _ in range(n_bin):
+                bin, n_chunk = struct.unpack_from('<Ii', buf, pos)
+                bins.append(bin)
+                bin_sizes.append(n_chunk)
+                bin_positions.append(pos + 8)
+                pos += 8 + 16 * n_chunk
+            seq_bins.append(len(bins))
+
+            n_intv = struct.unpack_from('<i', buf, pos)[0]
+            linear_sizes.append(n_intv)
+            linear_positions.append(pos + 4)
+            pos += 4 + 8 * n_intv
+
+        raw = np.frombuffer(buf, dtype=np.uint8)
+
+        # Byte position of all the chunks
+        bin_sizes = np.array(bin_sizes, dtype=np.int64)
+        bin_chunks = np.zeros(len(bins) + 1, dtype=np.int64)
+        bin_chunks[1:] = np.cumsum(bin_sizes)
+        chunk_positions = np.repeat(np.array(bin_positions, dtype=np.int64), bin_sizes) + \
+            16 * (np.arange(bin_chunks[-1], dtype=np.int64) - np.repeat(bin_chunks[:-1], bin_sizes))
+        chunks = raw[chunk_positions[:, None] + np.arange(16)].view('<i8').reshape(-1, 2)
+
+        # Byte position of all the linear offsets
+        linear_sizes = np.array(linear_sizes, dtype=np.int64)
+        seq_linear = np.zeros(n_seq + 1, dtype=np.int64)
+        seq_linear[1:] = np.cumsum(linear_sizes)
+        linear_positions = np.repeat(np.array(linear_positions, dtype=np.int64), linear_sizes) + \
+            8 * (np.arange(seq_linear[-1], dtype=np.int64) - np.repeat(seq_linear[:-1], linear_sizes))
+        linear = raw[linear_positions[:, None] + np.arange(8)].view('<i8').reshape(-1)
+
+        meta = {'names': names, 'conf': conf, 'more': len(buf) - pos}
+        arrays = {
+            'bins': np.array(bins, dtype=np.int64),
+            'seq_bins': np.array(seq_bins, dtype=np.int64),
+            'bin_chunks': bin_chunks,
+            'chunks_begin': np.ascontiguousarray(chunks[:, 0]),
+            'chunks_end': np.ascontiguousarray(chunks[:, 1]),
+            'linear': linear,
+            'seq_linear': seq_linear
+        }
+        return meta, arrays
+
+    def _chunks(self, seq):
+        """
+        Returns: A dictionary with the chunks range of each bin of a sequence like {bin: (first, last + 1)}
+        """
+        if seq not in self._bins:
+            i = self._ids[seq]
+            first, last = self.arrays['seq_bins'][i], self.arrays['seq_bins'][i + 1]
+            bin_chunks = self.arrays['bin_chunks'][first:last + 1].tolist()
+            self._bins[seq] = {
+                bin: (bin_chunks[j], bin_chunks[j + 1])
+                for j, bin in enumerate(self.arrays['bins'][first:last].tolist())
             }
+        return self._bins[seq]
+
+    @property
+    def binning(self):
+        """
+        Deprecated, the bins are now stored in flat arrays (see '_chunks').
+
+        Returns: The binning index as a dictionary like {sequence: {bin: [(begin, end), ...]}} with the
+        virtual offsets of the chunks of each bin
+        """
+        warnings.warn("TabixIndex.binning is deprecated and builds a copy of the whole binning index",
+                      DeprecationWarning, stacklevel=2)
+        begins = self.arrays['chunks_begin']
+        ends = self.arrays['chunks_end']
+        return {
+            seq: {
+                bin: list(zip(begins[first:last].tolist(), ends[first:last].tolist()))
+                for bin, (first, last) in self._chunks(seq).items()
+            } for seq in self.names
+        }
+
+    @property
+    def zero_based(self):
+        """
+        Returns: True if the begin column of the indexed file is zero-based (UCSC like files)
+        """
+        return bool(self.conf['preset'] & TabixIndex.TI_FLAG_UCSC)
+
+    def _windows(self):
+        """
+        Iterate all the linear index windows in file order as tuples like (sequence, window, address). Where
+        'address' is the compressed file offset of the first block that contains data of that window.
+        """
+        address = 0
+        for name in self.names:
+            for window, offset in enumerate(self.linear[name]['offset'].tolist()):
+                # Empty windows can have a zero offset, keep addresses monotonic
+                address = max(address, offset >> SHIFT_AMOUNT)
+                yield name, window, address
+
+    def tiles(self, n: int, size: int = None):
+        """
+        Split the indexed genome into 'n' partitions with a similar amount of compressed bytes, using
+        the linear index.
+
+        Args:
+            n: Number of partitions
+            size: Size in bytes of the compressed data file. Used to weight the last window of the file.
+
+        Returns:
+            A list of 'n' partitions. Each partition is a list of disjoint tiles like (sequence, begin, end), where
+            'begin' (included) and 'end' (excluded) are zero-based positions. All the tiles together cover the
+            whole genome and all the tiles of the same sequence are contiguous.
+        """
+        partitions = [[] for _ in range(n)]
+
+        windows = list(self._windows())
+        if len(windows) == 0:
+            return partitions
+
+        first = windows[0][2]
+        last = windows[-1][2] if size is None else max(size, windows[-1][2])
+        total = max(1, last - first)
+
+        for i, (name, window, address) in enumerate(windows):
+            partition = partitions[min(n - 1, ((address - first) * n) // total)]
+
+            begin = window << TabixIndex.TAD_LIDX_SHIFT
+            last_window = i + 1 == len(windows) or windows[i + 1][0] != name
+            end = TabixIndex.MAX_POSITION if last_window else (window + 1) << TabixIndex.TAD_LIDX_SHIFT
+
+            # Extend the previous tile when it is contiguous
+            if len(partition) > 0 and partition[-1][0] == name and partition[-1][2] == begin:
+                partition[-1] = (name, partition[-1][1], end)
+            else:
+                partition.append((name, begin, end))
 
-            # Read target names
-            l = struct.unpack('i', idx.read(4))[0]
-            buf = idx.read(l)
-
-            self.names = []
-            buf_str = ""
-            for i in range(l):
-                if buf[i] == 0:
-                    self.names.append(buf_str)
-                    buf_str = ""
-                else:
-                    buf_str += chr(buf[i])
-
-            self.binning = {}
-            self.linear = {}
-            for i in range(self.mSeq):
-
-                # Load binning index
-                n_bin = struct.unpack('I', idx.read(4))[0]
-
-                bins = {}
-                for j in range(n_bin):
-                    bin = struct.unpack('I', idx.read(4))[0]
-                    bin_l = struct.unpack('I', idx.read(4))[0]
-
-                    chunks = []
-                    for k in range(bin_l):
-                        u = struct.unpack('Q', idx.read(8))[0]
-                        v = struct.unpack('Q', idx.read(8))[0]
-                        chunks.append((u, v))
-                    bins[bin] = chunks
-
-                self.binning[self.names[i]] = bins
-
-                # load linear index
-                l = struct.unpack('I', idx.read(4))[0]
-                offsets = []
-                for k in range(l):
-                    offsets.append(struct.unpack('Q', idx.read(8))[0])
-
-                self.linear[self.names[i]] = {'size': l, 'offset': offsets}
-
-            # Check other bytes
-            b = idx.read(1)
-            c = 1 if b else 0
-            while b:
-                b = idx.read(1)
-                c += 1
-            self.more = c
+        return partitions
+
+    def sequences(self, size: int = None):
+        """
+        Compressed size and span of each indexed sequence, using the linear index.
+
+        Args:
+            size: Size in bytes of the compressed data file. Used to weight the last sequence of the file.
+
+        Returns:
+            A dictionary like {sequence: (nbytes, begin, end)} where 'begin' (included) and 'end' (excluded)
+            are zero-based positions of the linear index windows with data.
+        """
+        starts = []
+        for name in self.names:
+            offsets = self.linear[name]['offset'].tolist()
+            if len(offsets) == 0:
+                continue
+
+            # Windows before the first row can have a zero offset
+            window = next((w for w, o in enumerate(offsets) if o != 0), 0)
+            starts.append((name, window, len(offsets), offsets[window] >> SHIFT_AMOUNT))
+
+        result = {}
+        for i, (name, window, windows, address) in enumerate(starts):
+            if i + 1 < len(starts):
+                next_address = starts[i + 1][3]
+            else:
+                next_address = address if size is None else max(size, address)
+            result[name] = (
+                max(0, next_address - address),
+                window << TabixIndex.TAD_LIDX_SHIFT,
+                windows << TabixIndex.TAD_LIDX_SHIFT
+            )
+        return result
+
+    def mapped(self, seq):
+        """
+        Number of rows of a sequence. Only the indices written by htslib store it (at the pseudo-bin).
+
+        Args:
+            seq: Sequence name
+
+        Returns:
+            The number of rows or None if the index does not store it
+        """
+        if seq not in self._ids:
+            return None
+
+        first, last = self._chunks(seq).get(TabixIndex.MAX_BIN, (0, 0))
+        if last - first < 2:
+            return None
+        return int(self.arrays['chunks_begin'][first + 1])
+
+    def blocks(self, seq, begin: int, end: int):
+        """
+        Estimate how many compressed blocks hold the data of a region, counting the distinct
+        block addresses of the linear index windows that the region covers.
+
+        Args:
+            seq: Sequence name
+            begin: Zero-based begin position (included)
+            end: Zero-based end position (excluded)
+
+        Returns:
+            Estimated number of blocks
+        """
+        if seq not in self.linear or end <= begin:
+            return 0
+
+        offsets = self.linear[seq]['offset']
+        if len(offsets) == 0:
+            return 0
+
+        first = min(begin >> TabixIndex.TAD_LIDX_SHIFT, len(offsets) - 1)
+        last = min((end - 1) >> TabixIndex.TAD_LIDX_SHIFT, len(offsets) - 1)
+        return len({o >> SHIFT_AMOUNT for o in offsets[first:last + 1].tolist()})
+
+    def nbytes(self, seq, begin: int, end: int):
+        """
+        Estimate how many compressed bytes hold the data of a region, using the addresses of
+        the linear index windows that the region covers.
+
+        Args:
+            seq: Sequence name
+            begin: Zero-based begin position (included)
+            end: Zero-based end position (excluded)
+
+        Returns:
+            Estimated number of compressed bytes
+        """
+        if seq not in self.linear or end <= begin:
+            return 0
+
+        offsets = self.linear[seq]['offset']
+        if len(offsets) == 0:
+            return 0
+
+        first = min(begin >> TabixIndex.TAD_LIDX_SHIFT, len(offsets) - 1)
+        last = min(((end - 1) >> TabixIndex.TAD_LIDX_SHIFT) + 1, len(offsets) - 1)
+        return max(0, (int(offsets[last]) >> SHIFT_AMOUNT) - (int(offsets[first]) >> SHIFT_AMOUNT))
 
     @staticmethod
     def _reg2bins(beg, _end):
@@ -149,36 +403,57 @@ class TabixIndex:
 
     def query(self, seq, begin: int, end: int):
         """
-        TODO Implement the tabix query
-        """
-        if seq in self.names:
-
-            # Bins
-            idx_b = self.binning[seq]
-            idx_l = self.linear[seq]
+        Compressed file chunks that can contain rows overlapping a region
 
-            bins = self._reg2bins(begin, end)
+        Args:
+            seq: Sequence name
+            begin: Zero-based begin position (included)
+            end: Zero-based end position (excluded)
 
-            # Linear offset
-            l_length = idx_l['size']
-            l_offsets = idx_l['offset']
-            if l_length > 0:
-                if begin >> TabixIndex.TAD_LIDX_SHIFT >= l_length:
-                    min_off = l_offsets[l_length - 1]
-                else:
-                    min_off = l_offsets[begin >> TabixIndex.TAD_LIDX_SHIFT]
+        Returns:
+            A sorted list of disjoint chunks like (begin, end), where both are virtual file offsets. Chunks
+            closer than TAD_MIN_CHUNK_GAP compressed bytes are merged to read them sequentially.
+        """
+        if seq not in self._ids:
+            return []
+
+        begin = max(0, begin)
+        end = min(end, TabixIndex.MAX_POSITION)
+        if end <= begin:
+            return []
+
+        # Linear offset
+        l_length = self.linear[seq]['size']
+        l_offsets = self.linear[seq]['offset']
+        if l_length > 0:
+            min_off = int(l_offsets[min(begin >> TabixIndex.TAD_LIDX_SHIFT, l_length - 1)])
+        else:
+            min_off = 0
+
+        # Chunks of all the bins that overlap the region and end after the linear offset
+        idx_b = self._chunks(seq)
+        chunks_begin, chunks_end = self.arrays['chunks_begin'], self.arrays['chunks_end']
+        chunks = []
+        for bin in self._reg2bins(begin, end):
+            if bin in idx_b and bin != TabixIndex.MAX_BIN:
+                first, last = idx_b[bin]
+                chunks.extend(zip(chunks_begin[first:last].tolist(), chunks_end[first:last].tolist()))
+        chunks = sorted(c for c in chunks if c[1] > min_off)
+        if len(chunks) == 0:
+            return []
+
+        # Drop the chunks contained in the previous one and trim the overlaps
+        merged = [list(chunks[0])]
+        for u, v in chunks[1:]:
+            last = merged[-1]
+            if v <= last[1]:
+                continue
+            if (u >> SHIFT_AMOUNT) - (last[1] >> SHIFT_AMOUNT) < TabixIndex.TAD_MIN_CHUNK_GAP:
+                last[1] = v
             else:
-                min_off = 0
-
-            n_off = 0
-            for bin in bins:
-                if bin in idx_b:
-                    n_off += len(idx_b[bin])
-
-            if n_off == 0:
-                return
+                merged.append([u, v])
 
-            return n_off
+        return [(u, v) for u, v in merged]
 
 
 @click.command()
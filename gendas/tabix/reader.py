@@ -13,11 +13,16 @@
 #
 
 import collections
+import gzip
+import mmap as mmap_module
 import os
 import struct
 import zlib
+from concurrent.futures import ThreadPoolExecutor
 
+from gendas.tabix.cache import BlockCache
 from gendas.tabix.constants import *
+from gendas.tabix.index import TabixIndex
 
 
 class BlockReader:
@@ -25,12 +30,15 @@ class BlockReader:
     Class to randomly decompress a single block in a tabix block-gzipped file
     """
 
-    def __init__(self, filename, cache_size=1000):
+    def __init__(self, filename, cache_size=1000, mmap=False, cache: BlockCache = None):
         """
 
         Args:
             filename: Path to a tabix block-gzipped file
             cache_size: Maximum number of block to keep uncompressed in the cache
+            cache: A block cache shared with other readers. Defaults to None, a private cache of 'cache_size' blocks.
+            mmap: True to memory map the file and decompress the blocks directly from the mapped memory.
+                The uncompressed blocks are kept as bytes and only decoded when they are read as text.
         """
 
         # Check that the data file exists
@@ -41,14 +49,30 @@ class BlockReader:
         self.__data = open(self.__filename, "rb")
         self.__header = None
 
+        self.mmap = mmap
+        self.__map = None
+        self.__view = None
+        if mmap:
+            self.__map = mmap_module.mmap(self.__data.fileno(), 0, access=mmap_module.ACCESS_READ)
+            self.__view = memoryview(self.__map)
+
         self.__partial_line_ends = {}
-        self.__blocks_cache = LRUCache(cache_size)
+        if cache is None:
+            cache = BlockCache(cache_size * DEFAULT_UNCOMPRESSED_BLOCK_SIZE)
+        self.__blocks_cache = cache
+
+    def __enter__(self):
+        return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.close()
 
     def close(self):
         self.__header = None
+        if self.__view is not None:
+            self.__view.release()
+            self.__map.close()
+            self.__view, self.__map = None, None
         if self.__data is not None:
             self.__data.close()
 
@@ -66,7 +90,7 @@ class BlockReader:
         block_address = (block >> SHIFT_AMOUNT) & ADDRESS_MASK
         block_offset = int(block & OFFSET_MASK)
 
-        block_length, block_content = self.__read_block_bytes(block_address)
+        block_length, block_content = self.block(block_address)
 
         # Remove offset
         block_content = block_content[block_offset:]
@@ -86,7 +110,7 @@ class BlockReader:
             next_block_address = block_address + block_length
             if next_block_address not in self.__partial_line_ends:
                 # Force to read next block
-                next_block_length, next_block_content = self.__read_block_bytes(next_block_address)
+                next_block_length, next_block_content = self.block(next_block_address)
                 next_block_offset = next_block_content.find('\n')
                 self.__partial_line_ends[next_block_address] = str(next_block_content[:next_block_offset])
 
@@ -95,32 +119,78 @@ class BlockReader:
 
         return lines
 
-    def __read_block_bytes(self, block_address):
+    def block(self, block_address):
+        """
+        Uncompress the block that starts at the given file address
+
+        Args:
+            block_address: Compressed file offset of the block
 
-        # First check cache
-        if self.__blocks_cache.has_key(block_address):
-            block = self.__blocks_cache.get(block_address)
+        Returns:
+            A tuple like (compressed_length, content). The length is zero at the end of the file.
+        """
+        block_compressed_length, content = self.__cached_block(block_address)
+        return block_compressed_length, content.decode("utf-8") if self.mmap else content
+
+    def block_bytes(self, block_address):
+        """
+        Uncompress the block that starts at the given file address without decoding it
+
+        Args:
+            block_address: Compressed file offset of the block
+
+        Returns:
+            A tuple like (compressed_length, content) where content are bytes. The length is zero at the end of the file.
+        """
+        block_compressed_length, content = self.__cached_block(block_address)
+        return block_compressed_length, content if self.mmap else content.encode("utf-8")
+
+    def __cached_block(self, block_address):
+
+        # First check cache. The key includes the file, because the cache can be shared.
+        key = (self.__filename, self.mmap, block_address)
+        block = self.__blocks_cache.get(key)
+        if block is not None:
             return block[0], block[1]
 
+        block_compressed = self.__compressed_block(block_address)
+        if block_compressed is None:
+            return 0, b'' if self.mmap else ''
+        block_compressed_length = len(block_compressed)
+
+        # Decompress only the deflate stream, without copying it from the mapped memory
+        lines = zlib.decompress(block_compressed[BLOCK_HEADER_LENGTH:-BLOCK_FOOTER_LENGTH], -15)
+
+        # Decode string
+        if not self.mmap:
+            lines = lines.decode("utf-8")
+
+        self.__blocks_cache.set(key, (block_compressed_length, lines))
+
+        return block_compressed_length, lines
+
+    def __compressed_block(self, block_address):
+        """
+        Returns: The compressed block, header included, or None at the end of the file
+        """
+        if self.__view is not None:
+            header = self.__view[block_address:block_address + BLOCK_HEADER_LENGTH]
+            if len(header) < BLOCK_HEADER_LENGTH:
+                return None
+            block_compressed_length = struct.unpack_from("H", header, offset=BLOCK_LENGTH_OFFSET)[0] + 1
+            return self.__view[block_address:block_address + block_compressed_length]
+
         self.__data.seek(block_address)
 
         # Read the block header
         header = self.__data.read(BLOCK_HEADER_LENGTH)
+        if len(header) < BLOCK_HEADER_LENGTH:
+            return None
         # Extract compressed block length
         block_compressed_length = struct.unpack_from("H", header, offset=BLOCK_LENGTH_OFFSET)[0] + 1
 
         # Read compressed block
-        block_compressed = header + self.__data.read(block_compressed_length - BLOCK_HEADER_LENGTH)
-
-        # Decompress
-        lines = zlib.decompress(block_compressed, 15 + 32)
-
-        # Decode string
-        lines = lines.decode("utf-8")
-
-        self.__blocks_cache.set(block_address, (block_compressed_length, lines))
-
-        return block_compressed_length, lines
+        return header + self.__data.read(block_compressed_length - BLOCK_HEADER_LENGTH)
 
     def header(self):
         """
@@ -132,30 +202,357 @@ class BlockReader:
         return self.__header
 
 
-class LRUCache:
+class TabixFile:
     """
-    A simple in-memory cache implementation
+    Pure python reader of tabix indexed files. It follows the same interface than the pytabix files.
     """
 
-    def __init__(self, capacity):
-        self.capacity = capacity
-        self.cache = collections.OrderedDict()
+    def __init__(self, filename, index: TabixIndex = None, cache_size=1000, mmap=False, cache: BlockCache = None):
+        """
+        Args:
+            filename: Path to a tabix block-gzipped file
+            index: The tabix index of the file. Defaults to None, load it from the '.tbi' file.
+            cache_size: Maximum number of blocks to keep uncompressed in the cache
+            mmap: True to memory map the file. Then the rows are returned as TabixRow objects that
+                only decode the columns when they are read.
+            cache: A block cache shared with other files. Defaults to None, a private cache.
+        """
+        self.filename = filename
+        self.index = TabixIndex("{}.tbi".format(filename)) if index is None else index
+        self.reader = BlockReader(filename, cache_size=cache_size, mmap=mmap, cache=cache)
+
+        conf = self.index.conf
+        self._sc = conf['sc'] - 1
+        self._bc = conf['bc'] - 1
+        self._ec = conf['ec'] - 1
+        self._meta = chr(conf['meta_char'])
+        self._shift = 0 if self.index.zero_based else 1
+        self._vcf = (conf['preset'] & 0xffff) == PRESET_VCF
+
+    def query(self, sequence, begin: int, end: int):
+        """
+        Rows that overlap a region
 
-    def get(self, key):
-        try:
-            value = self.cache.pop(key)
-            self.cache[key] = value
-            return value
-        except KeyError:
-            return -1
+        Args:
+            sequence: Sequence name
+            begin: One-based begin position (included)
+            end: One-based end position (included)
 
-    def set(self, key, value):
-        try:
-            self.cache.pop(key)
-        except KeyError:
-            if len(self.cache) >= self.capacity:
-                self.cache.popitem(last=False)
-        self.cache[key] = value
+        Returns:
+            A generator of rows as lists of strings
+        """
+        return self.fetch(sequence, max(0, begin - 1), end)
+
+    def querys(self, region: str):
+        """
+        Rows that overlap a region like 'sequence' or 'sequence:begin-end' (one-based, both included)
+        """
+        if ':' not in region:
+            return self.fetch(region, 0, TabixIndex.MAX_POSITION)
 
-    def has_key(self, key):
-        return key in self.cache
+        sequence, positions = region.rsplit(':', 1)
+        begin, end = positions.replace(',', '').split('-')
+        return self.query(sequence, int(begin), int(end))
+
+    def fetch(self, sequence, begin: int, end: int):
+        """
+        Rows that overlap a region
+
+        Args:
+            sequence: Sequence name
+            begin: Zero-based begin position (included)
+            end: Zero-based end position (excluded)
+
+        Returns:
+            A generator of rows as lists of strings
+        """
+        if self.reader.mmap:
+            for fields in self.fetch_bytes(sequence, begin, end):
+                yield TabixRow(fields)
+            return
+
+        for u, v in self.index.query(sequence, begin, end):
+            for line in self._lines(u, v):
+                if line.startswith(self._meta):
+                    continue
+
+                row = line.split('\t')
+                if row[self._sc] != sequence:
+                    continue
+
+                r_begin, r_end = self._interval(row)
+                if r_begin >= end:
+                    # The rows are sorted, next rows and chunks are after the region
+                    return
+                if r_end > begin:
+                    yield row
+
+    def query_bytes(self, sequence, begin: int, end: int):
+        """
+        Same as query, but the rows are lists with the bytes of each column. The numbers can be parsed
+        from the bytes without decoding them.
+        """
+        return self.fetch_bytes(sequence, max(0, begin - 1), end)
+
+    def fetch_bytes(self, sequence, begin: int, end: int):
+        """
+        Same as fetch, but the rows are lists with the bytes of each column
+        """
+        meta = self._meta.encode("utf-8")
+        name = sequence.encode("utf-8")
+        for u, v in self.index.query(sequence, begin, end):
+            for line in self._lines_bytes(u, v):
+                if line.startswith(meta):
+                    continue
+
+                fields = line.split(b'\t')
+                if fields[self._sc] != name:
+                    continue
+
+                r_begin, r_end = self._interval(fields)
+                if r_begin >= end:
+                    # The rows are sorted, next rows and chunks are after the region
+                    return
+                if r_end > begin:
+                    yield fields
+
+    def _interval(self, row):
+        """
+        Zero-based interval (end excluded) of a row
+        """
+        begin = int(row[self._bc]) - self._shift
+        if self._vcf:
+            return begin, begin + len(row[3])
+        if self._ec < 0:
+            return begin, begin + 1
+        return begin, int(row[self._ec])
+
+    def _lines(self, u, v):
+        """
+        Text lines of a chunk
+
+        Args:
+            u: Virtual offset of the first line
+            v: Virtual offset after the last line
+        """
+        address, offset = u >> SHIFT_AMOUNT, u & OFFSET_MASK
+        last_address, last_offset = v >> SHIFT_AMOUNT, v & OFFSET_MASK
+
+        partial = ''
+        while address <= last_address:
+            length, content = self.reader.block(address)
+            if length == 0:
+                break
+
+            text = content[offset:last_offset] if address == last_address else content[offset:]
+            lines = (partial + text).split('\n')
+            partial = lines.pop()
+            for line in lines:
+                yield line
+
+            address += length
+            offset = 0
+
+        if len(partial) > 0:
+            yield partial
+
+    def _lines_bytes(self, u, v):
+        """
+        Same as _lines, but the lines are not decoded
+        """
+        address, offset = u >> SHIFT_AMOUNT, u & OFFSET_MASK
+        last_address, last_offset = v >> SHIFT_AMOUNT, v & OFFSET_MASK
+
+        partial = b''
+        while address <= last_address:
+            length, content = self.reader.block_bytes(address)
+            if length == 0:
+                break
+
+            # Only the lines that continue at the next block are joined
+            lines = content[offset:last_offset if address == last_address else len(content)].split(b'\n')
+            if len(partial) > 0:
+                lines[0] = partial + lines[0]
+            partial = lines.pop()
+            for line in lines:
+                yield line
+
+            address += length
+            offset = 0
+
+        if len(partial) > 0:
+            yield partial
+
+    def close(self):
+        self.reader.close()
+
+
+class TabixRow:
+    """
+    A row of a tabix file. It behaves like a list of strings, but the columns are kept as bytes
+    and only decoded when they are read.
+    """
+
+    __slots__ = ('_fields',)
+
+    def __init__(self, fields):
+        """
+        Args:
+            fields: A list with the bytes of each column
+        """
+        self._fields = fields
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [f.decode("utf-8") for f in self._fields[i]]
+        return self._fields[i].decode("utf-8")
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __iter__(self):
+        return (f.decode("utf-8") for f in self._fields)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class ParallelBlockReader:
+    """
+    Sequential reader of a whole block-gzipped file that decompresses the blocks in a pool of threads.
+    The blocks are compressed independently and zlib releases the GIL, so a single process can use
+    several cores. The lines are returned in file order.
+    """
+
+    # Number of blocks decompressed by each task
+    BLOCKS_PER_TASK = 16
+
+    def __init__(self, filename, threads: int = None, read_ahead: int = None):
+        """
+        Args:
+            filename: Path to a block-gzipped file
+            threads: Number of decompression threads. Defaults to None, the number of cores.
+            read_ahead: Maximum number of tasks decompressed in advance. Defaults to two per thread.
+        """
+        self.filename = filename
+        self.threads = max(1, threads or os.cpu_count())
+        self.read_ahead = read_ahead or 2 * self.threads
+        self.__data = open(filename, "rb")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self.__data is not None:
+            self.__data.close()
+            self.__data = None
+
+    def __iter__(self):
+        """
+        Returns: A generator of the text lines of the file, with the line end
+        """
+        partial = b''
+        for content in self.contents():
+            content = partial + content
+            last = content.rfind(b'\n') + 1
+            partial = content[last:]
+            if last > 0:
+                for line in _lines(content[:last].decode("utf-8"))[:-1]:
+                    yield line + '\n'
+
+        if len(partial) > 0:
+            lines = _lines(partial.decode("utf-8"))
+            for line in lines[:-1]:
+                yield line + '\n'
+            if len(lines[-1]) > 0:
+                yield lines[-1]
+
+    def contents(self):
+        """
+        Returns: A generator of the decompressed contents of the file in order, as bytes
+        """
+        if self.threads == 1:
+            for task in self._tasks():
+                yield _decompress(task)
+            return
+
+        with ThreadPoolExecutor(self.threads) as executor:
+            pending = collections.deque()
+            for task in self._tasks():
+                if len(pending) >= self.read_ahead:
+                    yield pending.popleft().result()
+                pending.append(executor.submit(_decompress, task))
+
+            while len(pending) > 0:
+                yield pending.popleft().result()
+
+    def _tasks(self):
+        """
+        Returns: A generator of lists with BLOCKS_PER_TASK compressed blocks
+        """
+        task = []
+        while True:
+            header = self.__data.read(BLOCK_HEADER_LENGTH)
+            if len(header) < BLOCK_HEADER_LENGTH:
+                break
+
+            block_compressed_length = struct.unpack_from("H", header, offset=BLOCK_LENGTH_OFFSET)[0] + 1
+            task.append(self.__data.read(block_compressed_length - BLOCK_HEADER_LENGTH))
+            if len(task) == ParallelBlockReader.BLOCKS_PER_TASK:
+                yield task
+                task = []
+
+        if len(task) > 0:
+            yield task
+
+
+def _lines(text):
+    """
+    Split a text at the line ends like the gzip text reader does, '\r\n' and '\r' are translated to '\n'.
+    Only those end a line, str.splitlines also splits at other control characters.
+
+    Returns:
+        A list with the lines without their end. The last item is the text after the last line end.
+    """
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return text.split('\n')
+
+
+def _decompress(blocks):
+    """
+    Decompress a list of blocks without their header and join the contents
+    """
+    return b''.join(zlib.decompress(b[:-BLOCK_FOOTER_LENGTH], -15) for b in blocks)
+
+
+def is_bgzf(filename):
+    """
+    Returns: True if the file starts with a block-gzip header
+    """
+    with open(filename, "rb") as fd:
+        header = fd.read(BLOCK_HEADER_LENGTH)
+    return len(header) == BLOCK_HEADER_LENGTH and header[:4] == b'\x1f\x8b\x08\x04' and header[12:14] == b'BC'
+
+
+def open_text(filename, threads: int = None):
+    """
+    Open a gzip compressed text file to read it sequentially. Block-gzipped files are decompressed
+    in parallel, other files are read with the gzip module.
+
+    Args:
+        filename: Path to a gzip or block-gzip compressed file
+        threads: Number of decompression threads. Defaults to None, the number of cores.
+
+    Returns:
+        An iterable of text lines that can be used as a context manager
+    """
+    if is_bgzf(filename):
+        return ParallelBlockReader(filename, threads=threads)
+    return gzip.open(filename, 'rt')
@@ -16,6 +16,28 @@
     Help functions used in several modules.
 """
 
+import json
+import mmap
+import os
+import struct
+import tempfile
+
+import numpy as np
+
+# Magic number of the binary arrays files
+ARRAYS_MAGIC = b'GDA\x01'
+
+# Directory of the shared memory file system
+SHARED_MEMORY = '/dev/shm'
+
+# NumPy data types of the basic column types
+NUMPY_TYPES = {
+    int: np.int64,
+    float: np.float64,
+    bool: np.bool_,
+    str: np.str_
+}
+
 
 def flatten(iterable):
     """
@@ -55,6 +77,30 @@ def _overlap_intervals(intervals):
     return b, e
 
 
+def _coalesce(regions, mergeable):
+    """
+    Sort some regions and group the ones that overlap, that are contiguous or that can be read together
+
+    Args:
+        regions: A list of tuples like (sequence, begin, end)
+        mergeable: A function like f(sequence, end, begin) that returns True when a region that ends at 'end'
+            and the next region that begins at 'begin' can be read together
+
+    Returns:
+        A list of tuples like (sequence, begin, end, indices), with the indices of the grouped regions sorted by begin
+    """
+    groups = []
+    for i in sorted(range(len(regions)), key=lambda i: (regions[i][0], regions[i][1])):
+        sequence, begin, end = regions[i]
+        if len(groups) > 0 and groups[-1][0] == sequence and \
+                (begin <= groups[-1][2] + 1 or mergeable(sequence, groups[-1][2], begin)):
+            groups[-1][2] = max(groups[-1][2], end)
+            groups[-1][3].append(i)
+        else:
+            groups.append([sequence, begin, end, [i]])
+    return [tuple(g) for g in groups]
+
+
 def _skip_partitions(iterator, p):
     for i, v in enumerate(iterator):
         if i % p[1] != p[0]:
@@ -67,3 +113,156 @@ def _skip_comments(iterator, char):
         if v.startswith(char):
             continue
         yield v
+
+
+def _save_arrays(path, meta: dict, arrays: dict):
+    """
+    Write NumPy arrays to a binary file that can be memory mapped later. The file
+    is written to a temporary file and renamed, so readers never see a partial file.
+
+    Args:
+        path: Output file
+        meta: A JSON serializable dictionary with metadata
+        arrays: A dictionary with one-dimensional NumPy arrays by name
+    """
+    arrays = {k: np.ascontiguousarray(v) for k, v in arrays.items()}
+
+    # Each array is aligned to 8 bytes after the header
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        layout[name] = (array.dtype.str, len(array), offset)
+        offset += (array.nbytes + 7) // 8 * 8
+
+    header = json.dumps({'meta': meta, 'arrays': layout}).encode()
+    header += b' ' * (-(len(ARRAYS_MAGIC) + 4 + len(header)) % 8)
+
+    tmp = "{}.tmp{}".format(path, os.getpid())
+    with open(tmp, 'wb') as fd:
+        fd.write(ARRAYS_MAGIC)
+        fd.write(struct.pack('<I', len(header)))
+        fd.write(header)
+        for array in arrays.values():
+            fd.write(array.tobytes())
+            fd.write(b'\0' * (-array.nbytes % 8))
+    os.replace(tmp, path)
+
+
+def _load_arrays(path):
+    """
+    Memory map a file written by '_save_arrays'
+
+    Args:
+        path: The arrays file
+
+    Returns:
+        A tuple like (meta, arrays). The arrays are read-only views of the mapped file.
+    """
+    with open(path, 'rb') as fd:
+        buffer = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if buffer[:len(ARRAYS_MAGIC)] != ARRAYS_MAGIC:
+        raise RuntimeError("[arrays file] wrong magic number at {}".format(path))
+
+    size = struct.unpack('<I', buffer[len(ARRAYS_MAGIC):len(ARRAYS_MAGIC) + 4])[0]
+    start = len(ARRAYS_MAGIC) + 4
+    header = json.loads(buffer[start:start + size].decode())
+    start += size
+
+    arrays = {
+        name: np.frombuffer(buffer, dtype=np.dtype(dtype), count=length, offset=start + offset)
+        for name, (dtype, length, offset) in header['arrays'].items()
+    }
+    return header['meta'], arrays
+
+
+def _shared_path(prefix):
+    """
+    Create an empty file at the shared memory file system, or at the temporary directory if there is none
+
+    Args:
+        prefix: File name prefix
+
+    Returns:
+        The file path
+    """
+    fd, path = tempfile.mkstemp(prefix=prefix, dir=SHARED_MEMORY if os.path.isdir(SHARED_MEMORY) else None)
+    os.close(fd)
+    return path
+
+
+def _encode_strings(values):
+    """
+    Encode a list of strings as a bytes array and an offsets array
+
+    Args:
+        values: A list of strings
+
+    Returns:
+        A tuple like (data, offsets) where the string 'i' is data[offsets[i]:offsets[i + 1]]
+    """
+    encoded = [v.encode() for v in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(e) for e in encoded], dtype=np.int64)
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def _decode_strings(data, offsets):
+    """
+    Decode the strings encoded by '_encode_strings'
+    """
+    blob = data.tobytes()
+    return [blob[offsets[i]:offsets[i + 1]].decode() for i in range(len(offsets) - 1)]
+
+
+def _dtype(ctype):
+    """
+    NumPy data type of a column type
+
+    Args:
+        ctype: A column type (a python type, a NumPy data type or a conversion function)
+
+    Returns:
+        The NumPy data type or None if the values must be stored as python objects
+    """
+    if ctype in NUMPY_TYPES:
+        return NUMPY_TYPES[ctype]
+    try:
+        return np.dtype(ctype)
+    except TypeError:
+        return None
+
+
+def _column(values, ctype, parse=False):
+    """
+    Create a typed NumPy array with the values of a column
+
+    Args:
+        values: A list with the column values
+        ctype: The column type
+        parse: True if the values are strings that need to be converted
+    """
+    dtype = _dtype(ctype)
+    if dtype is None:
+        array = np.empty(len(values), dtype=object)
+        array[:] = [ctype(v) for v in values] if parse else values
+        return array
+    return np.array(values, dtype=dtype)
+
+
+def _rows_to_batches(rows, header, ctypes, size):
+    """
+    Group rows into column batches
+
+    Args:
+        rows: An iterable of rows like {column: value, ...}
+        header: The columns of the batches
+        ctypes: The columns types
+        size: Maximum number of rows at each batch
+
+    Returns:
+        A generator of dictionaries like {column: numpy_array, ...}
+    """
+    for chunk in _get_chunks(rows, size=size):
+        if len(chunk) > 0:
+            yield {h: _column([r[h] for r in chunk], c) for h, c in zip(header, ctypes)}
@@ -0,0 +1,138 @@
+#
+#   Copyright 2018 Jordi Deu-Pons
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may not use this
+#   file except in compliance with the License. You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software distributed under
+#   the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+#   ANY KIND, either express or implied. See the License for the specific language
+#   governing permissions and limitations under the License.
+#
+
+"""
+    Persistent pool of workers. The sources are sent to the workers only once, when the pool starts,
+    and after that the tasks only reference them by identifier. In this way the workers keep the
+    sources (open files, caches, ...) across tasks and queries.
+"""
+
+import atexit
+import logging
+import uuid
+
+import dill
+from multiprocess import Pool, current_process
+
+logger = logging.getLogger("gendas")
+
+# Sources available at this process by identifier
+_SOURCES = {}
+
+# True only at the processes started by a WorkerPool
+_WORKER = False
+
+
+def _init_worker(sources):
+    """
+    Worker initializer. Loads the sources definitions.
+
+    Args:
+        sources: The serialized sources dictionary
+    """
+    global _WORKER
+    _WORKER = True
+    _SOURCES.update(dill.loads(sources))
+
+
+def _shared_source(uid):
+    """
+    Returns: The source with the given identifier at the current process
+    """
+    return _SOURCES[uid]
+
+
+def _is_worker():
+    """
+    Returns: True if the current process is a worker of a gendas pool
+    """
+    return _WORKER or current_process().daemon
+
+
+def shared(uid):
+    """
+    Args:
+        uid: A source identifier
+
+    Returns: True if the source is already available at the workers
+    """
+    return uid is not None and uid in _SOURCES
+
+
+class WorkerPool:
+    """
+    A pool of processes that lives as long as the engine that created it.
+
+    It follows the same interface than pathos pools.
+    """
+
+    def __init__(self, workers: int, sources: dict):
+        """
+        Start the workers.
+
+        Args:
+            workers: Number of processes
+            sources: A dictionary with the sources to share
+        """
+        for source in sources.values():
+            if source.uid is None:
+                source.uid = uuid.uuid4().hex
+
+        shared_sources = {s.uid: s for s in sources.values()}
+
+        # Serialize them before registering, otherwise they will be serialized as references
+        self._pool = Pool(processes=workers, initializer=_init_worker, initargs=(dill.dumps(shared_sources),))
+        self._uids = list(shared_sources.keys())
+        _SOURCES.update(shared_sources)
+        atexit.register(self.close)
+        logger.debug("pool of {} workers started".format(workers))
+
+    def map(self, fn, iterable):
+        return self._pool.map(fn, iterable)
+
+    def imap(self, fn, iterable):
+        return self._pool.imap(fn, iterable)
+
+    def uimap(self, fn, iterable):
+        return self._pool.imap_unordered(fn, iterable)
+
+    def apipe(self, fn, *args):
+        return self._pool.apply_async(fn, args)
+
+    def apply_async(self, fn, args, callback=None, error_callback=None):
+        """
+        Run a function at a worker and call 'callback' with its result, or 'error_callback' with
+        the exception that it raised, at a thread of this process.
+        """
+        return self._pool.apply_async(fn, args, callback=callback, error_callback=error_callback)
+
+    def close(self):
+        """
+        Stop all the workers
+        """
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+            atexit.unregister(self.close)
+            for uid in self._uids:
+                _SOURCES.pop(uid, None)
+            logger.debug("pool closed")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # The pool is kept alive to reuse it in the next queries
+        pass
@@ -0,0 +1,76 @@
+#
+#   Copyright 2018 Jordi Deu-Pons
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may not use this
+#   file except in compliance with the License. You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software distributed under
+#   the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+#   ANY KIND, either express or implied. See the License for the specific language
+#   governing permissions and limitations under the License.
+#
+
+
+import os
+import shutil
+
+import pytest
+
+from gendas.engine import Gendas
+
+DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'examples', 'data')
+
+CONFIG = """
+[variants]
+type = tabix
+file = breast.tsv.gz
+header = CHR, POS, REF, ALT, SAMPLE
+ctypes = str, int, str, str, str
+sequence = CHR
+begin = POS
+end = POS
+
+[exons]
+type = tabix
+file = cds_exons.tsv.gz
+header = CHR, START, STOP, GENE
+ctypes = str, int, int, str
+sequence = CHR
+begin = START
+end = STOP
+indices = GENE,
+
+[genes]
+type = tabix
+file = cds_annotations.tsv.gz
+header = CHR, GENE, SYMBOL, BEGIN, END, STRAND
+ctypes = str, str, str, int, int, str
+sequence = CHR
+begin = BEGIN
+end = END
+"""
+
+
+@pytest.fixture(scope='session')
+def data(tmp_path_factory):
+    """
+    A copy of the example tabix files, so the index caches are not written to the repository
+    """
+    folder = tmp_path_factory.mktemp('data')
+    for name in ('breast.tsv.gz', 'cds_exons.tsv.gz', 'cds_exons.bed.gz', 'cds_annotations.tsv.gz'):
+        for suffix in ('', '.tbi'):
+            shutil.copy(os.path.join(DATA, name + suffix), str(folder))
+
+    with open(str(folder / 'gendas.conf'), 'w') as fd:
+        fd.write(CONFIG)
+
+    return folder
+
+
+@pytest.fixture(params=[1, 2], ids=['serial', 'parallel'])
+def gd(request, data):
+    engine = Gendas(str(data / 'gendas.conf'), workers=request.param)
+    yield engine
+    engine.close()
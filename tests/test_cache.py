@@ -0,0 +1,85 @@
+#
+#   Copyright 2018 Jordi Deu-Pons
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may not use this
+#   file except in compliance with the License. You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software distributed under
+#   the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+#   ANY KIND, either express or implied. See the License for the specific language
+#   governing permissions and limitations under the License.
+#
+
+
+
+import numpy as np
+import pandas as pd
+
+from gendas.cache import RegionCache
+from gendas.sources import PandasSource
+
+
+def _source():
+    source = PandasSource(pd.DataFrame({'CHR': ['1'], 'START': [1], 'STOP': [1]}), sequence='CHR', begin='START',
+                          end='STOP')
+    source.label = 'test'
+    return source
+
+
+def test_region_cache_hits():
+    source = _source()
+    cache = RegionCache(10 ** 6)
+    rows = [{'START': 10, 'STOP': 20}, {'START': 30, 'STOP': 40}]
+    assert cache.get(source, 'rows', '1', 0, 100) is None
+    cache.set(source, 'rows', '1', 0, 100, None, rows)
+
+    assert cache.get(source, 'rows', '1', 0, 100) == rows
+    assert cache.get(source, 'rows', '1', 25, 35) == [rows[1]]
+    assert cache.get(source, 'rows', '1', 0, 101) is None
+    assert cache.get(source, 'rows', '2', 0, 100) is None
+    assert cache.get(source, 'columns', '1', 0, 100) is None
+    assert cache.stats()['hits'] == 2 and cache.stats()['contained_hits'] == 1 and cache.stats()['misses'] == 4
+
+
+def test_region_cache_columns():
+    source = _source()
+    cache = RegionCache(10 ** 6)
+    values = {'START': np.array([10, 30]), 'STOP': np.array([20, 40])}
+    cache.set(source, 'columns', '1', 0, 100, ['START', 'STOP'], values)
+
+    assert cache.get(source, 'columns', '1', 15, 25, ['START'])['START'].tolist() == [10]
+    assert [len(v) for v in cache.get(source, 'columns', '1', 50, 60, ['START']).values()] == [0, 0]
+
+    # A cached result with less columns cannot answer the query
+    assert cache.get(source, 'columns', '1', 15, 25) is None
+
+
+def test_region_cache_copies():
+    source = _source()
+    cache = RegionCache(10 ** 6)
+    rows = [{'START': 10, 'STOP': 20}]
+    cache.set(source, 'rows', '1', 0, 100, None, rows)
+    rows.append({'START': 50, 'STOP': 60})
+
+    cached = cache.get(source, 'rows', '1', 0, 100)
+    assert cached == [{'START': 10, 'STOP': 20}]
+    cached.clear()
+    assert cache.get(source, 'rows', '1', 0, 100) == [{'START': 10, 'STOP': 20}]
+
+    cache.set(source, 'columns', '1', 0, 100, None, {'START': np.array([10])})
+    cache.get(source, 'columns', '1', 0, 100).clear()
+    assert list(cache.get(source, 'columns', '1', 0, 100)) == ['START']
+
+
+def test_region_cache_evictions():
+    source = _source()
+    cache = RegionCache(2000)
+    for i in range(10):
+        cache.set(source, 'rows', '1', i * 100, i * 100 + 99, None, [{'START': i * 100, 'STOP': i * 100 + 1}])
+        assert cache.nbytes <= cache.max_bytes
+
+    assert cache.stats()['evictions'] > 0
+    assert cache.get(source, 'rows', '1', 0, 99) is None
+    assert cache.get(source, 'rows', '1', 900, 999) == [{'START': 900, 'STOP': 901}]
@@ -0,0 +1,140 @@
+#
+#   Copyright 2018 Jordi Deu-Pons
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may not use this
+#   file except in compliance with the License. You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software distributed under
+#   the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+#   ANY KIND, either express or implied. See the License for the specific language
+#   governing permissions and limitations under the License.
+#
+
+
+import pytest
+
+from gendas import engine
+from gendas.engine import GendasSlice
+from gendas.statistics import count, max, mean
+
+
+def test_slice_rows_once(gd):
+    source = gd.sources['genes']
+    genes = [r for r in source][:30]
+    segments = []
+    for gene in genes:
+        middle = (gene['BEGIN'] + gene['END']) // 2
+        segments += [('21', gene['BEGIN'], middle), ('21', middle - 10, gene['END']), ('21', gene['END'], gene['END'])]
+    segments += [('21', 1, 1), ('X', 1, 1000)]
+
+    expected = {}
+    for sequence, begin, end in segments:
+        for row in source.query(sequence, *source.region(begin, end)):
+            expected[_key(row)] = row
+    assert len(expected) > 0
+
+    dataset = GendasSlice(gd, segments)['genes']
+    rows = [r for r in dataset]
+    assert len(rows) == len(expected)
+    assert sorted(rows, key=_key) == sorted(expected.values(), key=_key)
+
+    positions = [v for b in dataset._batches(7) for v in b['BEGIN'].tolist()]
+    assert positions == [r['BEGIN'] for r in rows]
+
+
+def _key(row):
+    return tuple(row.values())
+
+
+def test_shared_scans(gd):
+    source = gd.sources['exons']
+    reads = []
+
+    def read():
+        reads.append(1)
+        return iter([{'GENE': 'A'}, {'GENE': 'B'}])
+
+    partition = GendasSlice(gd, [('21', 0, 1000)], shared=True)
+    first = iter(partition._scan(source, 'rows', {'GENE'}, read))
+    assert next(first) == {'GENE': 'A'}
+
+    # A second reader while the first one is still streaming
+    assert list(partition._scan(source, 'rows', {'GENE'}, read)) == [{'GENE': 'A'}, {'GENE': 'B'}]
+    assert list(first) == [{'GENE': 'B'}]
+    assert list(partition._scan(source, 'rows', {'GENE'}, read)) == [{'GENE': 'A'}, {'GENE': 'B'}]
+    assert len(reads) == 1
+
+
+def test_groupby_reads_once(gd, monkeypatch):
+    queries = []
+    query_batches = engine._query_batches
+
+    def counted(source, *args, **kwargs):
+        queries.append(source.label)
+        return query_batches(source, *args, **kwargs)
+
+    monkeypatch.setattr(engine, '_query_batches', counted)
+    groupby = gd.groupby(gd['exons']['GENE'])
+    label, segments = next(g for g in gd.sources['exons'].index('GENE') if len(g[1]) > 1)
+
+    single = groupby._compute({'N': lambda g: count(g['variants']['POS'])}, {}, (label, segments))
+    reads = len(queries)
+    assert reads > 0
+
+    del queries[:]
+    result = groupby._compute({
+        'N': lambda g: count(g['variants']['POS']),
+        'MEAN': lambda g: mean(g['variants']['POS']),
+        'MAX': lambda g: max(g['variants']['POS'])
+    }, {}, (label, segments))
+    assert len(queries) == reads
+    assert result['N'] == single['N']
+
+
+def test_groupby_aggregators(gd):
+    aggregators = {
+        'N': lambda g: count(g['variants']['POS']),
+        'M': lambda g: mean(g['variants']['POS']),
+        'V': lambda g: g['variants'].count()
+    }
+    grouped = {r['GENE']: r for r in gd.groupby(gd['exons']['GENE']).aggregate(aggregators)}
+    single = {r['GENE']: r for r in gd.groupby(gd['exons']['GENE']).aggregate({'N': aggregators['N']})}
+    assert len(grouped) > 0
+    for gene, r in grouped.items():
+        assert r['N'] == r['V'] == single[gene]['N']
+
+
+def test_groupby_cost_sources(gd):
+    groupby = gd.groupby(gd['exons']['GENE'])
+    assert groupby._read({'N': lambda g: count(g['variants']['POS'])}, {}) == {'variants'}
+    assert groupby._read(lambda g, v: g['variants'].merge(g['genes']).count(), {}) == {'variants', 'genes'}
+    assert groupby._read(lambda g, v: v['missing'], {}) is None
+
+    # Only the sources that the aggregator reads add their compressed bytes
+    segments = [('21', 100, 199), ('21', 300, 399)]
+    assert groupby._cost(segments, []) == 200
+    assert groupby._cost(segments, [_Sized(1000)]) == 2200
+
+
+class _Sized:
+    """
+    A source with a fixed number of compressed bytes at any region
+    """
+
+    def __init__(self, size):
+        self.size = size
+
+    def nbytes(self, sequence, begin, end):
+        return self.size
+
+
+def test_groupby_errors(gd):
+    def fail(g, v):
+        if v['GENE'] is not None:
+            raise ValueError(v['GENE'])
+        return v
+
+    with pytest.raises(ValueError):
+        list(gd.groupby(gd['exons']['GENE']).aggregate(fail))
@@ -0,0 +1,74 @@
+#
+#   Copyright 2018 Jordi Deu-Pons
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may not use this
+#   file except in compliance with the License. You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software distributed under
+#   the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+#   ANY KIND, either express or implied. See the License for the specific language
+#   governing permissions and limitations under the License.
+#
+
+
+
+import numpy as np
+import pytest
+
+from gendas.engine import GendasDatasetFilter, GendasMergeFilter
+from gendas.expressions import And, split
+
+
+def test_expression_columns(gd):
+    expression = (gd['variants']['POS'] > 100) & gd['genes']['STRAND'].isin(['+']) & \
+        (gd['variants']['POS'] < gd['genes']['END'])
+    assert isinstance(expression, And)
+    assert expression.columns() == {'variants': {'POS'}, 'genes': {'STRAND', 'END'}}
+    assert len(expression.conjuncts()) == 3
+
+    inside, outside = split(expression, {'variants'})
+    assert repr(inside) == "(variants.POS > 100)"
+    assert outside.sources() == {'variants', 'genes'}
+    assert split(expression, {'other'})[0] is None
+
+
+def test_expression_batches(gd):
+    expression = ~(gd['variants']['POS'] <= 20000000) | (gd['variants']['REF'] == 'G')
+    row = {'variants': {'POS': 10, 'REF': 'G'}}
+    assert expression(row) and not expression({'variants': {'POS': 10, 'REF': 'A'}})
+
+    batch = {'variants': {'POS': np.array([10, 10, 30000000]), 'REF': np.array(['G', 'A', 'A'], dtype=object)}}
+    assert expression.evaluate_batch(batch).tolist() == [True, False, True]
+
+
+def test_filter_pushdown(gd):
+    merge = gd['variants'].merge(gd['genes'])
+    expression = (gd['variants']['POS'] > 20000000) & gd['genes']['STRAND'].isin(['+']) & \
+        (gd['variants']['POS'] >= gd['genes']['BEGIN'])
+    filtered = merge.filter(expression)
+
+    # The conjuncts of a single dataset filter it before the join
+    assert isinstance(filtered, GendasMergeFilter)
+    assert isinstance(filtered.merge.left, GendasDatasetFilter)
+    assert isinstance(filtered.merge.right, GendasDatasetFilter)
+
+    expected = [
+        r for r in merge
+        if r['variants']['POS'] > 20000000 and r['genes']['STRAND'] == '+' and
+        r['variants']['POS'] >= r['genes']['BEGIN']
+    ]
+    assert len(expected) > 0
+    assert [r for r in filtered] == expected
+    assert filtered.count() == len(expected)
+
+    positions = [v for b in filtered._batches(50) for v in b['variants']['POS'].tolist()]
+    assert positions == [r['variants']['POS'] for r in expected]
+
+
+def test_filter_other_sources(gd):
+    with pytest.raises(ValueError):
+        gd['variants'].filter(gd['genes']['STRAND'] == '+')
+    rows = [r for r in gd['variants'].filter(gd['variants']['REF'] == 'G')]
+    assert len(rows) > 0 and all(r['REF'] == 'G' for r in rows)
@@ -0,0 +1,35 @@
+#
+#   Copyright 2018 Jordi Deu-Pons
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may not use this
+#   file except in compliance with the License. You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software distributed under
+#   the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+#   ANY KIND, either express or implied. See the License for the specific language
+#   governing permissions and limitations under the License.
+#
+
+
+import os
+import shutil
+
+from gendas.indices import load_indices, stale_indices
+
+
+def test_index_coordinates(data, tmp_path):
+    filename = str(tmp_path / 'cds_exons.tsv.gz')
+    shutil.copy(str(data / 'cds_exons.tsv.gz'), filename)
+    by_exon = load_indices(filename, [3], 0, 1, 2)[3]
+    assert os.path.exists(filename + '.3.gdi')
+    assert stale_indices(filename, [3], 0, 1, 2) == []
+
+    # The same file and column with other coordinates columns is built again
+    assert stale_indices(filename, [3], 0, 1, 1) == [3]
+    by_begin = load_indices(filename, [3], 0, 1, 1)[3]
+    gene = next(iter(by_exon.keys()))
+    assert [(s, b, b) for s, b, _ in by_exon[gene]] == by_begin[gene]
+    assert by_exon[gene] != by_begin[gene]
+    assert load_indices(filename, [3], 0, 1, 1)[3][gene] == by_begin[gene]
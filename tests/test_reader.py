@@ -0,0 +1,66 @@
+#
+#   Copyright 2018 Jordi Deu-Pons
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may not use this
+#   file except in compliance with the License. You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software distributed under
+#   the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+#   ANY KIND, either express or implied. See the License for the specific language
+#   governing permissions and limitations under the License.
+#
+
+
+import gzip
+import struct
+import zlib
+
+from gendas.tabix.reader import ParallelBlockReader, is_bgzf
+
+
+def _bgzip(filename, data, block_size=1000):
+    """
+    Write a block-gzip file with blocks of 'block_size' uncompressed bytes
+    """
+    with open(filename, 'wb') as fd:
+        for i in range(0, len(data) + 1, block_size):
+            chunk = data[i:i + block_size]
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+            deflated = compressor.compress(chunk) + compressor.flush()
+            header = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00'
+            fd.write(header + struct.pack('<H', len(header) + 2 + len(deflated) + 8 - 1))
+            fd.write(deflated + struct.pack('<II', zlib.crc32(chunk), len(chunk)))
+
+
+def test_lines_only_end_at_newlines(tmp_path):
+    lines = ['1\t{}\tA\x0bB\x0cC\x1cD\x1dE\x1eF\x85G\u2028H\n'.format(i) for i in range(300)]
+    filename = str(tmp_path / 'lines.tsv.gz')
+    _bgzip(filename, ''.join(lines).encode('utf-8'))
+    assert is_bgzf(filename)
+
+    for threads in (1, 3):
+        with ParallelBlockReader(filename, threads=threads) as reader:
+            assert list(reader) == lines
+
+
+def test_last_line_without_newline(tmp_path):
+    filename = str(tmp_path / 'partial.tsv.gz')
+    _bgzip(filename, b'a\nb\n\nc', block_size=3)
+
+    with ParallelBlockReader(filename, threads=1) as reader:
+        assert list(reader) == ['a\n', 'b\n', '\n', 'c']
+
+
+def test_carriage_returns(tmp_path):
+    data = b'a\tb\r\nc\td\r\n\r\ne\rf\n' * 50 + b'g\r'
+    filename = str(tmp_path / 'windows.tsv.gz')
+    _bgzip(filename, data, block_size=7)
+    with gzip.open(filename, 'rt') as fd:
+        expected = list(fd)
+    assert expected[:2] == ['a\tb\n', 'c\td\n']
+
+    for threads in (1, 3):
+        with ParallelBlockReader(filename, threads=threads) as reader:
+            assert list(reader) == expected
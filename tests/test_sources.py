@@ -0,0 +1,156 @@
+#
+#   Copyright 2018 Jordi Deu-Pons
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may not use this
+#   file except in compliance with the License. You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software distributed under
+#   the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+#   ANY KIND, either express or implied. See the License for the specific language
+#   governing permissions and limitations under the License.
+#
+
+
+import gzip
+
+import pandas as pd
+import pytest
+
+from gendas.sources import ArraySource, PandasSource, TabixSource
+
+
+@pytest.fixture
+def df():
+    return pd.DataFrame({
+        'CHR': ['1', '1', '2', '1', '2'],
+        'START': [10, 5, 7, 30, 1],
+        'STOP': [20, 12, 7, 31, 3],
+        'GENE': ['A', 'B', 'C', 'D', 'E']
+    })
+
+
+def test_pandas_query(df):
+    source = PandasSource(df, sequence='CHR', begin='START', end='STOP')
+    for sequence, begin, end in [('1', 0, 100), ('1', 12, 13), ('1', 13, 30), ('2', 3, 7), ('2', 4, 7), ('X', 0, 10)]:
+        expected = df[(df['CHR'] == sequence) & (df['START'] < end) & (df['STOP'] >= begin)]
+        assert sorted(r['GENE'] for r in source.query(sequence, begin, end)) == sorted(expected['GENE'])
+
+
+def test_pandas_without_coordinates(df):
+    source = PandasSource(df)
+    assert len(source) == 5
+    assert [r['GENE'] for r in source] == ['A', 'B', 'C', 'D', 'E']
+    assert source.statistics() is None
+    with pytest.raises(ValueError):
+        source.query('1', 0, 100)
+
+
+@pytest.mark.parametrize('backend', TabixSource.BACKENDS)
+def test_tabix_partitions(data, backend):
+    source = TabixSource(str(data / 'cds_exons.tsv.gz'), sequence='CHR', begin='START', end='STOP',
+                         header=['CHR', 'START', 'STOP', 'GENE'], ctypes=[str, int, int, str], backend=backend)
+    rows = [r for r in source]
+    assert len(rows) == 2140
+    for partitions in (1, 3, 16):
+        parts = [r for p in range(partitions) for r in source.__iter__(p=(p, partitions))]
+        assert sorted(parts, key=_key) == sorted(rows, key=_key)
+
+
+@pytest.mark.parametrize('backend', TabixSource.BACKENDS)
+def test_tabix_region(data, backend):
+    source = TabixSource(str(data / 'breast.tsv.gz'), sequence='CHR', begin='POS', end='POS',
+                         header=['CHR', 'POS', 'REF', 'ALT', 'SAMPLE'], ctypes=[str, int, str, str, str],
+                         backend=backend)
+    row = next(iter(source))
+    found = list(source.query(row['CHR'], *source.region(row['POS'], row['POS'])))
+    assert row in found and all(r['POS'] == row['POS'] for r in found)
+    assert list(source.query(row['CHR'], *source.region(row['POS'] - 1, row['POS'] - 1))) == []
+
+
+@pytest.mark.parametrize('backend', TabixSource.BACKENDS)
+def test_tabix_region_zero_based(data, backend):
+    source = TabixSource(str(data / 'cds_exons.bed.gz'), sequence='CHR', begin='START', end='STOP',
+                         header=['CHR', 'START', 'STOP', 'SYMBOL'], ctypes=[str, int, int, str], backend=backend)
+    rows = [r for r in source][::100]
+    for row in rows:
+        for position in (row['START'], row['STOP']):
+            found = list(source.query(row['CHR'], *source.region(position, position)))
+            assert row in found
+            assert all(r['START'] <= position <= r['STOP'] for r in found)
+            assert source._covered(*source.region(position, position)) == (position, position)
+        assert row not in source.query(row['CHR'], *source.region(row['START'] - 1, row['START'] - 1))
+        assert row not in source.query(row['CHR'], *source.region(row['STOP'] + 1, row['STOP'] + 1))
+
+
+def test_tabix_query_batches(data):
+    sources = [
+        TabixSource(str(data / 'cds_annotations.tsv.gz'), sequence='CHR', begin='BEGIN', end='END',
+                    header=['CHR', 'GENE', 'SYMBOL', 'BEGIN', 'END', 'STRAND'],
+                    ctypes=[str, str, str, int, int, str], backend=backend)
+        for backend in TabixSource.BACKENDS
+    ]
+    row = next(iter(sources[0]))
+    batches = [list(s.query_batches(row['CHR'], 1, 10 ** 9, batch_size=100)) for s in sources]
+    assert len(batches[0]) > 1 and len(batches[0]) == len(batches[1])
+    for expected, batch in zip(*batches):
+        for h, values in expected.items():
+            assert batch[h].dtype == values.dtype
+            assert batch[h].tolist() == values.tolist()
+
+
+def _sources(data):
+    exons = dict(sequence='CHR', begin='START', end='STOP', header=['CHR', 'START', 'STOP', 'GENE'],
+                 ctypes=[str, int, int, str])
+    sources = [TabixSource(str(data / 'cds_exons.tsv.gz'), backend=b, **exons) for b in TabixSource.BACKENDS]
+    sources.append(TabixSource(str(data / 'cds_exons.bed.gz'), **exons))
+    sources.append(ArraySource(str(data / 'cds_exons.tsv.gz'), **exons))
+    return sources
+
+
+def test_query_many(data):
+    for source in _sources(data):
+        rows = [r for r in source][::40]
+        regions = [('21', 1, 1), ('X', 1, 10 ** 9), ('21', 10 ** 9, 10 ** 9 + 10)]
+        for row in rows:
+            begin, end = row['START'], row['STOP']
+            regions += [
+                ('21',) + source.region(begin, begin), ('21',) + source.region(end, end + 5),
+                ('21',) + source.region(begin - 100, end), ('21',) + source.region(end + 1, end + 50),
+                ('21',) + source.region(begin - 1, begin - 1)
+            ]
+        regions += regions[:10]
+        results = source.query_many(regions, columns=['START', 'STOP'])
+        assert len(results) == len(regions)
+        for region, result in zip(regions, results):
+            expected = list(source.query(*region, columns=['START', 'STOP']))
+            assert sorted(result, key=_key) == sorted(expected, key=_key), region
+
+
+def test_tabix_blank_lines(tmp_path):
+    filename = str(tmp_path / 'rows.tsv.gz')
+    with gzip.open(filename, 'wt') as fd:
+        fd.write('#CHR\tPOS\tGENE\n1\t10\tA\n\n1\t20\n1\t30\tC\n\n')
+    source = TabixSource(filename, sequence='CHR', begin='POS', end='POS',
+                         header=['CHR', 'POS', 'GENE'], ctypes=[str, int, str])
+    assert [r for r in source] == [
+        {'CHR': '1', 'POS': 10, 'GENE': 'A'}, {'CHR': '1', 'POS': 20}, {'CHR': '1', 'POS': 30, 'GENE': 'C'}
+    ]
+    batches = list(source.iter_batches())
+    assert len(batches) == 1
+    assert batches[0]['POS'].tolist() == [10, 20, 30]
+    assert batches[0]['GENE'].tolist() == ['A', '', 'C']
+
+
+def test_array_short_rows(tmp_path):
+    filename = str(tmp_path / 'rows.tsv.gz')
+    with gzip.open(filename, 'wt') as fd:
+        fd.write('1\t10\t15\tA\n1\t20\t25\n\n1\t30\t35\tC\tD\n')
+    source = ArraySource(filename, sequence='CHR', begin='START', end='STOP',
+                         header=['CHR', 'START', 'STOP', 'GENE'], ctypes=[str, int, int, str])
+    assert [(r['START'], r['GENE']) for r in source.query('1', 0, 100)] == [(10, 'A'), (20, ''), (30, 'C')]
+
+
+def _key(row):
+    return tuple(row.values())
@@ -0,0 +1,127 @@
+#
+#   Copyright 2018 Jordi Deu-Pons
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may not use this
+#   file except in compliance with the License. You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software distributed under
+#   the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+#   ANY KIND, either express or implied. See the License for the specific language
+#   governing permissions and limitations under the License.
+#
+
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from gendas.statistics import Describe, Extremes, Histogram, HyperLogLog, Moments, TDigest, _hash, aggregate, count, \
+    describe, max, mean, min
+
+
+def test_count_dataset(gd):
+    assert count(gd['exons']) == 2140
+    assert count(gd['exons']) == gd['exons'].count()
+
+
+def test_count_merge(gd):
+    merge = gd['exons'].merge(gd['genes'])
+    assert count(merge) == 2389
+    assert count(merge) == merge.count()
+
+
+def test_column_statistics(gd):
+    starts = np.array([r['START'] for r in gd['exons']])
+    assert count(gd['exons']['START']) == len(starts)
+    assert min(gd['exons']['START']) == starts.min()
+    assert max(gd['exons']['START']) == starts.max()
+    assert describe(gd['exons']['START'], ['sum'])['sum'] == starts.sum()
+
+
+def test_string_hash_does_not_depend_on_the_batch():
+    values = np.array(['gene{}'.format('x' * (i % 29)) for i in range(1000)])
+    hashes = _hash(values)
+    assert len(np.unique(hashes)) == 29
+
+    # The same values in batches of different widths
+    split = np.concatenate([_hash(np.array(values[i:i + 29].tolist())) for i in range(0, len(values), 29)])
+    assert np.array_equal(hashes, split)
+    assert _hash(np.array(['ab', 'abcdef']))[0] == _hash(np.array(['ab']))[0]
+
+
+def test_distinct_count_of_strings():
+    values = np.array(['v{}'.format(i % 229) for i in range(5000)])
+    state = HyperLogLog()
+    for i in range(0, len(values), 29):
+        state.update(np.array(values[i:i + 29].tolist()))
+    assert abs(state.result() - 229) < 229 * 0.05
+
+
+def _merged(state, values, size):
+    """
+    Aggregate the values in several partial states and merge them
+    """
+    for i in range(0, len(values), size):
+        partial = state.empty()
+        partial.update(values[i:i + size])
+        state.merge(partial)
+    return state
+
+
+def test_moments():
+    values = np.random.default_rng(1).normal(1e6, 3, size=10001)
+    result = _merged(Moments(), values, 997).result()
+    assert result['count'] == len(values)
+    assert result['sum'] == pytest.approx(values.sum())
+    assert result['mean'] == pytest.approx(values.mean())
+    assert result['var'] == pytest.approx(values.var(ddof=1))
+    assert Moments().result()['mean'] is None
+
+
+def test_moments_integers():
+    values = np.full(4, 2 ** 62, dtype=np.int64)
+    result = _merged(Moments(), values, 3).result()
+    assert result['sum'] == 2 ** 64 and result['mean'] == 2 ** 62
+    assert mean([1, 2, 3]) == 2 and isinstance(mean([1, 2, 3]), int)
+    assert mean([1, 2]) == 1.5
+
+
+def test_describe_and_extremes():
+    values = np.random.default_rng(2).integers(-1000, 1000, size=5000)
+    result = _merged(Describe(['count', 'min', 'max', 'std']), values, 333).result()
+    assert result == {'count': 5000, 'min': values.min(), 'max': values.max(), 'std': pytest.approx(values.std(ddof=1))}
+
+    strings = np.array(['b', 'a', 'c'])
+    assert _merged(Extremes(), strings, 2).result() == {'min': 'a', 'max': 'c'}
+    with pytest.raises(ValueError):
+        Describe(['median'])
+
+
+def test_quantiles_and_histogram():
+    values = np.random.default_rng(3).uniform(0, 100, size=20000)
+    quantiles = _merged(TDigest([0.01, 0.5, 0.99]), values, 1000).result()
+    assert quantiles == pytest.approx(np.quantile(values, [0.01, 0.5, 0.99]), abs=1)
+
+    edges = [0, 10, 50, 100]
+    assert list(_merged(Histogram(edges), values, 1000).result()) == list(np.histogram(values, bins=edges)[0])
+
+
+def test_distinct_count_merge():
+    values = np.arange(100000) % 30000
+    state = _merged(HyperLogLog(12), values, 7000)
+    assert state.precision == 12
+    assert abs(state.result() - 30000) < 30000 * 0.05
+
+
+def test_column_aggregate(gd):
+    starts = np.array([r['START'] for r in gd['exons']])
+    result = aggregate(gd['exons']['START'], Describe(['count', 'sum', 'min', 'max'])).result()
+    assert result == {'count': len(starts), 'sum': starts.sum(), 'min': starts.min(), 'max': starts.max()}
+
+
+def test_aggregate_collections():
+    values = [1.0, 2.0, 3.0]
+    assert aggregate(values, Moments()).result()['mean'] == 2.0
+    assert aggregate(pd.Series(values), Moments()).result()['mean'] == 2.0
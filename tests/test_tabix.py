@@ -0,0 +1,120 @@
+#
+#   Copyright 2018 Jordi Deu-Pons
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may not use this
+#   file except in compliance with the License. You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software distributed under
+#   the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+#   ANY KIND, either express or implied. See the License for the specific language
+#   governing permissions and limitations under the License.
+#
+
+
+import gzip
+import os
+import shutil
+
+import pytest
+import tabix
+
+from gendas.tabix.index import TabixIndex
+from gendas.tabix.reader import TabixFile
+
+DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'examples', 'data')
+
+FILES = ['breast.tsv.gz', 'cds_exons.tsv.gz', 'cds_annotations.tsv.gz']
+
+# Begin and end columns of each file (zero-based column numbers)
+COORDINATES = {'breast.tsv.gz': (1, 1), 'cds_exons.tsv.gz': (1, 2), 'cds_annotations.tsv.gz': (3, 4)}
+
+
+def _regions(filename):
+    """
+    Query regions at the rows boundaries, inside, between and after the rows
+    """
+    b_col, e_col = COORDINATES[filename]
+    with gzip.open(os.path.join(DATA, filename), 'rt') as fd:
+        rows = [line.rstrip('\n').split('\t') for line in fd if not line.startswith('#')]
+
+    regions = []
+    for row in rows[::max(1, len(rows) // 50)]:
+        sequence, begin, end = row[0], int(row[b_col]), int(row[e_col])
+        regions += [
+            (sequence, begin, begin), (sequence, begin - 1, begin - 1), (sequence, end, end),
+            (sequence, end + 1, end + 1), (sequence, begin - 10, begin - 1), (sequence, end + 1, end + 10),
+            (sequence, begin, end), (sequence, begin + 1, end + 1000)
+        ]
+    last = max(int(r[e_col]) for r in rows)
+    regions += [(rows[0][0], 1, 1), (rows[0][0], last + 1, last + 100000), (rows[0][0], 1, last + 1)]
+    return regions
+
+
+@pytest.mark.parametrize('mmap', [False, True], ids=['read', 'mmap'])
+@pytest.mark.parametrize('filename', FILES)
+def test_query(filename, mmap):
+    path = os.path.join(DATA, filename)
+    expected = tabix.open(path)
+    reader = TabixFile(path, mmap=mmap)
+    for sequence, begin, end in _regions(filename):
+        assert list(map(list, reader.query(sequence, begin, end))) == \
+            list(expected.query(sequence, begin, end)), (sequence, begin, end)
+    reader.close()
+
+
+@pytest.mark.parametrize('filename', FILES)
+def test_querys(filename):
+    path = os.path.join(DATA, filename)
+    expected = tabix.open(path)
+    reader = TabixFile(path)
+    for sequence, begin, end in _regions(filename)[:40]:
+        region = '{}:{}-{}'.format(sequence, max(1, begin), end)
+        assert list(reader.querys(region)) == list(expected.querys(region)), region
+
+    sequence = _regions(filename)[0][0]
+    assert list(reader.querys(sequence)) == list(expected.querys(sequence))
+    reader.close()
+
+
+def test_missing_sequence():
+    path = os.path.join(DATA, 'cds_exons.tsv.gz')
+    reader = TabixFile(path)
+    assert list(reader.query('X', 1, 100000000)) == []
+    assert list(reader.querys('X')) == []
+    reader.close()
+
+    # pytabix fails instead of returning no rows
+    with pytest.raises(tabix.TabixError):
+        list(tabix.open(path).query('X', 1, 100000000))
+
+
+@pytest.mark.parametrize('filename', FILES)
+def test_index_cache(filename, tmp_path):
+    shutil.copy(os.path.join(DATA, filename + '.tbi'), str(tmp_path))
+    path = str(tmp_path / (filename + '.tbi'))
+
+    parsed = TabixIndex(path)
+    written = TabixIndex(path, cache=True)
+    assert os.path.exists(path + '.gdc')
+    mapped = TabixIndex(path, cache=True)
+
+    for index in (written, mapped):
+        assert index.names == parsed.names
+        assert index.conf == parsed.conf
+        for name in parsed.names:
+            assert list(index.linear[name]['offset']) == list(parsed.linear[name]['offset'])
+            assert index._chunks(name) == parsed._chunks(name)
+            assert index.query(name, 0, TabixIndex.MAX_POSITION) == parsed.query(name, 0, TabixIndex.MAX_POSITION)
+
+
+def test_index_binning():
+    index = TabixIndex(os.path.join(DATA, 'cds_exons.tsv.gz.tbi'))
+    with pytest.warns(DeprecationWarning):
+        binning = index.binning
+
+    assert list(binning.keys()) == index.names
+    for name in index.names:
+        chunks = [c for bin, c in binning[name].items() if bin != TabixIndex.MAX_BIN]
+        assert all(0 <= u < v for bin_chunks in chunks for u, v in bin_chunks)
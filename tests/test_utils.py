@@ -0,0 +1,29 @@
+#
+#   Copyright 2018 Jordi Deu-Pons
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may not use this
+#   file except in compliance with the License. You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software distributed under
+#   the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+#   ANY KIND, either express or implied. See the License for the specific language
+#   governing permissions and limitations under the License.
+#
+
+
+
+from gendas.utils import _coalesce
+
+
+def test_coalesce():
+    regions = [('1', 50, 60), ('2', 1, 5), ('1', 1, 10), ('1', 5, 20), ('1', 21, 30), ('1', 40, 45)]
+    assert _coalesce(regions, lambda sequence, end, begin: False) == [
+        ('1', 1, 30, [2, 3, 4]), ('1', 40, 45, [5]), ('1', 50, 60, [0]), ('2', 1, 5, [1])
+    ]
+
+    # Close regions of the same sequence are read together
+    close = _coalesce(regions, lambda sequence, end, begin: begin - end <= 10)
+    assert close == [('1', 1, 60, [2, 3, 4, 5, 0]), ('2', 1, 5, [1])]
+    assert _coalesce([], lambda sequence, end, begin: True) == []